@@ -28,6 +28,7 @@ import math
 
 import opts
 from misc import utils, AttModel
+from misc.samplers import BucketBatchSampler, BlockShuffleSampler, PlannedBatchSampler
 from collections import defaultdict
 
 import torchvision.transforms as transforms
@@ -44,13 +45,32 @@ from evaluate import ANETcaptions
 from eval_grd_anet_entities import ANetGrdEval
 
 
+def plan_epoch(loader):
+    # let the prefetcher of the dataset know the batches of the coming epoch
+    if isinstance(loader.batch_sampler, PlannedBatchSampler):
+        loader.dataset.plan_prefetch(loader.batch_sampler.plan(), loader.num_workers)
+
+
+def load_vis_frame(frame_dir, frm_idx, scale):
+    # decode (and downscale) one of the sampled frames of a segment, as RGB
+    img = cv2.imread(os.path.join(frame_dir, str(frm_idx+1).zfill(2)+'.jpg'))
+    if img is None:
+        print('cannot load image...')
+        return None
+    if scale != 1:
+        img = cv2.resize(img, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    return np.ascontiguousarray(img[:, :, ::-1])
+
+
 # visualization over generated sentences
-def vis_infer(seg_show, seg_id, caption, att2_weights, proposals, num_box, gt_bboxs, sim_mat, seg_dim_info):
+def vis_infer(frame_dir, seg_id, caption, att2_weights, proposals, num_box, gt_bboxs, sim_mat):
     cap = caption.split()
     output = []
     top_k_prop = 1 # plot the top 1 proposal only
     proposal = proposals[:num_box[1].item()]
     gt_bbox = gt_bboxs[:num_box[2].item()]
+    scale = opt.vis_frame_scale
+    frames = {} # only the frames of the attended proposals are decoded
 
     sim_mat_val, sim_mat_ind = torch.max(sim_mat, dim=0)
 
@@ -60,19 +80,26 @@ def vis_infer(seg_show, seg_id, caption, att2_weights, proposals, num_box, gt_bb
 
             idx = top_k_alpha_idx
             target_frm = int(proposal[idx, 4].item())
-            seg = copy.deepcopy(seg_show[target_frm, :seg_dim_info[0], :seg_dim_info[1]].numpy())
-            seg_text = np.ones((67, int(seg_dim_info[1]), 3))*255
-            cv2.putText(seg_text, '%s' % (cap[j]), (50, 50), cv2.FONT_HERSHEY_PLAIN, 3.0, (255, 0, 0), thickness=3)
+            if target_frm not in frames:
+                frames[target_frm] = load_vis_frame(frame_dir, target_frm, scale)
+            if frames[target_frm] is None: # blank frame of the same size as the others
+                loaded = [f for f in frames.values() if f is not None]
+                seg = np.zeros_like(loaded[0]) if loaded else np.zeros((int(1280*scale), int(720*scale), 3), dtype=np.uint8)
+            else:
+                seg = frames[target_frm].copy()
+            seg_text = np.full((int(67*scale), seg.shape[1], 3), 255, dtype=np.uint8)
+            cv2.putText(seg_text, '%s' % (cap[j]), (int(50*scale), int(50*scale)), cv2.FONT_HERSHEY_PLAIN, 3.0*scale,
+                        (255, 0, 0), thickness=max(1, int(round(3*scale))))
 
             # draw the proposal box and text
             idx = top_k_alpha_idx
-            bbox = proposal[idx, :4]
-            bbox = tuple(int(np.round(x)) for x in proposal[idx, :4])
+            bbox = tuple(int(np.round(x*scale)) for x in proposal[idx, :4])
             class_name = opt.itod.get(sim_mat_ind[idx].item(), '__background__')
             cv2.rectangle(seg, bbox[0:2], bbox[2:4],
-                         (0, 255, 0), 2)
+                         (0, 255, 0), max(1, int(round(2*scale))))
             cv2.putText(seg, '%s: (%.2f)' % (class_name, sim_mat_val[idx]),
-                       (bbox[0], bbox[1] + 25), cv2.FONT_HERSHEY_PLAIN, 2.0, (0, 0, 255), thickness=2)
+                       (bbox[0], bbox[1] + int(25*scale)), cv2.FONT_HERSHEY_PLAIN, 2.0*scale, (0, 0, 255),
+                       thickness=max(1, int(round(2*scale))))
 
             output.append(np.concatenate([seg_text, seg], axis=0))
 
@@ -89,6 +116,7 @@ def vis_infer(seg_show, seg_id, caption, att2_weights, proposals, num_box, gt_bb
 def eval_grounding(opt, vis=None):
     model.eval()
 
+    plan_epoch(dataloader_val)
     data_iter = iter(dataloader_val)
     cls_pred_lst = []
     cls_accu_score = defaultdict(list)
@@ -98,11 +126,19 @@ def eval_grounding(opt, vis=None):
 
     for step in range(len(dataloader_val)):
         data = data_iter.next()
+        vid_idx = None
+        if opt.dedup_video_feats:
+            data, vid_idx = data[:-1], data[-1]
+            if opt.cuda:
+                vid_idx = vid_idx.cuda()
+        ppl_slots = None
+        if opt.packed_proposals:
+            data, ppl_slots = data[:-1], data[-1]
         seg_feat, iseq, gts_seq, num, proposals, bboxs, box_mask, seg_id, region_feat, frm_mask, sample_idx, ppl_mask = data
 
         proposals = proposals[:,:max(int(max(num[:,1])),1),:]
         ppl_mask = ppl_mask[:,:max(int(max(num[:,1])),1)]
-        assert(max(int(max(num[:,1])),1) == opt.num_sampled_frm*opt.num_prop_per_frm)
+        assert(opt.packed_proposals or max(int(max(num[:,1])),1) == opt.num_sampled_frm*opt.num_prop_per_frm)
         bboxs = bboxs[:,:max(int(max(num[:,2])),1),:]
         frm_mask = frm_mask[:, :max(int(max(num[:,1])),1), :max(int(max(num[:,2])),1)]
         region_feat = region_feat[:,:max(int(max(num[:,1])),1),:]
@@ -120,17 +156,22 @@ def eval_grounding(opt, vis=None):
         sample_idx = Variable(sample_idx.type(input_seqs.type()))
 
         dummy = input_ppls.new(input_ppls.size(0)).byte().fill_(0)
+        vid_ids = [s.split('_segment_')[0] for s in seg_id]
 
         # cls_pred_hm_lst contains a list of tuples (clss_ind, hit/1 or miss/0)
         cls_pred_hm_lst, att2_ind, grd_ind = model(segs_feat, input_seqs, gt_seqs, input_num,
-            input_ppls, gt_bboxs, dummy, ppls_feat, mask_frms, sample_idx, pnt_mask, 'GRD')
+            input_ppls, gt_bboxs, dummy, ppls_feat, mask_frms, sample_idx, pnt_mask, 'GRD', {'ppl_slots':ppl_slots, 'vid_ids':vid_ids}, vid_idx)
 
         # save attention/grounding results on GT sentences
+        fixed_ppls = input_ppls
+        if ppl_slots is not None: # packed proposals, back to the fixed layout
+            fixed_ppls = utils.scatter_rois(input_ppls.transpose(1, 2), ppl_slots, \
+                opt.num_sampled_frm*opt.num_prop_per_frm).transpose(1, 2)
         obj_mask = (input_seqs[:,0,1:,0] > opt.vocab_size) # Bx20
-        obj_bbox_att2 = torch.gather(input_ppls.view(-1, opt.num_sampled_frm, opt.num_prop_per_frm, 7) \
+        obj_bbox_att2 = torch.gather(fixed_ppls.contiguous().view(-1, opt.num_sampled_frm, opt.num_prop_per_frm, 7) \
             .permute(0, 2, 1, 3).contiguous(), 1, att2_ind.unsqueeze(-1).expand((att2_ind.size(0), \
             att2_ind.size(1), opt.num_sampled_frm, 7))) # Bx20x10x7
-        obj_bbox_grd = torch.gather(input_ppls.view(-1, opt.num_sampled_frm, opt.num_prop_per_frm, 7) \
+        obj_bbox_grd = torch.gather(fixed_ppls.contiguous().view(-1, opt.num_sampled_frm, opt.num_prop_per_frm, 7) \
             .permute(0, 2, 1, 3).contiguous(), 1, grd_ind.unsqueeze(-1).expand((grd_ind.size(0), \
             grd_ind.size(1), opt.num_sampled_frm, 7))) # Bx20x10x7
 
@@ -187,6 +228,9 @@ def eval_grounding(opt, vis=None):
 def train(epoch, opt, vis=None, vis_window=None):
     model.train()
 
+    if opt.sample_shards:
+        dataset.set_epoch(epoch)
+    plan_epoch(dataloader)
     data_iter = iter(dataloader)
     nbatches = len(dataloader)
     train_loss = []
@@ -199,6 +243,13 @@ def train(epoch, opt, vis=None, vis_window=None):
 
     for step in range(len(dataloader)-1):
         data = data_iter.next()
+        vid_idx = None
+        if opt.dedup_video_feats:
+            data, vid_idx = data[:-1], data[-1]
+            if opt.cuda:
+                vid_idx = vid_idx.cuda()
+        if opt.packed_proposals:
+            data = data[:-1] # ppl_slots, only needed to map the grounding results back
         seg_feat, iseq, gts_seq, num, proposals, bboxs, box_mask, seg_id, region_feat, frm_mask, sample_idx, ppl_mask = data
         proposals = proposals[:,:max(int(max(num[:,1])),1),:]
         ppl_mask = ppl_mask[:,:max(int(max(num[:,1])),1)]
@@ -223,7 +274,7 @@ def train(epoch, opt, vis=None, vis_window=None):
 
         loss = 0
         lm_loss, att2_loss, ground_loss, cls_loss = model(segs_feat, input_seqs, gt_seqs, input_num,
-            input_ppls, gt_bboxs, mask_bboxs, ppls_feat, mask_frms, sample_idx, pnt_mask, 'MLE')
+            input_ppls, gt_bboxs, mask_bboxs, ppls_feat, mask_frms, sample_idx, pnt_mask, 'MLE', vid_idx=vid_idx)
 
         w_att2, w_grd, w_cls = opt.w_att2, opt.w_grd, opt.w_cls
         att2_loss = w_att2*att2_loss.sum()
@@ -300,17 +351,25 @@ def train(epoch, opt, vis=None, vis_window=None):
             loss_history[iteration] = loss.item()
             lr_history[iteration] = opt.learning_rate
 
+    # per-epoch data loading cache statistics
+    for stats in dataset.cache_stats():
+        print(stats.summary())
+        stats.reset()
+    if bucket_sampler is not None:
+        print(bucket_sampler.padding_summary())
+
 
 def eval(epoch, opt, vis=None, vis_window=None):
     model.eval()
 
+    plan_epoch(dataloader_val)
     data_iter_val = iter(dataloader_val)
     start = time.time()
 
     num_show = 0
     predictions = defaultdict(list)
     count = 0
-    raw_caption_file = json.load(open(opt.input_raw_cap))
+    catalog = dataset_val.catalog # segment boundaries of the predictions
     min_value = -1e8
 
     if opt.eval_obj_grounding:
@@ -322,8 +381,16 @@ def eval(epoch, opt, vis=None, vis_window=None):
     if opt.eval_obj_grounding or opt.language_eval:
         for step in range(len(dataloader_val)):
             data = data_iter_val.next()
+            vid_idx = None
+            if opt.dedup_video_feats:
+                data, vid_idx = data[:-1], data[-1]
+                if opt.cuda:
+                    vid_idx = vid_idx.cuda()
+            ppl_slots = None
+            if opt.packed_proposals:
+                data, ppl_slots = data[:-1], data[-1]
             if opt.vis_attn:
-                seg_feat, iseq, gts_seq, num, proposals, bboxs, box_mask, seg_id, seg_show, seg_dim_info, region_feat, frm_mask, sample_idx, ppl_mask = data
+                seg_feat, iseq, gts_seq, num, proposals, bboxs, box_mask, seg_id, frame_dir, region_feat, frm_mask, sample_idx, ppl_mask = data
             else:
                 seg_feat, iseq, gts_seq, num, proposals, bboxs, box_mask, seg_id, region_feat, frm_mask, sample_idx, ppl_mask = data
 
@@ -339,21 +406,27 @@ def eval(epoch, opt, vis=None, vis_window=None):
             ppls_feat.resize_(region_feat.size()).data.copy_(region_feat)
             sample_idx = Variable(sample_idx.type(input_num.type()))
 
-            eval_opt = {'sample_max':1, 'beam_size': opt.beam_size, 'inference_mode' : True}
+            eval_opt = {'sample_max':1, 'beam_size': opt.beam_size, 'inference_mode' : True,
+                        'vid_ids':[s.split('_segment_')[0] for s in seg_id]}
             dummy = input_ppls.new(input_ppls.size(0)).byte().fill_(0)
 
             batch_size = input_ppls.size(0)
 
             seq, att2_weights, sim_mat = model(segs_feat, dummy, dummy, input_num, \
-                                               input_ppls, dummy, dummy, ppls_feat, dummy, sample_idx, pnt_mask, 'sample', eval_opt)
+                                               input_ppls, dummy, dummy, ppls_feat, dummy, sample_idx, pnt_mask, 'sample', eval_opt, vid_idx)
 
             # save localization results on generated sentences
             if opt.eval_obj_grounding:
                 assert opt.beam_size == 1, 'only support beam_size is 1'
 
-                att2_ind = torch.max(att2_weights.view(batch_size, att2_weights.size(1), \
+                fixed_att2_weights, fixed_ppls = att2_weights, input_ppls
+                if ppl_slots is not None: # packed proposals, back to the fixed layout
+                    num_slots = opt.num_sampled_frm*opt.num_prop_per_frm
+                    fixed_att2_weights = utils.scatter_rois(att2_weights, ppl_slots, num_slots, -1e8) # masked logits
+                    fixed_ppls = utils.scatter_rois(input_ppls.transpose(1, 2), ppl_slots, num_slots).transpose(1, 2)
+                att2_ind = torch.max(fixed_att2_weights.contiguous().view(batch_size, att2_weights.size(1), \
                     opt.num_sampled_frm, opt.num_prop_per_frm), dim=-1)[1]
-                obj_bbox_att2 = torch.gather(input_ppls.view(-1, opt.num_sampled_frm, opt.num_prop_per_frm, 7) \
+                obj_bbox_att2 = torch.gather(fixed_ppls.contiguous().view(-1, opt.num_sampled_frm, opt.num_prop_per_frm, 7) \
                     .permute(0, 2, 1, 3).contiguous(), 1, att2_ind.unsqueeze(-1).expand((batch_size, \
                     att2_ind.size(1), opt.num_sampled_frm, input_ppls.size(-1)))) # Bx20x10x7
 
@@ -377,12 +450,11 @@ def eval(epoch, opt, vis=None, vis_window=None):
                                           dataset.wtod, seq.data, opt.vocab_size, opt)
 
             for k, sent in enumerate(sents):
-                vid_idx, seg_idx = seg_id[k].split('_segment_')
-                seg_idx = int(seg_idx)
+                vid_idx = seg_id[k].split('_segment_')[0]
 
                 predictions[vid_idx].append(
                     {'sentence':sent,
-                    'timestamp':raw_caption_file[vid_idx]['timestamps'][seg_idx]})
+                    'timestamp':catalog.timestamps[catalog.index(seg_id[k])].tolist()})
 
                 if num_show < 20:
                     print('segment %s: %s' %(seg_id[k], sent))
@@ -394,9 +466,9 @@ def eval(epoch, opt, vis=None, vis_window=None):
                     att2_weights = F.softmax(att2_weights, dim=2)
                     # visualize some selected examples
                     if torch.sum(proposals[k]) != 0:
-                        vis_infer(seg_show[k], seg_id[k], sent, \
+                        vis_infer(frame_dir[k], seg_id[k], sent, \
                             att2_weights[k].cpu().data, proposals[k], num[k].long(), \
-                            bboxs[k], sim_mat[k].cpu().data, seg_dim_info[k])
+                            bboxs[k], sim_mat[k].cpu().data)
 
             if count % 2 == 0:
                 print(count)
@@ -501,6 +573,10 @@ def eval(epoch, opt, vis=None, vis_window=None):
                 update='append'
             )
 
+    for stats in dataset_val.cache_stats() + (model.module if opt.mGPUs else model).cache_stats():
+        print(stats.summary())
+        stats.reset()
+
     print('Saving the predictions')
 
     # Write validation result into summary
@@ -537,7 +613,7 @@ if __name__ == '__main__':
         import cv2
 
     if opt.dataset == 'anet':
-        from misc.dataloader_anet import DataLoader
+        from misc.dataloader_anet import DataLoader, StreamingDataLoader
     else:
         raise Exception('only support anet!')
 
@@ -545,13 +621,41 @@ if __name__ == '__main__':
         os.makedirs(opt.checkpoint_path)
 
     # Data Loader
-    dataset = DataLoader(opt, split=opt.train_split, seq_per_img=opt.seq_per_img)
-    dataloader = torch.utils.data.DataLoader(dataset, batch_size=opt.batch_size,
-                                            shuffle=True, num_workers=opt.num_workers)
+    bucket_sampler = None
+    if opt.sample_shards:
+        assert not opt.bucket_batches, 'bucketed batches need random access, not supported with sample shards'
+        assert not opt.block_shuffle, 'sample shards are already read sequentially, --block_shuffle is not supported'
+        assert opt.prefetch_depth == 0, 'the prefetcher needs random access, not supported with sample shards'
+        dataset = StreamingDataLoader(opt, split=opt.train_split, seq_per_img=opt.seq_per_img)
+        # shuffled by the dataset itself (shard order and shuffle buffer)
+        dataloader = torch.utils.data.DataLoader(dataset, batch_size=opt.batch_size,
+                                                num_workers=opt.num_workers, collate_fn=dataset.collate)
+    else:
+        dataset = DataLoader(opt, split=opt.train_split, seq_per_img=opt.seq_per_img)
+        assert not (opt.bucket_batches and opt.block_shuffle), '--bucket_batches and --block_shuffle are exclusive'
+        if opt.bucket_batches:
+            bucket_sampler = BucketBatchSampler(dataset.sample_lengths(), opt.batch_size, opt.bucket_pool_size)
+            batch_sampler = bucket_sampler
+        elif opt.block_shuffle:
+            batch_sampler = torch.utils.data.BatchSampler(BlockShuffleSampler(
+                dataset.sample_blocks(opt.shuffle_block_videos), opt.shuffle_window), opt.batch_size, False)
+        else:
+            batch_sampler = torch.utils.data.BatchSampler(torch.utils.data.RandomSampler(dataset),
+                                                          opt.batch_size, False)
+        if opt.prefetch_depth > 0:
+            batch_sampler = PlannedBatchSampler(batch_sampler)
+        dataloader = torch.utils.data.DataLoader(dataset, batch_sampler=batch_sampler,
+                                                num_workers=opt.num_workers, worker_init_fn=dataset.init_worker,
+                                                collate_fn=dataset.collate)
 
     dataset_val = DataLoader(opt, split=opt.val_split, seq_per_img=opt.seq_per_img)
-    dataloader_val = torch.utils.data.DataLoader(dataset_val, batch_size=opt.batch_size,
-                                            shuffle=False, num_workers=opt.num_workers)
+    batch_sampler_val = torch.utils.data.BatchSampler(torch.utils.data.SequentialSampler(dataset_val),
+                                                      opt.batch_size, False)
+    if opt.prefetch_depth > 0:
+        batch_sampler_val = PlannedBatchSampler(batch_sampler_val)
+    dataloader_val = torch.utils.data.DataLoader(dataset_val, batch_sampler=batch_sampler_val,
+                                            num_workers=opt.num_workers, worker_init_fn=dataset_val.init_worker,
+                                            collate_fn=dataset_val.collate)
 
     segs_feat = torch.FloatTensor(1)
     input_seqs = torch.LongTensor(1)
@@ -644,6 +748,8 @@ if __name__ == '__main__':
     ss_prob_history = histories.get('ss_prob_history', {})
 
     if opt.mGPUs:
+        assert not opt.dedup_video_feats, 'DataParallel would split the unique videos and the segments differently'
+        assert opt.context_cache_mb == 0, 'the context encoding cache is not shared between the DataParallel replicas'
         model = nn.DataParallel(model)
 
     if opt.cuda:
@@ -32,22 +32,27 @@ class Attention(nn.Module):
 
     def forward(self, h, att_feats, p_att_feats):
         # The p_att_feats here is already projected
+        # The rows of h can be a multiple of the rows of att_feats, rows k*group...(k+1)*group-1
+        # of h (e.g., the captions or the beams of a segment) attend to att_feats[k]
         batch_size = h.size(0)
-        att_size = att_feats.numel() // batch_size // self.rnn_size
-        att = p_att_feats.view(-1, att_size, self.att_hid_size)
+        num_feats = att_feats.size(0)
+        group = batch_size // num_feats
+        att_size = att_feats.numel() // num_feats // self.rnn_size
+        att = p_att_feats.view(num_feats, 1, att_size, self.att_hid_size)
         
         att_h = self.h2att(h)                        # batch * att_hid_size
-        att_h = att_h.unsqueeze(1)            # batch * att_size * att_hid_size
-        dot = att + att_h                                # batch * att_size * att_hid_size
-        dot = F.tanh(dot)                              # batch * att_size * att_hid_size
+        att_h = att_h.view(num_feats, group, 1, self.att_hid_size)
+        dot = att + att_h                                # num_feats * group * att_size * att_hid_size
+        dot = F.tanh(dot)                              # num_feats * group * att_size * att_hid_size
         dot = dot.view(-1, self.att_hid_size)               # (batch * att_size) * att_hid_size
         # dot = F.dropout(dot, 0.3, training=self.training)
         dot = self.alpha_net(dot)                           # (batch * att_size) * 1
         dot = dot.view(-1, att_size)                        # batch * att_size
         
         weight = F.softmax(dot, dim=1)                             # batch * att_size
-        att_feats_ = att_feats.view(-1, att_size, self.rnn_size) # batch * att_size * att_feat_size
-        att_res = torch.bmm(weight.unsqueeze(1), att_feats_).squeeze(1) # batch * att_feat_size
+        att_feats_ = att_feats.view(num_feats, att_size, self.rnn_size) # num_feats * att_size * att_feat_size
+        att_res = torch.bmm(weight.view(num_feats, group, att_size), att_feats_) # num_feats * group * att_feat_size
+        att_res = att_res.view(batch_size, self.rnn_size)
         # att_res = self.batch_norm(att_res)
 
         return att_res
@@ -70,9 +75,13 @@ class Attention2(nn.Module):
 
     def forward(self, h, att_feats, p_att_feats, att_mask, pnt_mask):
         # The p_att_feats here is already projected
+        # As in Attention, the rows of h can be a multiple of the rows of att_feats; the masks have
+        # the rows of either
         batch_size = h.size(0)
-        att_size = att_feats.numel() // batch_size // self.rnn_size
-        att = p_att_feats.view(-1, att_size, self.att_hid_size)
+        num_feats = att_feats.size(0)
+        group = batch_size // num_feats
+        att_size = att_feats.numel() // num_feats // self.rnn_size
+        att = p_att_feats.view(num_feats, 1, att_size, self.att_hid_size)
         
         att_h = self.h2att(h)                        # batch * att_hid_size
 
@@ -80,30 +89,32 @@ class Attention2(nn.Module):
             # print('Additive region attention!')
             if self.alpha_net.weight.size(1) == self.att_hid_size:
                 if self.region_attn_mode == 'mix_mul':
-                    dot = att * att_h.unsqueeze(1) # element-wise multiplication attn.
+                    dot = att * att_h.view(num_feats, group, 1, self.att_hid_size) # element-wise multiplication attn.
                 else:
-                    dot = att + att_h.unsqueeze(1)  # batch * att_size * att_hid_size
+                    dot = att + att_h.view(num_feats, group, 1, self.att_hid_size)  # num_feats * group * att_size * att_hid_size
             else:
                 dot = torch.cat((xt.unsqueeze(1), att_feats), 2)
 
-            dot = F.tanh(dot)                              # batch * att_size * att_hid_size
+            dot = F.tanh(dot)                              # num_feats * group * att_size * att_hid_size
             dot = dot.view(-1, self.att_hid_size)               # (batch * att_size) * att_hid_size
             # dot = F.dropout(dot, 0.3, training=self.training)
             hAflat = self.alpha_net(dot)                           # (batch * att_size) * 1
         else:
             # print('Dot-product region attention!')
-            assert(att.size(2) == att_h.size(1))
-            hAflat = torch.matmul(att, att_h.view(batch_size, self.att_hid_size, 1))
+            assert(att.size(3) == att_h.size(1))
+            hAflat = torch.matmul(att_h.view(num_feats, group, self.att_hid_size), \
+                att.view(num_feats, att_size, self.att_hid_size).transpose(1, 2)) # num_feats * group * att_size
 
-        hAflat = hAflat.view(-1, att_size)                        # batch * att_size
-        hAflat.masked_fill_(att_mask, self.min_value)
+        hAflat = hAflat.contiguous().view(-1, att_size)                        # batch * att_size
+        hAflat.view(att_mask.size(0), -1, att_size).masked_fill_(att_mask.unsqueeze(1), self.min_value)
         frm_masked_hAflat = hAflat.clone()
 
         weight = F.softmax(hAflat, dim=1)                             # batch * att_size
-        frm_masked_hAflat.masked_fill_(pnt_mask, self.min_value)
+        frm_masked_hAflat.view(pnt_mask.size(0), -1, att_size).masked_fill_(pnt_mask.unsqueeze(1), self.min_value)
 
-        att_feats_ = att_feats.view(-1, att_size, self.rnn_size) # batch * att_size * att_feat_size
-        att_res = torch.bmm(weight.unsqueeze(1), att_feats_).squeeze(1) # batch * att_feat_size
+        att_feats_ = att_feats.view(num_feats, att_size, self.rnn_size) # num_feats * att_size * att_feat_size
+        att_res = torch.bmm(weight.view(num_feats, group, att_size), att_feats_) # num_feats * group * att_feat_size
+        att_res = att_res.view(batch_size, self.rnn_size)
 
         return att_res, frm_masked_hAflat, att_h
 
@@ -134,6 +145,8 @@ class TopDownCore(nn.Module):
     def forward(self, xt, fc_feats, conv_feats, p_conv_feats, pool_feats, p_pool_feats, att_mask, pnt_mask, state, sim_mat_static_update):
         # att_mask is for attention , pnt_mask cound be for either attention or grounding
         # pnt_mask is frm_mask during training and is att_mask during inference
+        # fc_feats and xt have a row per sequence, the attention feats and masks can have a row per
+        # group of sequences (see Attention)
         
         att_lstm_input = torch.cat([fc_feats, xt], 1)
         h_att, c_att = self.att_lstm(att_lstm_input, (state[0][0], state[1][0]))
@@ -141,8 +154,8 @@ class TopDownCore(nn.Module):
             att = self.attention(h_att, conv_feats, p_conv_feats)
         att2, att2_weight, att_h = self.attention2(h_att, pool_feats, p_pool_feats, att_mask[:,1:], pnt_mask[:,1:])
 
-        max_grd_val = att2.new(pool_feats.size(0), 1).fill_(0) # dummy
-        grd_val = att2.new(pool_feats.size(0), 1).fill_(0)
+        max_grd_val = att2.new(h_att.size(0), 1).fill_(0) # dummy
+        grd_val = att2.new(h_att.size(0), 1).fill_(0)
 
         if self.att_input_mode == 'both':
             lang_lstm_input = torch.cat([att+att2, h_att], 1)
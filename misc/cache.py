@@ -0,0 +1,322 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import fcntl
+import hashlib
+import multiprocessing
+import shutil
+import threading
+import numpy as np
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+class CacheStats(object):
+    """Hit/miss counters shared between the main process and the DataLoader workers.
+
+    The counters live in shared memory, so they must be created before the workers are
+    started (i.e. in the dataset constructor) and can then be read from the main process.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.hits = multiprocessing.Value('l', 0)
+        self.misses = multiprocessing.Value('l', 0)
+        self.evictions = multiprocessing.Value('l', 0)
+
+    def hit(self):
+        with self.hits.get_lock():
+            self.hits.value += 1
+
+    def miss(self):
+        with self.misses.get_lock():
+            self.misses.value += 1
+
+    def evict(self, n=1):
+        with self.evictions.get_lock():
+            self.evictions.value += n
+
+    def reset(self):
+        for v in (self.hits, self.misses, self.evictions):
+            with v.get_lock():
+                v.value = 0
+
+    def hit_rate(self):
+        total = self.hits.value + self.misses.value
+        return self.hits.value*1./total if total > 0 else 0.
+
+    def summary(self):
+        return '{}: {} hits, {} misses, {} evictions (hit rate {:.1f}%)'.format(self.name, \
+            self.hits.value, self.misses.value, self.evictions.value, self.hit_rate()*100)
+
+
+def _nbytes(value):
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    elif isinstance(value, (tuple, list)):
+        return sum(_nbytes(v) for v in value)
+    elif isinstance(value, dict):
+        return sum(_nbytes(v) for v in value.values())
+    elif hasattr(value, 'nbytes'): # e.g., QuantizedRows
+        return value.nbytes
+    elif hasattr(value, 'element_size'): # torch tensors
+        return value.numel()*value.element_size()
+    return 0
+
+
+class LRUCache(object):
+    """In-process LRU cache of numpy arrays or tensors (or tuples/dicts of them) with a byte budget.
+
+    Each DataLoader worker holds its own copy. Note that the workers are re-created every
+    epoch, so the content only survives within an epoch; use a DirectoryCache on a tmpfs
+    (e.g. /dev/shm) to share entries across workers and epochs.
+    """
+    def __init__(self, max_bytes, stats=None):
+        self.max_bytes = max_bytes
+        self.stats = stats
+        self.used_bytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock() # the prefetch threads share the cache
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.used_bytes = 0
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.pop(key, None)
+            if value is not None:
+                self._entries[key] = value # move to the most recently used end
+        if self.stats is not None:
+            if value is not None:
+                self.stats.hit()
+            else:
+                self.stats.miss()
+        return value
+
+    def put(self, key, value):
+        nbytes = _nbytes(value)
+        if nbytes > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self.used_bytes -= _nbytes(self._entries.pop(key))
+            while self._entries and self.used_bytes + nbytes > self.max_bytes:
+                _, old_value = self._entries.popitem(last=False)
+                self.used_bytes -= _nbytes(old_value)
+                if self.stats is not None:
+                    self.stats.evict()
+            self._entries[key] = value
+            self.used_bytes += nbytes
+
+
+class DirectoryCache(object):
+    """Cache of dicts of numpy arrays stored as .npz files in a directory, shared by all the
+    processes that point to the same directory.
+
+    Files are placed atomically (write to a temporary file, then rename), hits refresh the
+    file mtime and the least recently used files are evicted once max_bytes is exceeded.
+    The bytes used are kept in a file of the directory and updated under a file lock, so the
+    budget holds across all the processes, e.g., the loaders of several splits or jobs.
+    Put the directory on a tmpfs such as /dev/shm to get a cross-worker shared-memory cache.
+    """
+    suffix = '.npz'
+    used_bytes_file = '.used_bytes' # also the lock file
+
+    def __init__(self, root, max_bytes, stats=None, compress=False):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.stats = stats
+        self.compress = compress
+        if not os.path.isdir(root):
+            os.makedirs(root)
+        with self._locked() as fd:
+            self._write_used_bytes(fd, sum(s for _, s, _ in self._scan()))
+
+    def _path(self, key):
+        return os.path.join(self.root, key+self.suffix)
+
+    def _scan(self):
+        # (path, size, mtime) of the cached files
+        entries = []
+        for fname in os.listdir(self.root):
+            if fname.startswith('.') or not fname.endswith(self.suffix) or fname.endswith(('.tmp', '.part')):
+                continue
+            path = os.path.join(self.root, fname)
+            try:
+                st = os.stat(path)
+            except OSError: # evicted by another process in the meantime
+                continue
+            entries.append((path, st.st_size, st.st_mtime))
+        return entries
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with np.load(path) as f:
+                value = {k:f[k] for k in f.files}
+            os.utime(path, None) # mark as recently used
+        except (IOError, OSError, ValueError): # missing, or evicted while reading
+            if self.stats is not None:
+                self.stats.miss()
+            return None
+        if self.stats is not None:
+            self.stats.hit()
+        return value
+
+    def put(self, key, value):
+        path = self._path(key)
+        if os.path.isfile(path):
+            return
+        tmp_path = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.current_thread().ident)
+        with open(tmp_path, 'wb') as f:
+            if self.compress:
+                np.savez_compressed(f, **value)
+            else:
+                np.savez(f, **value)
+        self._place(tmp_path, path)
+
+    def _place(self, tmp_path, path):
+        # move a fully written temporary file into the cache, False if it exceeds the budget
+        nbytes = os.path.getsize(tmp_path)
+        if nbytes > self.max_bytes:
+            os.remove(tmp_path)
+            return False
+        with self._locked() as fd:
+            # another process may have placed the same file already, only count the difference
+            try:
+                replaced = os.path.getsize(path)
+            except OSError:
+                replaced = 0
+            os.rename(tmp_path, path) # atomic within the same filesystem
+            used = self._read_used_bytes(fd) + nbytes - replaced
+            if used > self.max_bytes:
+                used = self._evict()
+            self._write_used_bytes(fd, used)
+        return True
+
+    @contextmanager
+    def _locked(self):
+        # exclusive lock of the directory between all the processes (and threads), yields the
+        # descriptor of the file with the bytes used
+        fd = os.open(os.path.join(self.root, self.used_bytes_file), os.O_RDWR | os.O_CREAT)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield fd
+        finally:
+            os.close(fd) # releases the lock
+
+    def _read_used_bytes(self, fd):
+        os.lseek(fd, 0, os.SEEK_SET)
+        data = os.read(fd, 32)
+        return int(data) if data else 0
+
+    def _write_used_bytes(self, fd, used):
+        os.lseek(fd, 0, os.SEEK_SET)
+        os.ftruncate(fd, 0)
+        os.write(fd, str(used).encode('utf-8'))
+
+    def _evict(self):
+        # re-scan to correct for files changed outside the cache, then drop the least recently used
+        # files until we are 10% under the budget
+        entries = sorted(self._scan(), key=lambda x:x[2])
+        used = sum(s for _, s, _ in entries)
+        num_evicted = 0
+        for path, size, _ in entries:
+            if used <= 0.9*self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            used -= size
+            num_evicted += 1
+        if self.stats is not None and num_evicted > 0:
+            self.stats.evict(num_evicted)
+        return used
+
+
+class TieredFileCache(DirectoryCache):
+    """Read-through cache of whole files from a slow (e.g. network) filesystem on a local disk.
+
+    The first access to a file copies it into root; later accesses, from any process that
+    points to the same directory, read the local copy. Uses the atomic placement, size cap
+    and mtime-based LRU eviction of DirectoryCache. A file is copied by one process at a time,
+    the others read the slow filesystem meanwhile. A file evicted while it is memory-mapped
+    stays readable until it is closed.
+    """
+    suffix = ''
+
+    def __init__(self, root, max_bytes, stats=None):
+        super(TieredFileCache, self).__init__(root, max_bytes, stats)
+
+    def _path(self, src_path):
+        # flat layout, prefixed by the source directory so equal file names do not collide
+        src_path = os.path.abspath(src_path)
+        prefix = hashlib.sha1(os.path.dirname(src_path).encode('utf-8')).hexdigest()[:12]
+        return os.path.join(self.root, prefix+'_'+os.path.basename(src_path))
+
+    def local_path(self, src_path):
+        """Returns the path of the local copy of src_path, or src_path if it cannot be cached."""
+        path = self._path(src_path)
+        try:
+            os.utime(path, None) # mark as recently used
+            if self.stats is not None:
+                self.stats.hit()
+            return path
+        except OSError: # not cached yet, or evicted
+            pass
+        if self.stats is not None:
+            self.stats.miss()
+        # claim the copy with a lock on <path>.part, the others read src_path until it lands (the
+        # lock of a process that died is released, so its claim is taken over)
+        part_path = path+'.part'
+        try:
+            claim = os.open(part_path, os.O_WRONLY | os.O_CREAT)
+        except OSError:
+            return src_path
+        try:
+            fcntl.flock(claim, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError): # being copied by another process or thread
+            os.close(claim)
+            return src_path
+        tmp_path = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.current_thread().ident)
+        try:
+            if os.path.isfile(path): # placed by the previous holder of the claim
+                return path
+            shutil.copyfile(src_path, tmp_path)
+            if self._place(tmp_path, path):
+                return path
+        except (IOError, OSError): # e.g., the local disk is full
+            if os.path.isfile(tmp_path):
+                os.remove(tmp_path)
+        finally:
+            try:
+                if os.stat(part_path).st_ino == os.fstat(claim).st_ino: # not a newer claim
+                    os.remove(part_path)
+            except OSError:
+                pass
+            os.close(claim)
+        return src_path
+
+    def load(self, src_path, mmap_mode=None):
+        """np.load through the cache."""
+        try:
+            return np.load(self.local_path(src_path), mmap_mode=mmap_mode)
+        except (IOError, OSError): # evicted between the copy and the open
+            return np.load(src_path, mmap_mode=mmap_mode)
@@ -0,0 +1,224 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import os
+import numpy as np
+
+
+def get_det_word(gt_bboxs, caption, bbox_ann, wtod):
+    # get the present category.
+    pcats = []
+    for i in range(gt_bboxs.shape[0]):
+        pcats.append(gt_bboxs[i,6])
+    # get the orginial form of the caption.
+    indicator = []
+
+    indicator.append([(0, 0, 0)]*len(caption)) # category class, binary class, fine-grain class.
+    for i, bbox in enumerate(bbox_ann):
+        # if the bbox_idx is not filtered out.
+        if bbox['bbox_idx'] in pcats:
+            w_idx = bbox['idx']
+            ng = bbox['clss']
+            bn = (ng != caption[w_idx]) + 1
+            fg = bbox['label']
+            indicator[0][w_idx] = (wtod[bbox['clss']], bn, fg)
+
+    return indicator
+
+
+def build_segment_annotation(caption, seq_length, test_mode, dtoi, wtod, wtoi, vocab_size):
+    """Turns the caption annotation of a segment into the caption sequence
+    (ncap x seq_length x 5, see below) and the gt boxes (num_box x 8: x1, y1, x2, y2,
+    frm_idx, label, bbox_idx, word idx).
+
+    Nothing in here is random, so it can be computed once by prepro/prepare_samples.py.
+    """
+    captions = [caption] # one per segment
+
+    bbox_ann = []
+    bbox_idx = 0
+    for caption in captions:
+        for i, clss in enumerate(caption['clss']):
+            for j, cls in enumerate(clss): # one box might have multiple labels
+                # we don't care about the boxes outside the length limit.
+                # after all our goal is referring, not detection
+                if caption['idx'][i][j] < seq_length:
+                    if test_mode:
+                        # dummy bbox and frm_idx for the hidden testing split
+                        bbox_ann.append({'bbox':[0, 0, 0, 0], 'label': dtoi[cls], 'clss': cls,
+                            'bbox_idx':bbox_idx, 'idx':caption['idx'][i][j], 'frm_idx':-1})
+                    else:
+                        bbox_ann.append({'bbox':caption['bbox'][i], 'label': dtoi[cls], 'clss': cls,
+                            'bbox_idx':bbox_idx, 'idx':caption['idx'][i][j], 'frm_idx':caption['frm_idx'][i]})
+
+                    bbox_idx += 1
+
+    # (optional) sort the box based on idx
+    bbox_ann = sorted(bbox_ann, key=lambda x:x['idx'])
+
+    gt_bboxs = np.zeros((len(bbox_ann), 8), dtype=np.float32)
+    for i, bbox in enumerate(bbox_ann):
+        gt_bboxs[i, :4] = bbox['bbox']
+        gt_bboxs[i, 4] = bbox['frm_idx']
+        gt_bboxs[i, 5] = bbox['label']
+        gt_bboxs[i, 6] = bbox['bbox_idx']
+        gt_bboxs[i, 7] = bbox['idx']
+
+    if not test_mode: # skip this in test mode
+        gt_x = (gt_bboxs[:,2]-gt_bboxs[:,0]+1)
+        gt_y = (gt_bboxs[:,3]-gt_bboxs[:,1]+1)
+        gt_area_nonzero = (((gt_x != 1) & (gt_y != 1)))
+        gt_bboxs = gt_bboxs[gt_area_nonzero]
+
+    # given the bbox_ann, and caption, this function determine which word belongs to the detection.
+    det_indicator = get_det_word(gt_bboxs, captions[0]['caption'], bbox_ann, wtod)
+    # fetch the captions
+    ncap = len(captions) # number of captions available for this image
+    assert ncap > 0, 'an image does not have any label. this can be handled but right now isn\'t'
+
+    # convert caption into sequence label.
+    cap_seq = np.zeros([ncap, seq_length, 5], dtype=np.int64)
+    for i, caption in enumerate(captions):
+        j = 0
+        while j < len(caption['caption']) and j < seq_length:
+            if det_indicator[i][j][0] != 0:
+                cap_seq[i,j,0] = det_indicator[i][j][0] + vocab_size
+                cap_seq[i,j,1] = det_indicator[i][j][1]
+                cap_seq[i,j,2] = det_indicator[i][j][2]
+                cap_seq[i,j,3] = wtoi[caption['caption'][j]]
+                cap_seq[i,j,4] = wtoi[caption['caption'][j]]
+            else:
+                cap_seq[i,j,0] = wtoi[caption['caption'][j]]
+                cap_seq[i,j,4] = wtoi[caption['caption'][j]]
+            j += 1
+
+    return cap_seq, gt_bboxs
+
+
+class MetadataCatalog(object):
+    """Per-segment metadata of the dataset in flat numpy arrays, indexed like info['videos'].
+
+    Replaces the nested info/caption/raw caption dicts: numpy arrays carry no per-element
+    reference counts, so the pages stay shared with the forked DataLoader workers. Use
+    get_catalog() to build it once per process for all the splits. The gt boxes of all the
+    segments are concatenated, segment ix owns the rows gt_box_offsets[ix]:gt_box_offsets[ix+1].
+    """
+    fields = ('seg_ids', 'splits', 'num_seg_in_video', 'has_annotation', 'cap_seq', 'gt_boxes',
+              'gt_box_offsets', 'timestamps', 'durations')
+
+    def __init__(self, arrays, seq_length, test_mode):
+        for name in self.fields:
+            setattr(self, name, arrays[name])
+        self.seq_length = seq_length
+        self.test_mode = test_mode
+        self.caption_lengths = np.count_nonzero(self.cap_seq[:, :, 4], axis=1)
+        self._order = np.argsort(self.seg_ids)
+
+    @classmethod
+    def build(cls, info, caption_file, raw_caption_file, seq_length, test_mode):
+        itow = info['ix_to_word']
+        wtoi = {w:i for i,w in itow.items()}
+        wtod = {w:i+1 for w,i in info['wtod'].items()} # word to detection
+        dtoi = wtod # detection to index
+        vocab_size = len(itow) + 1 # since it start from 1
+
+        num_segs = len(info['videos'])
+        seg_ids = [seg['id'] for seg in info['videos']]
+        vid_ids = [seg_id.split('_segment_')[0] for seg_id in seg_ids]
+        num_seg_per_vid = {}
+        for seg_id, vid_id in zip(seg_ids, vid_ids):
+            num_seg_per_vid[vid_id] = max(num_seg_per_vid.get(vid_id, 0), int(seg_id.split('_segment_')[1])+1)
+
+        arrays = {'seg_ids':np.array(seg_ids), 'splits':np.array([seg['split'] for seg in info['videos']]),
+                  'num_seg_in_video':np.array([num_seg_per_vid[vid_id] for vid_id in vid_ids], dtype=np.int64),
+                  'has_annotation':np.zeros(num_segs, dtype=bool),
+                  'cap_seq':np.zeros((num_segs, seq_length, 5), dtype=np.int64),
+                  'gt_box_offsets':np.zeros(num_segs+1, dtype=np.int64),
+                  'timestamps':np.zeros((num_segs, 2)), 'durations':np.zeros(num_segs)}
+        gt_boxes = [np.zeros((0, 8), dtype=np.float32)]
+        for ix, (seg_id, vid_id) in enumerate(zip(seg_ids, vid_ids)):
+            seg_idx = str(int(seg_id.split('_segment_')[1]))
+            num_box = 0
+            if vid_id in caption_file and seg_idx in caption_file[vid_id]['segments'] and vid_id in raw_caption_file:
+                seg_cap_seq, seg_gt_boxes = build_segment_annotation(caption_file[vid_id]['segments'][seg_idx],
+                    seq_length, test_mode, dtoi, wtod, wtoi, vocab_size)
+                arrays['cap_seq'][ix] = seg_cap_seq[0]
+                gt_boxes.append(seg_gt_boxes)
+                num_box = seg_gt_boxes.shape[0]
+                arrays['timestamps'][ix] = raw_caption_file[vid_id]['timestamps'][int(seg_idx)]
+                arrays['durations'][ix] = raw_caption_file[vid_id]['duration']
+                arrays['has_annotation'][ix] = True
+            arrays['gt_box_offsets'][ix+1] = arrays['gt_box_offsets'][ix] + num_box
+        arrays['gt_boxes'] = np.concatenate(gt_boxes)
+        return cls(arrays, seq_length, test_mode)
+
+    def save(self, root):
+        if not os.path.isdir(root):
+            os.makedirs(root)
+        for name in self.fields:
+            np.save(os.path.join(root, name+'.npy'), getattr(self, name))
+        # write the meta data last so that a partially written directory is never picked up
+        with open(os.path.join(root, 'meta.json'), 'w') as f:
+            json.dump({'seq_length':self.seq_length, 'test_mode':self.test_mode}, f)
+
+    @classmethod
+    def load(cls, root):
+        with open(os.path.join(root, 'meta.json')) as f:
+            meta = json.load(f)
+        arrays = {name:np.load(os.path.join(root, name+'.npy'), mmap_mode='r') for name in cls.fields}
+        return cls(arrays, meta['seq_length'], meta['test_mode'])
+
+    def __len__(self):
+        return len(self.seg_ids)
+
+    def index(self, seg_id):
+        pos = np.searchsorted(self.seg_ids, seg_id, sorter=self._order)
+        ix = self._order[min(pos, len(self._order)-1)]
+        if self.seg_ids[ix] != seg_id:
+            raise KeyError(seg_id)
+        return ix
+
+    def annotation(self, ix):
+        # cap_seq (1 x seq_length x 5), gt_bboxs (num_box x 8), timestamps, duration
+        if not self.has_annotation[ix]:
+            raise KeyError('no caption annotation for segment {}'.format(self.seg_ids[ix]))
+        return self.cap_seq[ix:ix+1], self.gt_boxes[self.gt_box_offsets[ix]:self.gt_box_offsets[ix+1]], \
+            self.timestamps[ix], self.durations[ix]
+
+
+_catalogs = {}
+
+def get_catalog(input_dic, input_json, input_raw_cap, seq_length, test_mode, prepared_root=''):
+    """MetadataCatalog of the segments in input_dic, built from the caption json files (or
+    loaded from the prepro/prepare_samples.py output in prepared_root) once per process.
+    The vocabulary of input_dic is kept in catalog.vocab.
+    """
+    key = (input_dic, input_json, input_raw_cap, seq_length, test_mode, prepared_root)
+    if key not in _catalogs:
+        print('DataLoader loading json file: ', input_dic)
+        info = json.load(open(input_dic))
+        if prepared_root:
+            print('DataLoader loading prepared samples: ', prepared_root)
+            catalog = MetadataCatalog.load(prepared_root)
+            assert catalog.seq_length == seq_length and catalog.test_mode == test_mode, \
+                'prepared samples were built with a different seq_length/test_mode'
+            assert np.array_equal(catalog.seg_ids, np.array([seg['id'] for seg in info['videos']])), \
+                'prepared samples do not match the input_dic'
+        else:
+            print('DataLoader loading json file: ', input_json)
+            caption_file = json.load(open(input_json))
+            print('DataLoader loading json file: ', input_raw_cap)
+            raw_caption_file = json.load(open(input_raw_cap))
+            catalog = MetadataCatalog.build(info, caption_file, raw_caption_file, seq_length, test_mode)
+        catalog.vocab = {k:info[k] for k in ('ix_to_word', 'wtod', 'wtol')}
+        _catalogs[key] = catalog
+    return _catalogs[key]
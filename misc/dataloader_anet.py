@@ -10,6 +10,7 @@ from __future__ import division
 from __future__ import print_function
 
 import json
+import hashlib
 import h5py
 import os
 import numpy as np
@@ -18,10 +19,14 @@ from torchvision.datasets.folder import default_loader
 import torch
 import torch.utils.data as data
 import copy
-from PIL import Image
 import torchvision.transforms as transforms
 import torchtext.vocab as vocab # use this to load glove vector
-from collections import defaultdict
+from misc.feature_store import RegionFeatureShards, FeatureManifest, copy_rows, get_proposal_store, \
+    load_seg_feature
+from misc.cache import CacheStats, LRUCache, DirectoryCache, TieredFileCache
+from misc.catalog import get_catalog
+from misc.sample_shards import iter_shard
+from misc.prefetch import PrefetchStats, LookaheadPrefetcher
 
 class DataLoader(data.Dataset):
     def __init__(self, opt, split='training', seq_per_img=5):
@@ -35,6 +40,45 @@ class DataLoader(data.Dataset):
         self.vis_attn = opt.vis_attn
         self.feature_root = opt.feature_root
         self.seg_feature_root = opt.seg_feature_root
+        # dtype of the feature buffers handed to the model, cast to float when copied to the GPU
+        self.feat_dtype = np.float16 if opt.feat_half else np.float32
+        # local copies of the feature files (or shards) read from slow, e.g. network, storage
+        self.file_cache = None
+        if opt.local_cache_dir:
+            self.file_cache = TieredFileCache(opt.local_cache_dir, int(opt.local_cache_gb*1024**3),
+                CacheStats('local feature file cache ({})'.format(split)))
+        if opt.region_feat_shards:
+            print('DataLoader loading region feature shards: ', opt.region_feat_shards)
+            self.region_store = RegionFeatureShards(opt.region_feat_shards, self.file_cache)
+        else:
+            self.region_store = None
+        self.feature_manifest = None
+        if opt.feature_manifest:
+            print('DataLoader loading feature manifest: ', opt.feature_manifest)
+            feature_manifest = FeatureManifest(opt.feature_manifest)
+            if opt.manifest_check and feature_manifest.is_stale(self.feature_root, self.seg_feature_root):
+                print('feature manifest is stale, checking the feature files instead')
+            else:
+                self.feature_manifest = feature_manifest
+
+        # the frame-wise features are per video and shared by all its segments
+        self.seg_feat_cache = None
+        self.seg_feat_dir_cache = None
+        if opt.seg_feat_cache_mb > 0:
+            self.seg_feat_cache = LRUCache(opt.seg_feat_cache_mb*1024**2,
+                CacheStats('frame-wise feature cache ({})'.format(split)))
+        if opt.seg_feat_cache_dir:
+            self.seg_feat_dir_cache = DirectoryCache(opt.seg_feat_cache_dir, opt.seg_feat_cache_dir_mb*1024**2,
+                CacheStats('shared frame-wise feature cache ({})'.format(split)))
+
+        # lookahead reads on a thread pool within each worker, see plan_prefetch()
+        self.prefetch_depth = opt.prefetch_depth
+        self.prefetch_stats = PrefetchStats('prefetcher ({})'.format(split)) if opt.prefetch_depth > 0 else None
+        self.prefetch_schedule = None
+        self.worker_id, self.num_workers = 0, 1
+        self.prefetcher = None
+        self._prefetcher_plan, self._prefetcher_pid = None, None
+
         self.num_sampled_frm = opt.num_sampled_frm
         self.num_prop_per_frm = opt.num_prop_per_frm
         self.exclude_bgd_det = opt.exclude_bgd_det
@@ -43,17 +87,31 @@ class DataLoader(data.Dataset):
         self.test_mode = opt.test_mode
         self.max_gt_box = 100
         self.max_proposal = self.num_sampled_frm * self.num_prop_per_frm
-        self.glove = vocab.GloVe(name='6B', dim=300)
-
-        # load the json file which contains additional information about the dataset
-        print('DataLoader loading json file: ', opt.input_dic)
-        self.info = json.load(open(self.opt.input_dic))
-        self.itow = self.info['ix_to_word']
+        self.packed_proposals = opt.packed_proposals
+        self.dedup_video_feats = opt.dedup_video_feats
+
+        # the deterministic proposal part of the samples (see build_regions), shared across
+        # workers and epochs; the entries depend on the settings below, hence the subdirectory (the
+        # annotations are not part of the entries, the frame masks are built per sample)
+        self.sample_cache = None
+        if opt.sample_cache_dir:
+            # ('frm_idx': the entries keep the frame indices, not the frame masks of earlier versions)
+            key = hashlib.sha1(json.dumps(['frm_idx', self.max_proposal, self.max_gt_box, self.prop_thresh,
+                self.exclude_bgd_det, self.packed_proposals, np.dtype(self.feat_dtype).name, self.att_feat_size,
+                opt.proposal_h5, opt.region_feat_shards or self.feature_root]).encode('utf-8')).hexdigest()[:12]
+            self.sample_cache = DirectoryCache(os.path.join(opt.sample_cache_dir, key), opt.sample_cache_mb*1024**2,
+                CacheStats('sample cache ({})'.format(split)), compress=opt.sample_cache_compress)
+
+        # vocabulary and per-segment metadata (captions, gt boxes, segment boundaries), shared
+        # by the loaders of all the splits
+        self.catalog = get_catalog(opt.input_dic, opt.input_json, opt.input_raw_cap, self.seq_length,
+            self.test_mode, opt.prepared_samples)
+        self.itow = self.catalog.vocab['ix_to_word']
         self.wtoi = {w:i for i,w in self.itow.items()}
-        self.wtod = {w:i+1 for w,i in self.info['wtod'].items()} # word to detection
+        self.wtod = {w:i+1 for w,i in self.catalog.vocab['wtod'].items()} # word to detection
         self.dtoi = self.wtod # detection to index
         self.itod = {i:w for w,i in self.dtoi.items()}
-        self.wtol = self.info['wtol']
+        self.wtol = self.catalog.vocab['wtol']
         self.ltow = {l:w for w,l in self.wtol.items()}
         self.vocab_size = len(self.itow) + 1 # since it start from 1
         print('vocab size is ', self.vocab_size)
@@ -68,102 +126,180 @@ class DataLoader(data.Dataset):
 
         # for VG classes
         self.vg_cls = classes
-        self.glove_vg_cls = np.zeros((len(classes), 300))
-        for i, w in enumerate(classes):
-                split_word = w.replace(',', ' ').split(' ')
-                vector = []
-                for word in split_word:
-                    if word in self.glove.stoi:
-                        vector.append(self.glove.vectors[self.glove.stoi[word]].numpy())
-                    else: # use a random vector instead
-                        vector.append(2*np.random.rand(300) - 1)
-
-                avg_vector = np.zeros((300))
-                for v in vector:
-                    avg_vector += v
-
-                self.glove_vg_cls[i] = avg_vector/len(vector)
-
-        # open the caption json file
-        print('DataLoader loading json file: ', opt.input_json)
-        self.caption_file = json.load(open(self.opt.input_json))
-
-        # open the caption json file with segment boundaries
-        print('DataLoader loading json file: ', opt.input_raw_cap)
-        self.raw_caption_file = json.load(open(opt.input_raw_cap))
-
-        # open the detection json file.
-        print('DataLoader loading proposal file: ', opt.proposal_h5)
-        h5_proposal_file = h5py.File(self.opt.proposal_h5, 'r', driver='core')
-        self.num_proposals = h5_proposal_file['dets_num'][:]
-        self.label_proposals = h5_proposal_file['dets_labels'][:]
-        h5_proposal_file.close()
+        self.glove_vg_cls, self.glove_clss, self.glove_w = self.load_glove_tables(opt.glove_cache_dir)
+
+        self.detect_size = len(self.itod)
+        self.load_split(split)
+
+    def load_split(self, split):
+        # proposals and the segments of the split
+        # open the detection file, the proposals are read per segment and shared by all the loaders
+        print('DataLoader loading proposal file: ', self.opt.proposal_h5)
+        self.proposal_store = get_proposal_store(self.opt.proposal_h5, self.opt.proposal_labels_npy)
+        self.num_proposals = self.proposal_store.num_proposals
+
+        # separate out indexes for each of the provided splits
+        self.split_ix = []
+        for ix in np.nonzero(self.catalog.splits == split)[0]:
+            seg_id = str(self.catalog.seg_ids[ix])
+            vid_id = seg_id.split('_segment_')[0]
+            # all the feature files must exist
+            if self.has_region_feature(seg_id) and self.has_seg_feature(vid_id):
+                if self.opt.vis_attn:
+                    if random.random() < 0.001: # randomly sample 0.1% segments to visualize
+                        self.split_ix.append(ix)
+                else:
+                    self.split_ix.append(ix)
+        self.split_ix = np.array(self.split_ix, dtype=np.int64)
+        print('assigned %d segments to split %s' %(len(self.split_ix), split))
+
+    def build_glove_tables(self):
+        # loads the full GloVe vocabulary (400k vectors), only kept alive while building the tables
+        glove = vocab.GloVe(name='6B', dim=300)
+
+        glove_vg_cls = np.zeros((len(self.vg_cls), 300))
+        for i, w in enumerate(self.vg_cls):
+            split_word = w.replace(',', ' ').split(' ')
+            vector = []
+            for word in split_word:
+                if word in glove.stoi:
+                    vector.append(glove.vectors[glove.stoi[word]].numpy())
+                else: # use a random vector instead
+                    vector.append(2*np.random.rand(300) - 1)
+
+            avg_vector = np.zeros((300))
+            for v in vector:
+                avg_vector += v
+
+            glove_vg_cls[i] = avg_vector/len(vector)
 
         # category id to labels. +1 becuase 0 is the background label.
-        self.glove_clss = np.zeros((len(self.itod)+1, 300))
-        self.glove_clss[0] = 2*np.random.rand(300) - 1 # background
+        glove_clss = np.zeros((len(self.itod)+1, 300))
+        glove_clss[0] = 2*np.random.rand(300) - 1 # background
         for i, word in enumerate(self.itod.values()):
-        	if word in self.glove.stoi:
-        		vector = self.glove.vectors[self.glove.stoi[word]]
-        	else: # use a random vector instead
-        		vector = 2*np.random.rand(300) - 1
-        	self.glove_clss[i+1] = vector        	
+            if word in glove.stoi:
+                vector = glove.vectors[glove.stoi[word]]
+            else: # use a random vector instead
+                vector = 2*np.random.rand(300) - 1
+            glove_clss[i+1] = vector
 
-        self.glove_w = np.zeros((len(self.wtoi)+1, 300))
+        glove_w = np.zeros((len(self.wtoi)+1, 300))
         for i, word in enumerate(self.wtoi.keys()):
             vector = np.zeros((300))
             count = 0
             for w in word.split(' '):
                 count += 1
-                if w in self.glove.stoi:
-                    glove_vector = self.glove.vectors[self.glove.stoi[w]]
+                if w in glove.stoi:
+                    glove_vector = glove.vectors[glove.stoi[w]]
                     vector += glove_vector.numpy()
                 else: # use a random vector instead
                     random_vector = 2*np.random.rand(300) - 1
                     vector += random_vector
-            self.glove_w[i+1] = vector / count            
-
-        self.detect_size = len(self.itod)
-
-        # separate out indexes for each of the provided splits
-        self.split_ix = []
-        self.num_seg_per_vid = defaultdict(list)
-        for ix in range(len(self.info['videos'])):
-            seg = self.info['videos'][ix]
-            seg_id = seg['id']
-            vid_id, seg_idx = seg_id.split('_segment_')
-            self.num_seg_per_vid[vid_id].append(int(seg_idx))
-            if seg['split'] == split:
-                # all the feature files must exist
-                if os.path.isfile(os.path.join(self.feature_root, seg_id+'.npy')) and \
-                    os.path.isfile(os.path.join(self.seg_feature_root, vid_id[2:]+'_bn.npy')):
-                    if opt.vis_attn:
-                        if random.random() < 0.001: # randomly sample 0.1% segments to visualize
-                            self.split_ix.append(ix)
-                    else:
-                        self.split_ix.append(ix)
-        print('assigned %d segments to split %s' %(len(self.split_ix), split))
-
-    def get_det_word(self, gt_bboxs, caption, bbox_ann):
-        
-        # get the present category.
-        pcats = []
-        for i in range(gt_bboxs.shape[0]):
-            pcats.append(gt_bboxs[i,6])
-        # get the orginial form of the caption.
-        indicator = []
-
-        indicator.append([(0, 0, 0)]*len(caption)) # category class, binary class, fine-grain class.
-        for i, bbox in enumerate(bbox_ann):
-            # if the bbox_idx is not filtered out.
-            if bbox['bbox_idx'] in pcats:
-                w_idx = bbox['idx']
-                ng = bbox['clss']
-                bn = (ng != caption[w_idx]) + 1
-                fg = bbox['label']
-                indicator[0][w_idx] = (self.wtod[bbox['clss']], bn, fg)
-
-        return indicator
+            glove_w[i+1] = vector / count
+
+        return glove_vg_cls, glove_clss, glove_w
+
+    def load_glove_tables(self, cache_dir):
+        # the tables only depend on the vocabularies (and their order), cache them keyed by a hash
+        # so that later runs and the second (val) DataLoader skip loading GloVe entirely
+        if not cache_dir:
+            return self.build_glove_tables()
+
+        key = hashlib.sha1(json.dumps(['glove.6B.300d', self.vg_cls, list(self.itod.values()), \
+            list(self.wtoi.keys())]).encode('utf-8')).hexdigest()
+        cache_file = os.path.join(cache_dir, 'glove_tables_{}.npz'.format(key))
+        if os.path.isfile(cache_file):
+            print('DataLoader loading cached glove tables: ', cache_file)
+            with np.load(cache_file) as f:
+                return f['glove_vg_cls'], f['glove_clss'], f['glove_w']
+
+        glove_vg_cls, glove_clss, glove_w = self.build_glove_tables()
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        tmp_file = '{}.{}.tmp'.format(cache_file, os.getpid())
+        with open(tmp_file, 'wb') as f:
+            np.savez(f, glove_vg_cls=glove_vg_cls, glove_clss=glove_clss, glove_w=glove_w)
+        os.rename(tmp_file, cache_file)
+        print('DataLoader wrote glove tables to ', cache_file)
+        return glove_vg_cls, glove_clss, glove_w
+
+    def has_region_feature(self, seg_id):
+        if self.region_store is not None:
+            return seg_id in self.region_store
+        if self.feature_manifest is not None:
+            return self.feature_manifest.has_region(seg_id)
+        return os.path.isfile(os.path.join(self.feature_root, seg_id+'.npy'))
+
+    def has_seg_feature(self, vid_id):
+        if self.feature_manifest is not None:
+            return self.feature_manifest.has_frame(vid_id[2:]+'_bn')
+        return os.path.isfile(os.path.join(self.seg_feature_root, vid_id[2:]+'_bn.npy'))
+
+    def load_region_feature(self, seg_id):
+        # num_proposal x feat_dim
+        if self.region_store is not None:
+            return self.region_store[seg_id] # memmap slice, copied into the padded buffer below
+        path = os.path.join(self.feature_root, seg_id+'.npy')
+        region_feature = self.file_cache.load(path) if self.file_cache is not None else np.load(path)
+        return region_feature.reshape(-1, region_feature.shape[2])
+
+    def load_seg_feature(self, vid_id):
+        # the returned array may be shared with the cache, do not modify it in place
+        if self.seg_feat_cache is not None:
+            cached = self.seg_feat_cache.get(vid_id)
+            if cached is not None:
+                return cached
+
+        cached = None
+        if self.seg_feat_dir_cache is not None:
+            cached = self.seg_feat_dir_cache.get(vid_id)
+        if cached is not None:
+            seg_feature, num_frm = cached['seg_feature'].astype(self.feat_dtype, copy=False), int(cached['num_frm'])
+        else:
+            seg_feature, num_frm = load_seg_feature(self.seg_feature_root, vid_id, self.t_attn_size, self.feat_dtype,
+                self.file_cache)
+            if self.seg_feat_dir_cache is not None:
+                self.seg_feat_dir_cache.put(vid_id, {'seg_feature':seg_feature, 'num_frm':np.array(num_frm)})
+
+        if self.seg_feat_cache is not None:
+            self.seg_feat_cache.put(vid_id, (seg_feature, num_frm))
+        return seg_feature, num_frm
+
+    def sample_lengths(self):
+        # (caption length, number of proposals) of every sample, the two sizes a batch is padded to
+        lengths = np.zeros((len(self.split_ix), 2), dtype=np.int64)
+        lengths[:, 0] = self.catalog.caption_lengths[self.split_ix]
+        if self.packed_proposals:
+            # the unmasked proposals only, this reads all the proposals once
+            for i, ix in enumerate(self.split_ix):
+                lengths[i, 1] = np.count_nonzero(~self.get_pnt_mask(self.proposal_store[ix][:self.max_proposal]))
+        else:
+            lengths[:, 1] = np.minimum(self.num_proposals[self.split_ix], self.max_proposal)
+        return lengths
+
+    def sample_blocks(self, videos_per_block=1):
+        # sample indices grouped into runs of videos_per_block consecutive videos, in the sorted
+        # seg_id order of the feature files and of the packed shards (prepro/pack_region_feats.py)
+        seg_ids = self.catalog.seg_ids[self.split_ix]
+        order = np.argsort(seg_ids, kind='mergesort')
+        vid_ids = np.array([str(seg_ids[i]).split('_segment_')[0] for i in order])
+        new_vid = np.concatenate(([True], vid_ids[1:] != vid_ids[:-1])) if len(order) > 0 else np.zeros(0, dtype=bool)
+        block_ids = (np.cumsum(new_vid)-1) // videos_per_block
+        return np.split(order, np.nonzero(np.diff(block_ids))[0]+1) if len(order) > 0 else []
+
+    def cache_stats(self):
+        # CacheStats/PrefetchStats of the enabled caches and prefetcher, the counters are shared with the workers
+        stats = [c.stats for c in (self.file_cache, self.seg_feat_cache, self.seg_feat_dir_cache, self.sample_cache) if c is not None]
+        if self.prefetch_stats is not None:
+            stats.append(self.prefetch_stats)
+        return stats
+
+    def get_pnt_mask(self, proposals):
+        # proposal mask to filter out low-confidence proposals or backgrounds
+        pnt_mask = (proposals[:, 6] <= self.prop_thresh)
+        if self.exclude_bgd_det:
+            pnt_mask |= (proposals[:, 5] == 0)
+        return pnt_mask
 
     def get_frm_mask(self, proposals, gt_bboxs):
         # proposals: num_pps
@@ -172,107 +308,102 @@ class DataLoader(data.Dataset):
         num_box = gt_bboxs.shape[0]
         return (np.tile(proposals.reshape(-1,1), (1,num_box)) != np.tile(gt_bboxs, (num_pps,1)))
 
-    def __getitem__(self, index):
-
-        ix = self.split_ix[index]
-
-        seg_id = self.info['videos'][ix]['id']
-        vid_id_ix, seg_id_ix = seg_id.split('_segment_')
-        seg_id_ix = str(int(seg_id_ix))
-
-        # load the proposal file
-        num_proposal = int(self.num_proposals[ix])
-        proposals = copy.deepcopy(self.label_proposals[ix])
-        proposals = proposals[:num_proposal,:]
+    def load_sample(self, ix):
+        # everything a sample is built from, read from the proposal, feature and annotation files
+        seg_id = str(self.catalog.seg_ids[ix])
+        vid_id = seg_id.split('_segment_')[0]
+
+        # caption sequence and gt boxes, timestamps are not accurate, with minor misalignments
+        cap_seq, gt_bboxs, timestamps, dur = self.catalog.annotation(ix)
+
+        regions = None
+        if self.sample_cache is not None:
+            regions = self.sample_cache.get(seg_id)
+        if regions is None:
+            # load the proposal file
+            proposals = self.proposal_store[ix]
+            num_proposal = proposals.shape[0]
+
+            # no need to resize proposal nor GT box since they are all based on images with 720px in width)
+            region_feature = self.load_region_feature(seg_id)
+            assert(num_proposal == region_feature.shape[0])
+            regions = self.build_regions(proposals, region_feature)
+            if self.sample_cache is not None:
+                self.sample_cache.put(seg_id, regions)
 
-        # no need to resize proposal nor GT box since they are all based on images with 720px in width)
-        region_feature = np.load(os.path.join(self.feature_root, seg_id+'.npy'))
-        region_feature = region_feature.reshape(-1, region_feature.shape[2]).copy()
-        assert(num_proposal == region_feature.shape[0])
+        # load the frame-wise segment feature
+        seg_feature, num_frm = self.load_seg_feature(vid_id)
+        return seg_id, regions, seg_feature, num_frm, cap_seq, gt_bboxs, timestamps, dur
+
+    def read_sample(self, index):
+        # load_sample(), run on the prefetch threads
+        return self.load_sample(self.split_ix[index])
+
+    def plan_prefetch(self, batches, num_workers):
+        # called in the main process before the workers start: the DataLoader hands the
+        # batches out round-robin, so worker w gets batches w, w+num_workers, ...
+        self.prefetch_schedule = batches
+        self.num_workers = max(num_workers, 1)
+
+    def init_worker(self, worker_id):
+        # worker_init_fn of the torch DataLoader
+        self.worker_id = worker_id
+
+    def get_prefetcher(self):
+        # one prefetcher (and thread pool) per worker process and epoch plan
+        schedule = self.prefetch_schedule
+        if self.prefetcher is None or self._prefetcher_plan is not schedule or self._prefetcher_pid != os.getpid():
+            if self.prefetcher is not None and self._prefetcher_pid == os.getpid():
+                self.prefetcher.close()
+            indices = [i for batch in schedule[self.worker_id::self.num_workers] for i in batch]
+            self.prefetcher = LookaheadPrefetcher(self.read_sample, indices, self.prefetch_depth,
+                self.opt.prefetch_mb*1024**2, self.opt.prefetch_threads, self.prefetch_stats)
+            self._prefetcher_plan, self._prefetcher_pid = schedule, os.getpid()
+        return self.prefetcher
 
-        # proposal mask to filter out low-confidence proposals or backgrounds
-        pnt_mask = (proposals[:, 6] <= self.prop_thresh)
-        if self.exclude_bgd_det:
-            pnt_mask |= (proposals[:, 5] == 0)
+    def __getitem__(self, index):
+        if self.prefetch_depth > 0 and self.prefetch_schedule is not None:
+            return self.build_sample(*self.get_prefetcher().get(index))
+        return self.build_sample(*self.load_sample(self.split_ix[index]))
+
+    def build_regions(self, proposals, region_feature):
+        # the deterministic, unpadded proposal arrays of a sample: proposals (zeroed where masked),
+        # proposal mask, region features, frame indices and, with packed proposals, ppl_slots
+        pnt_mask = self.get_pnt_mask(proposals)
+        num_pps = min(proposals.shape[0], self.max_proposal)
+        ppl_slots = None
+        if self.packed_proposals:
+            # keep the unmasked proposals only, ppl_slots are their positions in the fixed
+            # num_sampled_frm x num_prop_per_frm layout
+            ppl_slots = np.nonzero(~pnt_mask[:self.max_proposal])[0]
+            proposals, pnt_mask, num_pps = proposals[ppl_slots], pnt_mask[ppl_slots], len(ppl_slots)
+        pnt_mask = pnt_mask[:num_pps]
+
+        regions = {'proposals':np.array(proposals[:num_pps], dtype=np.float32), 'pnt_mask':pnt_mask.astype(np.uint8),
+                   'region_feature':np.empty((num_pps, self.att_feat_size), dtype=self.feat_dtype)}
+        copy_rows(regions['region_feature'], region_feature, ppl_slots) # dequantized from int8 shards
+        regions['frm_idx'] = regions['proposals'][:, 4].copy()
+        # zero out the masked proposals (after taking their frame index for the frame mask)
+        regions['proposals'][pnt_mask] = 0.
+        regions['region_feature'][pnt_mask] = 0.
+        if ppl_slots is not None:
+            regions['ppl_slots'] = ppl_slots
+        return regions
+
+    def build_sample(self, seg_id, regions, seg_feature, num_frm, cap_seq, gt_bboxs, timestamps, dur):
+        # the inputs may be shared with the caches, do not modify them in place
+        seg_id_ix = int(seg_id.split('_segment_')[1])
+        num_pps = regions['proposals'].shape[0]
+        num_rows = num_pps if self.packed_proposals else self.max_proposal
 
-        # load the frame-wise segment feature
-        seg_rgb_feature = np.load(os.path.join(self.seg_feature_root, vid_id_ix[2:]+'_resnet.npy'))
-        seg_motion_feature = np.load(os.path.join(self.seg_feature_root, vid_id_ix[2:]+'_bn.npy'))
-        seg_feature_raw = np.concatenate((seg_rgb_feature, seg_motion_feature), axis=1)
-
-        # not accurate, with minor misalignments
-        timestamps = self.raw_caption_file[vid_id_ix]['timestamps'][int(seg_id_ix)]
-        dur = self.raw_caption_file[vid_id_ix]['duration']
-        num_frm = seg_feature_raw.shape[0]
         sample_idx = np.array([np.round(num_frm*timestamps[0]*1./dur), np.round(num_frm*timestamps[1]*1./dur)])
         sample_idx = np.clip(np.round(sample_idx), 0, self.t_attn_size).astype(int)
-        seg_feature = np.zeros((self.t_attn_size, seg_feature_raw.shape[1]))
-        seg_feature[:min(self.t_attn_size, num_frm)] = seg_feature_raw[:self.t_attn_size]
-
-        captions = [copy.deepcopy(self.caption_file[vid_id_ix]['segments'][seg_id_ix])] # one per segment
-        assert len(captions) == 1,  'Only support one caption per segment for now!'
-
-        bbox_ann = []
-        bbox_idx = 0
-        for caption in captions:
-            for i, clss in enumerate(caption['clss']):
-                for j, cls in enumerate(clss): # one box might have multiple labels
-                    # we don't care about the boxes outside the length limit.
-                    # after all our goal is referring, not detection
-                    if caption['idx'][i][j] < self.seq_length:
-                        if self.test_mode:
-                            # dummy bbox and frm_idx for the hidden testing split
-                            bbox_ann.append({'bbox':[0, 0, 0, 0], 'label': self.dtoi[cls], 'clss': cls,
-                                'bbox_idx':bbox_idx, 'idx':caption['idx'][i][j], 'frm_idx':-1})
-                        else:
-                            bbox_ann.append({'bbox':caption['bbox'][i], 'label': self.dtoi[cls], 'clss': cls,
-                                'bbox_idx':bbox_idx, 'idx':caption['idx'][i][j], 'frm_idx':caption['frm_idx'][i]})
-
-                        bbox_idx += 1
-
-        # (optional) sort the box based on idx
-        bbox_ann = sorted(bbox_ann, key=lambda x:x['idx'])
-
-        gt_bboxs = np.zeros((len(bbox_ann), 8))
-        for i, bbox in enumerate(bbox_ann):
-            gt_bboxs[i, :4] = bbox['bbox']
-            gt_bboxs[i, 4] = bbox['frm_idx']
-            gt_bboxs[i, 5] = bbox['label']
-            gt_bboxs[i, 6] = bbox['bbox_idx']
-            gt_bboxs[i, 7] = bbox['idx']
-
-        if not self.test_mode: # skip this in test mode
-            gt_x = (gt_bboxs[:,2]-gt_bboxs[:,0]+1)
-            gt_y = (gt_bboxs[:,3]-gt_bboxs[:,1]+1)
-            gt_area_nonzero = (((gt_x != 1) & (gt_y != 1)))
-            gt_bboxs = gt_bboxs[gt_area_nonzero]
-
-        # given the bbox_ann, and caption, this function determine which word belongs to the detection.
-        det_indicator = self.get_det_word(gt_bboxs, captions[0]['caption'], bbox_ann)
-        # fetch the captions
-        ncap = len(captions) # number of captions available for this image
-        assert ncap > 0, 'an image does not have any label. this can be handled but right now isn\'t'
-
-        # convert caption into sequence label.
-        cap_seq = np.zeros([ncap, self.seq_length, 5])
-        for i, caption in enumerate(captions):
-            j = 0
-            while j < len(caption['caption']) and j < self.seq_length:
-                is_det = False
-                if det_indicator[i][j][0] != 0:
-                    cap_seq[i,j,0] = det_indicator[i][j][0] + self.vocab_size
-                    cap_seq[i,j,1] = det_indicator[i][j][1]
-                    cap_seq[i,j,2] = det_indicator[i][j][2]
-                    cap_seq[i,j,3] = self.wtoi[caption['caption'][j]]
-                    cap_seq[i,j,4] = self.wtoi[caption['caption'][j]]
-                else:
-                    cap_seq[i,j,0] = self.wtoi[caption['caption'][j]]
-                    cap_seq[i,j,4] = self.wtoi[caption['caption'][j]]
-                j += 1
+
+        ncap = cap_seq.shape[0] # number of captions available for this image
 
         # get the mask of the ground truth bounding box. The data shape is 
         # num_caption x num_box x num_seq
-        box_mask = np.ones((len(captions), gt_bboxs.shape[0], self.seq_length))
+        box_mask = np.ones((ncap, gt_bboxs.shape[0], self.seq_length), dtype=np.uint8)
         for i in range(gt_bboxs.shape[0]):
             box_mask[0, i, int(gt_bboxs[i][7])] = 0
 
@@ -280,8 +411,8 @@ class DataLoader(data.Dataset):
 
         # get the batch version of the seq and box_mask.
         if ncap < self.seq_per_img:
-            seq_batch = np.zeros([self.seq_per_img, self.seq_length, 4])
-            mask_batch = np.zeros([self.seq_per_img, gt_bboxs.shape[0], self.seq_length])
+            seq_batch = np.zeros([self.seq_per_img, self.seq_length, 4], dtype=np.int64)
+            mask_batch = np.zeros([self.seq_per_img, gt_bboxs.shape[0], self.seq_length], dtype=np.uint8)
             # we need to subsample (with replacement)
             for q in range(self.seq_per_img):
                 ixl = random.randint(0,ncap)
@@ -292,67 +423,158 @@ class DataLoader(data.Dataset):
             seq_batch = cap_seq[ixl:ixl+self.seq_per_img,:,:4]
             mask_batch = box_mask[ixl:ixl+self.seq_per_img]
 
-        input_seq = np.zeros([self.seq_per_img, self.seq_length+1, 4])
+        input_seq = np.zeros([self.seq_per_img, self.seq_length+1, 4], dtype=np.int64)
         input_seq[:,1:] = seq_batch
 
-        gt_seq = np.zeros([10, self.seq_length])
+        gt_seq = np.zeros([10, self.seq_length], dtype=np.int64)
         gt_seq[:ncap,:] = cap_seq[:,:,4]
 
-        # load the image for visualization purposes
+        # the frames for visualization are decoded in the main process, only those that are drawn
         if self.vis_attn:
-            seg_show = np.zeros((self.num_sampled_frm, 1280, 720, 3))
-            seg_dim_info = torch.LongTensor(2)
-            for i in range(self.num_sampled_frm):
-                try:
-                    img = Image.open(os.path.join(self.opt.image_path, seg_id, str(i+1).zfill(2)+'.jpg')).convert('RGB')
-                    width, height = img.size
-                    seg_show[i, :height, :width] = np.array(img)
-                    seg_dim_info[0] = height
-                    seg_dim_info[1] = width
-                except:
-                    print('cannot load image...')
-                    break
-            seg_show = torch.from_numpy(seg_show).type(torch.ByteTensor)
-
-        # padding the proposals and gt_bboxs
-        pad_proposals = np.zeros((self.max_proposal, 7))
-        pad_pnt_mask = np.ones((self.max_proposal))
-        pad_gt_bboxs = np.zeros((self.max_gt_box, 6))
-        pad_box_mask = np.ones((self.seq_per_img, self.max_gt_box, self.seq_length+1))
-        pad_region_feature = np.zeros((self.max_proposal, self.att_feat_size))
-        pad_frm_mask = np.ones((self.max_proposal, self.max_gt_box)) # mask out proposals outside the target frames
+            frame_dir = os.path.join(self.opt.image_path, seg_id)
+
+        # padding the proposals and gt_bboxs, allocated in their final dtype and filled in place
+        pad_gt_bboxs = np.zeros((self.max_gt_box, 6), dtype=np.float32)
+        pad_box_mask = np.ones((self.seq_per_img, self.max_gt_box, self.seq_length+1), dtype=np.uint8)
+        pad_frm_mask = np.ones((num_rows, self.max_gt_box), dtype=np.uint8) # mask out proposals outside the target frames
 
         num_box = min(gt_bboxs.shape[0], self.max_gt_box)
-        num_pps = min(proposals.shape[0], self.max_proposal)
-        pad_proposals[:num_pps] = proposals[:num_pps]
-        pad_pnt_mask[:num_pps] = pnt_mask[:num_pps]
         pad_gt_bboxs[:num_box] = gt_bboxs[:num_box]
         pad_box_mask[:,:num_box,1:] = mask_batch[:,:num_box,:]
-        pad_region_feature[:num_pps] = region_feature[:num_pps]
-
-        frm_mask = self.get_frm_mask(pad_proposals[:num_pps, 4], pad_gt_bboxs[:num_box, 4])
-        pad_frm_mask[:num_pps, :num_box] = frm_mask
-
-        input_seq = torch.from_numpy(input_seq).long()
-        gt_seq = torch.from_numpy(gt_seq).long()
-        pad_proposals = torch.from_numpy(pad_proposals).float()
-        pad_pnt_mask = torch.from_numpy(pad_pnt_mask).byte()
-        pad_gt_bboxs = torch.from_numpy(pad_gt_bboxs).float()
-        pad_box_mask = torch.from_numpy(pad_box_mask).byte()
-        pad_region_feature = torch.from_numpy(pad_region_feature).float()
-        pad_proposals.masked_fill_(pad_pnt_mask.view(-1, 1), 0.)
-        pad_region_feature.masked_fill_(pad_pnt_mask.view(-1, 1), 0.)
-        pad_frm_mask = torch.from_numpy(pad_frm_mask).byte()
-        num = torch.FloatTensor([ncap, num_pps, num_box, int(seg_id_ix),
-            max(self.num_seg_per_vid[vid_id_ix])+1, timestamps[0]*1./dur,
+        pad_frm_mask[:num_pps, :num_box] = self.get_frm_mask(regions['frm_idx'], gt_bboxs[:num_box, 4])
+        if num_pps == num_rows:
+            # nothing to pad, the region arrays are not shared (built or read from the cache per sample)
+            pad_proposals, pad_pnt_mask, pad_region_feature = regions['proposals'], regions['pnt_mask'], \
+                regions['region_feature']
+        else:
+            pad_proposals = np.zeros((num_rows, 7), dtype=np.float32)
+            pad_pnt_mask = np.ones((num_rows), dtype=np.uint8)
+            pad_region_feature = np.zeros((num_rows, self.att_feat_size), dtype=self.feat_dtype)
+            pad_proposals[:num_pps] = regions['proposals']
+            pad_pnt_mask[:num_pps] = regions['pnt_mask']
+            pad_region_feature[:num_pps] = regions['region_feature']
+
+        # zero-copy, the buffers already have their final dtype
+        input_seq = torch.from_numpy(input_seq)
+        gt_seq = torch.from_numpy(gt_seq)
+        pad_proposals = torch.from_numpy(pad_proposals)
+        pad_pnt_mask = torch.from_numpy(pad_pnt_mask)
+        pad_gt_bboxs = torch.from_numpy(pad_gt_bboxs)
+        pad_box_mask = torch.from_numpy(pad_box_mask)
+        pad_region_feature = torch.from_numpy(pad_region_feature)
+        pad_frm_mask = torch.from_numpy(pad_frm_mask)
+        num = torch.FloatTensor([ncap, num_pps, num_box, seg_id_ix,
+            self.catalog.num_seg_in_video[self.catalog.index(seg_id)], timestamps[0]*1./dur,
             timestamps[1]*1./dur]) # 3 + 4 (seg_id, num_of_seg_in_video, seg_start_time, seg_end_time)
         sample_idx = torch.from_numpy(sample_idx).long()
 
         if self.vis_attn:
-            return seg_feature, input_seq, gt_seq, num, pad_proposals, pad_gt_bboxs, pad_box_mask, seg_id, seg_show, seg_dim_info, pad_region_feature, pad_frm_mask, sample_idx, pad_pnt_mask
+            sample = seg_feature, input_seq, gt_seq, num, pad_proposals, pad_gt_bboxs, pad_box_mask, seg_id, frame_dir, pad_region_feature, pad_frm_mask, sample_idx, pad_pnt_mask
         else:
-            return seg_feature, input_seq, gt_seq, num, pad_proposals, pad_gt_bboxs, pad_box_mask, seg_id, pad_region_feature, pad_frm_mask, sample_idx, pad_pnt_mask
-
+            sample = seg_feature, input_seq, gt_seq, num, pad_proposals, pad_gt_bboxs, pad_box_mask, seg_id, pad_region_feature, pad_frm_mask, sample_idx, pad_pnt_mask
+        if self.packed_proposals:
+            sample += (torch.from_numpy(regions['ppl_slots']),)
+        return sample
+
+    def collate(self, batch):
+        # collate_fn of the torch DataLoader: packed proposal sets are padded to the largest one
+        # of the batch (proposals, region features, frame/proposal masks and ppl_slots)
+        if self.packed_proposals:
+            num_rows = max(max(len(sample[-1]) for sample in batch), 1)
+            batch = [list(sample) for sample in batch]
+            for sample in batch:
+                for i, fill in ((4, 0), (-5, 0), (-4, 1), (-2, 1), (-1, self.max_proposal)):
+                    x = sample[i]
+                    sample[i] = x.new_full((num_rows,)+tuple(x.shape[1:]), fill)
+                    sample[i][:len(x)] = x
+        if not self.dedup_video_feats:
+            return data.dataloader.default_collate(batch)
+
+        # the frame-wise features only depend on the video, ship them once per video of the batch
+        # followed by the video index of every segment, appended to the batch
+        vid_index = {}
+        vid_idx = [vid_index.setdefault(sample[7].split('_segment_')[0], len(vid_index)) for sample in batch]
+        seg_features = [None]*len(vid_index)
+        for sample, i in zip(batch, vid_idx):
+            if seg_features[i] is None:
+                seg_features[i] = sample[0]
+        collated = data.dataloader.default_collate([sample[1:] for sample in batch])
+        return [data.dataloader.default_collate(seg_features)] + list(collated) + [torch.LongTensor(vid_idx)]
 
     def __len__(self):
         return len(self.split_ix)
+
+
+class StreamingDataLoader(DataLoader, getattr(data, 'IterableDataset', object)):
+    """Iterable variant of DataLoader reading the tar shards of prepro/write_sample_shards.py
+    front to back (PyTorch 1.2+).
+
+    Every epoch the shard order is shuffled (the same way on all ranks), the shards are split
+    over the ranks and then over the DataLoader workers, and the records of each worker pass
+    through a shuffle buffer. Call set_epoch() before each epoch to get a new order. The
+    number of shards should be a multiple of world_size*num_workers to keep them all busy.
+    """
+    def __init__(self, opt, split='training', seq_per_img=5, rank=0, world_size=1):
+        assert hasattr(data, 'IterableDataset'), 'streaming from sample shards requires PyTorch 1.2+'
+        self.rank = rank
+        self.world_size = world_size
+        self.epoch = 0
+        self.shuffle_buffer = opt.shard_shuffle_buffer
+        super(StreamingDataLoader, self).__init__(opt, split, seq_per_img)
+
+    def load_split(self, split):
+        self.shard_root = os.path.join(self.opt.sample_shards, split)
+        print('DataLoader loading sample shards: ', self.shard_root)
+        with open(os.path.join(self.shard_root, 'index.json')) as f:
+            index = json.load(f)
+        assert index['seq_length'] == self.seq_length and index['test_mode'] == self.test_mode \
+            and index['t_attn_size'] == self.t_attn_size, \
+            'sample shards were built with a different seq_length/test_mode/t_attn_size'
+        self.shards = index['shards'] # [file, num_samples]
+        self.num_samples = sum(n for _, n in self.shards)
+        print('assigned %d segments (%d shards) to split %s' %(self.num_samples, len(self.shards), split))
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __len__(self):
+        # exact for a single rank, approximate otherwise
+        return self.num_samples // self.world_size
+
+    def __getitem__(self, index):
+        raise NotImplementedError('sample shards can only be read sequentially')
+
+    def sample_lengths(self):
+        raise NotImplementedError('sample shards can only be read sequentially')
+
+    def __iter__(self):
+        order = np.random.RandomState(self.opt.seed+self.epoch).permutation(len(self.shards))
+        shards = [self.shards[i][0] for i in order[self.rank::self.world_size]]
+        worker_info = data.get_worker_info()
+        worker_id = 0
+        if worker_info is not None:
+            worker_id = worker_info.id
+            shards = shards[worker_id::worker_info.num_workers]
+        rng = random.Random(((self.opt.seed*1000+self.epoch)*1000+self.rank)*1000+worker_id)
+
+        def records():
+            for shard in shards:
+                for record in iter_shard(os.path.join(self.shard_root, shard)):
+                    yield record
+
+        buffer = []
+        for record in records():
+            if len(buffer) < self.shuffle_buffer:
+                buffer.append(record)
+                continue
+            j = rng.randrange(len(buffer))
+            buffer[j], record = record, buffer[j]
+            yield self.build_record(*record)
+        rng.shuffle(buffer)
+        for record in buffer:
+            yield self.build_record(*record)
+
+    def build_record(self, meta, arrays):
+        regions = self.build_regions(arrays['proposals'], arrays['region_feature'])
+        return self.build_sample(meta['seg_id'], regions, arrays['seg_feature'].astype(self.feat_dtype, copy=False),
+            meta['num_frm'], arrays['cap_seq'], arrays['gt_bboxs'], meta['timestamps'], meta['duration'])
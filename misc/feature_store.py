@@ -0,0 +1,212 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import os
+import h5py
+import numpy as np
+
+
+class QuantizedRows(object):
+    """int8 region feature rows with per-channel scales, dequantized by copy_rows()."""
+    def __init__(self, rows, scale):
+        self.rows = rows # num_rows x feat_dim int8
+        self.scale = scale # feat_dim float32
+
+    @property
+    def shape(self):
+        return self.rows.shape
+
+    @property
+    def nbytes(self):
+        return self.rows.nbytes + self.scale.nbytes
+
+    def __len__(self):
+        return len(self.rows)
+
+    def load(self):
+        # read memory-mapped rows in
+        return QuantizedRows(np.array(self.rows), np.array(self.scale))
+
+
+def copy_rows(out, rows, index=None):
+    # copy the first len(out) rows (or the rows at index) into out, dequantizing int8 rows
+    # without an intermediate
+    if index is None:
+        index = slice(0, len(out))
+    if isinstance(rows, QuantizedRows):
+        np.multiply(rows.rows[index], rows.scale, out=out, casting='unsafe')
+    else:
+        out[...] = rows[index]
+
+
+class RegionFeatureShards(object):
+    """Read-only view over region features packed by prepro/pack_region_feats.py.
+
+    Every segment is stored as a contiguous block of rows (num_frm*num_prop x feat_dim)
+    inside one of a few large .npy shards. Shards are memory-mapped lazily so that each
+    DataLoader worker only pays for the pages it actually touches. Shards packed with
+    --dtype int8 come with per-segment, per-channel scales (scales.npy) and are returned
+    as QuantizedRows. With a file_cache (misc.cache.TieredFileCache), the shards are
+    memory-mapped from local copies.
+    """
+    def __init__(self, root, file_cache=None):
+        self.root = root
+        self.file_cache = file_cache
+        with open(os.path.join(root, 'index.json')) as f:
+            index = json.load(f)
+        self.feat_dim = index['feat_dim']
+        self.dtype = np.dtype(index['dtype'])
+        self.shard_files = index['shards']
+        self.segments = index['segments'] # seg_id -> [shard_idx, row_start, num_rows(, scale_row)]
+        self.quantized = self.dtype == np.int8
+        self._scales = None
+        self._shards = {}
+
+    def __contains__(self, seg_id):
+        return seg_id in self.segments
+
+    def __len__(self):
+        return len(self.segments)
+
+    def _load(self, fname):
+        path = os.path.join(self.root, fname)
+        if self.file_cache is not None:
+            return self.file_cache.load(path, mmap_mode='r')
+        return np.load(path, mmap_mode='r')
+
+    def _shard(self, shard_idx):
+        if shard_idx not in self._shards:
+            self._shards[shard_idx] = self._load(self.shard_files[shard_idx])
+        return self._shards[shard_idx]
+
+    def __getitem__(self, seg_id):
+        # zero-copy, the rows are only read when the slice is consumed
+        entry = self.segments[seg_id]
+        shard_idx, row_start, num_rows = entry[:3]
+        rows = self._shard(shard_idx)[row_start:row_start+num_rows]
+        if self.quantized:
+            if self._scales is None:
+                self._scales = self._load('scales.npy')
+            return QuantizedRows(rows, self._scales[entry[3]])
+        return rows
+
+
+class ProposalStore(object):
+    """Per-segment access to the proposals (dets_labels) of the detection h5 file.
+
+    Only dets_num is read at startup. The labels are either memory-mapped from an .npy
+    export (prepro/export_proposal_labels.py), which shares the page cache between all the
+    loaders and workers, or read per segment from the h5 file. The h5 file is opened lazily
+    in each process (h5py handles do not survive a fork) and read in whole chunks, keeping
+    the last chunk around for the neighbouring segments. Use get_proposal_store() to share
+    one store per file within a process.
+    """
+    def __init__(self, h5_path, labels_npy=''):
+        self.h5_path = h5_path
+        with h5py.File(h5_path, 'r') as f:
+            self.num_proposals = f['dets_num'][:]
+            labels = f['dets_labels']
+            self.shape = labels.shape
+            self.chunk_rows = labels.chunks[0] if labels.chunks is not None else 1
+        self.labels_npy = labels_npy
+        self._labels = None
+        self._h5_pid = None
+        self._chunk = (-1, None) # (first row, rows) of the last chunk read
+
+    def __len__(self):
+        return len(self.num_proposals)
+
+    def _h5_labels(self):
+        if self._h5_pid != os.getpid():
+            self._labels = h5py.File(self.h5_path, 'r')['dets_labels']
+            self._h5_pid = os.getpid()
+        return self._labels
+
+    def _rows(self, ix):
+        if self.labels_npy:
+            if self._labels is None:
+                self._labels = np.load(self.labels_npy, mmap_mode='r')
+                assert self._labels.shape == self.shape, 'proposal labels npy does not match the h5 file'
+            return self._labels[ix]
+        labels = self._h5_labels()
+        if self.chunk_rows == 1:
+            return labels[ix]
+        start = ix - ix % self.chunk_rows
+        chunk_start, chunk = self._chunk
+        if chunk_start != start:
+            chunk = labels[start:start+self.chunk_rows]
+            self._chunk = (start, chunk)
+        return chunk[ix-start]
+
+    def __getitem__(self, ix):
+        # num_proposal x 7, a read-only view for the npy export
+        return self._rows(ix)[:int(self.num_proposals[ix])]
+
+
+_proposal_stores = {}
+
+def get_proposal_store(h5_path, labels_npy=''):
+    key = (os.path.abspath(h5_path), labels_npy)
+    if key not in _proposal_stores:
+        _proposal_stores[key] = ProposalStore(h5_path, labels_npy)
+    return _proposal_stores[key]
+
+
+class FeatureManifest(object):
+    """Availability of the region/frame-wise feature files, recorded by
+    prepro/build_feature_manifest.py so that split construction does not need one
+    os.path.isfile per segment.
+    """
+    def __init__(self, path):
+        with open(path) as f:
+            manifest = json.load(f)
+        self.roots = manifest['roots'] # name -> [path, mtime]
+        self.region = manifest['region'] # seg_id -> [size, mtime]
+        self.frame = manifest['frame'] # file name without .npy -> [size, mtime]
+
+    def has_region(self, seg_id):
+        return seg_id in self.region
+
+    def has_frame(self, name):
+        return name in self.frame
+
+    def is_stale(self, feature_root, seg_feature_root):
+        # cheap check: files added to or removed from a directory change its mtime
+        for name, root in (('feature_root', feature_root), ('seg_feature_root', seg_feature_root)):
+            path, mtime = self.roots[name]
+            if os.path.abspath(root) != path or os.stat(root).st_mtime != mtime:
+                return True
+        return False
+
+
+def load_seg_feature(seg_feature_root, vid_id, t_attn_size, dtype=np.float32, file_cache=None):
+    """Returns the first t_attn_size frames of rgb+motion features (zero padded) and the
+    number of frames in the video.
+
+    Only those rows are used by the model, so the rgb/motion files are memory-mapped and
+    the rows are copied straight into the padded output buffer instead of reading and
+    concatenating the whole video. The buffer is allocated in the output dtype so that no
+    float64 intermediate is created. file_cache (misc.cache.TieredFileCache) maps local
+    copies of the files instead.
+    """
+    load = file_cache.load if file_cache is not None else np.load
+    seg_rgb_feature = load(os.path.join(seg_feature_root, vid_id[2:]+'_resnet.npy'), mmap_mode='r')
+    seg_motion_feature = load(os.path.join(seg_feature_root, vid_id[2:]+'_bn.npy'), mmap_mode='r')
+    assert(seg_rgb_feature.shape[0] == seg_motion_feature.shape[0])
+
+    num_frm = seg_rgb_feature.shape[0]
+    num_used = min(t_attn_size, num_frm)
+    rgb_size = seg_rgb_feature.shape[1]
+    seg_feature = np.zeros((t_attn_size, rgb_size+seg_motion_feature.shape[1]), dtype=dtype)
+    seg_feature[:num_used, :rgb_size] = seg_rgb_feature[:num_used]
+    seg_feature[:num_used, rgb_size:] = seg_motion_feature[:num_used]
+    return seg_feature, num_frm
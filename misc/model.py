@@ -19,8 +19,10 @@ import numpy as np
 import random
 import pdb
 import pickle
+from collections import OrderedDict
 
 import misc.utils as utils
+from misc.cache import CacheStats, LRUCache
 from misc.CaptionModelBU import CaptionModel
 from misc.transformer import Transformer, TransformerDecoder
 
@@ -123,6 +125,7 @@ class AttModel(CaptionModel):
 
         self.logit = nn.Linear(self.rnn_size, self.vocab_size)
 
+        sdpa = False if opt.disable_transformer_sdpa else None # None: when available
         if opt.obj_interact:
             n_layers = 2
             n_heads = 6
@@ -132,7 +135,8 @@ class AttModel(CaptionModel):
                 n_layers=n_layers,
                 n_heads=n_heads,
                 drop_ratio=attn_drop,
-                pe=False)
+                pe=False,
+                sdpa=sdpa)
 
         if self.att_model == 'transformer':
             n_layers = 2
@@ -140,7 +144,8 @@ class AttModel(CaptionModel):
             attn_drop = 0.2
             print('initiailze language decoder transformer...')
             self.cap_model = TransformerDecoder(self.rnn_size, 0, self.vocab_size, \
-                d_hidden = self.rnn_size//2, n_layers=n_layers, n_heads=n_heads, drop_ratio=attn_drop)
+                d_hidden = self.rnn_size//2, n_layers=n_layers, n_heads=n_heads, drop_ratio=attn_drop, \
+                sdpa=sdpa)
 
         if opt.t_attn_mode == 'bilstm': # frame-wise feature encoding
             n_layers = 2
@@ -219,18 +224,28 @@ class AttModel(CaptionModel):
         # for p in self.ctx2pool_grd.parameters(): p.requires_grad=False
         # for p in self.vis_embed[0].parameters(): p.requires_grad=False
 
+        # eval-time cache of the context encoding of the frame-wise features, which only depends
+        # on the video, keyed by (video id, model version); see invalidate_context_cache()
+        self.context_cache = None
+        self.context_version = 0
+        if opt.context_cache_mb > 0:
+            self.context_cache = LRUCache(opt.context_cache_mb*1024**2, CacheStats('context encoding cache'))
+
         if opt.enable_visdom:
             import visdom
             self.vis = visdom.Visdom(server=opt.visdom_server, env='vis-'+opt.id)
 
 
-    def forward(self, segs_feat, seq, gt_seq, num, ppls, gt_boxes, mask_boxes, ppls_feat, frm_mask, sample_idx, pnt_mask, opt, eval_opt = {}):
+    def forward(self, segs_feat, seq, gt_seq, num, ppls, gt_boxes, mask_boxes, ppls_feat, frm_mask, sample_idx, pnt_mask, opt, eval_opt = {}, vid_idx=None):
+        # vid_idx: with --dedup_video_feats, segs_feat holds the unique videos of the batch and
+        # vid_idx maps every segment to its video (see DataLoader.collate)
+        # eval_opt['vid_ids']: video id of every segment, enables the context encoding cache in eval mode
         if opt == 'MLE':
-            return self._forward(segs_feat, seq, gt_seq, ppls, gt_boxes, mask_boxes, num, ppls_feat, frm_mask, sample_idx, pnt_mask)
+            return self._forward(segs_feat, seq, gt_seq, ppls, gt_boxes, mask_boxes, num, ppls_feat, frm_mask, sample_idx, pnt_mask, vid_idx=vid_idx)
         elif opt == 'GRD':
-            return self._forward(segs_feat, seq, gt_seq, ppls, gt_boxes, mask_boxes, num, ppls_feat, frm_mask, sample_idx, pnt_mask, True)
+            return self._forward(segs_feat, seq, gt_seq, ppls, gt_boxes, mask_boxes, num, ppls_feat, frm_mask, sample_idx, pnt_mask, True, eval_opt.get('ppl_slots'), vid_idx, eval_opt.get('vid_ids'))
         elif opt == 'sample':
-            seq, seqLogprobs, att2, sim_mat = self._sample(segs_feat, ppls, num, ppls_feat, sample_idx, pnt_mask, eval_opt)
+            seq, seqLogprobs, att2, sim_mat = self._sample(segs_feat, ppls, num, ppls_feat, sample_idx, pnt_mask, eval_opt, vid_idx)
             return Variable(seq), Variable(att2), Variable(sim_mat)
 
 
@@ -246,66 +261,136 @@ class AttModel(CaptionModel):
         # mask - B, rois_num
         #
         # dot - B, seq_cnt, rois_num
+        #
+        # att_feats (and mask) can also have a row per group of rows of xt, e.g., per segment
+        # with the seq_per_img captions of the segment in consecutive rows of xt
 
         B, S, _ = xt.size()
-        _, R, _ = att_feats.size()
+        N, R, _ = att_feats.size()
+        xt = xt.contiguous().view(N, B//N*S, xt.size(2)) # the steps of a group together
 
         if hasattr(self, 'alpha_net'):
             # Additive attention for grounding
             if self.alpha_net.weight.size(1) == self.att_hid_size:
                 dot = xt.unsqueeze(2) + att_feats.unsqueeze(1)
             else:
-                dot = torch.cat((xt.unsqueeze(2).expand(B, S, R, self.att_hid_size),
-                                 att_feats.unsqueeze(1).expand(B, S, R, self.att_hid_size)), 3)
+                dot = torch.cat((xt.unsqueeze(2).expand(N, xt.size(1), R, self.att_hid_size),
+                                 att_feats.unsqueeze(1).expand(N, xt.size(1), R, self.att_hid_size)), 3)
             dot = F.tanh(dot)
             dot = self.alpha_net(dot).squeeze(-1)
         else:
             # Dot-product attention for grounding
             assert(xt.size(-1) == att_feats.size(-1))
-            dot = torch.matmul(xt, att_feats.permute(0,2,1).contiguous()) # B, seq_cnt, rois_num
+            dot = torch.matmul(xt, att_feats.permute(0,2,1).contiguous()) # N, B//N*seq_cnt, rois_num
+        dot = dot.view(B, S, R)
 
         if bias is not None:
             assert(bias.numel() == dot.numel())
             dot += bias
 
         if mask.dim() == 2:
-            expanded_mask = mask.unsqueeze(1).expand_as(dot)
+            expanded_mask = mask.unsqueeze(1)
         elif mask.dim() == 3: # if expanded already
             expanded_mask = mask
         else:
             raise NotImplementedError
 
-        dot.masked_fill_(expanded_mask, self.min_value)
+        dot.view(mask.size(0), -1, S, R).masked_fill_(expanded_mask.unsqueeze(1), self.min_value)
 
         return dot
 
 
-    def _forward(self, segs_feat, input_seq, gt_seq, ppls, gt_boxes, mask_boxes, num, ppls_feat, frm_mask, sample_idx, pnt_mask, eval_obj_ground=False):
+    def _seg_fc_feats(self, segs_feat, num, vid_idx=None):
+        # mean-pooled frame-wise features of the segments (of their videos) and the segment info
+        fc_feats = torch.mean(segs_feat, dim=1)
+        if vid_idx is not None:
+            fc_feats = fc_feats.index_select(0, vid_idx)
+        return torch.cat((F.layer_norm(fc_feats, [self.fc_feat_size-self.seg_info_size]), \
+                          F.layer_norm(self.seg_info_embed(num[:, 3:7].float()), [self.seg_info_size])), dim=-1)
+
+    def train(self, mode=True):
+        # the weights may change in training mode
+        if mode:
+            self.invalidate_context_cache()
+        return super(AttModel, self).train(mode)
+
+    def load_state_dict(self, state_dict, strict=True):
+        self.invalidate_context_cache()
+        return super(AttModel, self).load_state_dict(state_dict, strict)
+
+    def invalidate_context_cache(self):
+        # call after changing the weights other than through train()/load_state_dict()
+        self.context_version = getattr(self, 'context_version', 0) + 1
+        if getattr(self, 'context_cache', None) is not None:
+            self.context_cache.clear()
+
+    def cache_stats(self):
+        return [self.context_cache.stats] if self.context_cache is not None else []
+
+    def _context(self, segs_feat):
+        # embedding and context encoding of the frame-wise features
+        conv_feats_splits = torch.split(segs_feat, 2048, 2)
+        conv_feats = torch.cat([m(c) for (m,c) in zip(self.att_embed, conv_feats_splits)], dim=2)
+        conv_feats = conv_feats.permute(0,2,1).contiguous() # inconsistency between Torch TempConv and PyTorch Conv1d
+        conv_feats = self.att_embed_aux(conv_feats)
+        conv_feats = conv_feats.permute(0,2,1).contiguous() # inconsistency between Torch TempConv and PyTorch Conv1d
+        return self.context_enc(conv_feats)[0]
+
+    def _cached_context(self, segs_feat, vid_ids, vid_idx=None):
+        # context encodings of the rows of segs_feat from the cache, the missing videos are
+        # encoded together; exact in eval mode, where BatchNorm/dropout do not mix the rows
+        keys = list(vid_ids)
+        if vid_idx is not None: # the rows are the unique videos
+            keys = [None]*segs_feat.size(0)
+            for i, vid_id in zip(vid_idx.tolist(), vid_ids):
+                keys[i] = vid_id
+        rows = [self.context_cache.get((k, self.context_version)) for k in keys]
+        missing = OrderedDict()
+        for i, (k, x) in enumerate(zip(keys, rows)):
+            if x is None:
+                missing.setdefault(k, i)
+        if len(missing) > 0:
+            encoded = self._context(segs_feat.index_select(0, torch.tensor(list(missing.values()),
+                device=segs_feat.device)))
+            encoded = {k:x.clone() for k, x in zip(missing, encoded)} # not views of the batch
+            for k, x in encoded.items():
+                self.context_cache.put((k, self.context_version), x)
+            rows = [x if x is not None else encoded[k] for k, x in zip(keys, rows)]
+        return torch.stack(rows)
+
+    def _encode_context(self, segs_feat, sample_idx, vid_idx=None, vid_ids=None):
+        # the context encoding only depends on the video, so with vid_idx it runs once per
+        # unique video and in eval mode it can be cached; frames outside the segment are zeroed
+        if self.context_cache is not None and vid_ids is not None and not self.training:
+            conv_feats = self._cached_context(segs_feat, vid_ids, vid_idx)
+        else:
+            conv_feats = self._context(segs_feat)
+        if vid_idx is not None:
+            conv_feats = conv_feats.index_select(0, vid_idx)
+
+        batch_size = sample_idx.size(0)
+        sample_idx_mask = conv_feats.new(batch_size, conv_feats.size(1), 1).fill_(1).byte()
+        for i in range(batch_size):
+            sample_idx_mask[i, sample_idx[i,0]:sample_idx[i,1]] = 0
+        return conv_feats.masked_fill(sample_idx_mask, 0)
+
+    def _forward(self, segs_feat, input_seq, gt_seq, ppls, gt_boxes, mask_boxes, num, ppls_feat, frm_mask, sample_idx, pnt_mask, eval_obj_ground=False, ppl_slots=None, vid_idx=None, vid_ids=None):
 
         seq = gt_seq[:, :self.seq_per_img, :].clone().view(-1, gt_seq.size(2)) # choose the first seq_per_img
         seq = torch.cat((Variable(seq.data.new(seq.size(0), 1).fill_(0)), seq), 1)
         input_seq = input_seq.view(-1, input_seq.size(2), input_seq.size(3)) # B*self.seq_per_img, self.seq_length+1, 5
-        input_seq_update = input_seq.data.clone()
 
-        batch_size = segs_feat.size(0) # B
+        batch_size = ppls.size(0) # B
         seq_batch_size = seq.size(0) # B*self.seq_per_img
         rois_num = ppls.size(1) # max_num_proposal of the batch
 
         state = self.init_hidden(seq_batch_size) # self.num_layers, B*self.seq_per_img, self.rnn_size
         rnn_output = []
-        roi_labels = [] # store which proposal match the gt box
         att2_weights = []
         h_att_output = []
         max_grd_output = []
-        frm_mask_output = []
 
-        conv_feats = segs_feat
-        sample_idx_mask = conv_feats.new(batch_size, conv_feats.size(1), 1).fill_(1).byte()
-        for i in range(batch_size):
-            sample_idx_mask[i, sample_idx[i,0]:sample_idx[i,1]] = 0
-        fc_feats = torch.mean(segs_feat, dim=1)
-        fc_feats = torch.cat((F.layer_norm(fc_feats, [self.fc_feat_size-self.seg_info_size]), \
-                              F.layer_norm(self.seg_info_embed(num[:, 3:7].float()), [self.seg_info_size])), dim=-1)
+        fc_feats = self._seg_fc_feats(segs_feat, num, vid_idx)
 
         # pooling the conv_feats
         pool_feats = ppls_feat
@@ -334,9 +419,7 @@ class AttModel(CaptionModel):
 
         # region-class similarity matrix
         sim_mat_static = self._grounder(p_vis_word_embed, g_pool_feats, pnt_mask[:,1:], bias)
-        sim_mat_static_update = sim_mat_static.view(batch_size, 1, self.detect_size+1, rois_num) \
-            .expand(batch_size, self.seq_per_img, self.detect_size+1, rois_num).contiguous() \
-            .view(seq_batch_size, self.detect_size+1, rois_num)
+        sim_mat_static_update = sim_mat_static
         sim_mat_static = F.softmax(sim_mat_static, dim=1)
 
         if self.test_mode:
@@ -363,22 +446,6 @@ class AttModel(CaptionModel):
             pool_feats = torch.cat((F.layer_norm(pool_feats, [pool_feats.size(-1)]), \
                 F.layer_norm(loc_feats, [loc_feats.size(-1)]), F.layer_norm(label_feat, [label_feat.size(-1)])), 2)
 
-        # replicate the feature to map the seq size.
-        fc_feats = fc_feats.view(batch_size, 1, self.fc_feat_size)\
-                .expand(batch_size, self.seq_per_img, self.fc_feat_size)\
-                .contiguous().view(-1, self.fc_feat_size)
-        pool_feats = pool_feats.view(batch_size, 1, rois_num, self.pool_feat_size)\
-                .expand(batch_size, self.seq_per_img, rois_num, self.pool_feat_size)\
-                .contiguous().view(-1, rois_num, self.pool_feat_size)
-        g_pool_feats = g_pool_feats.view(batch_size, 1, rois_num, self.vis_encoding_size) \
-                .expand(batch_size, self.seq_per_img, rois_num, self.vis_encoding_size) \
-                .contiguous().view(-1, rois_num, self.vis_encoding_size)
-        pnt_mask = pnt_mask.view(batch_size, 1, rois_num+1).expand(batch_size, self.seq_per_img, rois_num+1)\
-                .contiguous().view(-1, rois_num+1)
-        overlaps = overlaps.view(batch_size, 1, rois_num, overlaps.size(2)) \
-                .expand(batch_size, self.seq_per_img, rois_num, overlaps.size(2)) \
-                .contiguous().view(-1, rois_num, overlaps.size(2))
-
         # embed fc and att feats
         fc_feats = self.fc_embed(fc_feats)
         pool_feats = self.pool_embed(pool_feats)
@@ -387,21 +454,17 @@ class AttModel(CaptionModel):
         if hasattr(self, 'obj_interact'):
             pool_feats = self.obj_interact(pool_feats)
 
+        # the seq_per_img captions of a segment are in consecutive rows and share the visual features
+        # of the segment (see Attention), only the small fc_feats are replicated
+        fc_feats = fc_feats.view(batch_size, 1, self.rnn_size)\
+                .expand(batch_size, self.seq_per_img, self.rnn_size)\
+                .contiguous().view(-1, self.rnn_size)
+
         # Project the attention feats first to reduce memory and computation comsumptions.
         p_pool_feats = self.ctx2pool(pool_feats) # same here
 
         if self.att_input_mode in ('both', 'featmap'):
-            conv_feats_splits = torch.split(conv_feats, 2048, 2)
-            conv_feats = torch.cat([m(c) for (m,c) in zip(self.att_embed, conv_feats_splits)], dim=2)
-            conv_feats = conv_feats.permute(0,2,1).contiguous() # inconsistency between Torch TempConv and PyTorch Conv1d
-            conv_feats = self.att_embed_aux(conv_feats)
-            conv_feats = conv_feats.permute(0,2,1).contiguous() # inconsistency between Torch TempConv and PyTorch Conv1d
-            conv_feats = self.context_enc(conv_feats)[0]
-
-            conv_feats = conv_feats.masked_fill(sample_idx_mask, 0)
-            conv_feats = conv_feats.view(batch_size, 1, self.t_attn_size, self.rnn_size)\
-                .expand(batch_size, self.seq_per_img, self.t_attn_size, self.rnn_size)\
-                .contiguous().view(-1, self.t_attn_size, self.rnn_size)
+            conv_feats = self._encode_context(segs_feat, sample_idx, vid_idx, vid_ids)
             p_conv_feats = self.ctx2att(conv_feats) # self.rnn_size (1024) -> self.att_hid_size (512)
         else:
             # dummy
@@ -409,6 +472,11 @@ class AttModel(CaptionModel):
             p_conv_feats = pool_feats.new(1,1).fill_(0)
 
         if self.att_model == 'transformer': # Masked Transformer does not support box supervision yet
+            if self.seq_per_img > 1:
+                # a row of features per caption
+                replicate = lambda x: x.unsqueeze(1).expand(x.size(0), self.seq_per_img, *x.size()[1:]) \
+                    .contiguous().view(-1, *x.size()[1:])
+                conv_feats, pool_feats = replicate(conv_feats), replicate(pool_feats)
             if self.att_input_mode == 'both':
                 lm_loss = self.cap_model([conv_feats, pool_feats], seq)
             elif self.att_input_mode == 'featmap':
@@ -418,30 +486,31 @@ class AttModel(CaptionModel):
             return lm_loss.unsqueeze(0), lm_loss.new(1).fill_(0), lm_loss.new(1).fill_(0), \
                 lm_loss.new(1).fill_(0), lm_loss.new(1).fill_(0), lm_loss.new(1).fill_(0)
         elif self.att_model == 'topdown':
-            for i in range(self.seq_length):
-                it = seq[:, i].clone()
-
-                # break if all the sequences end
-                if i >= 1 and seq[:, i].data.sum() == 0:
-                    break
+            # number of steps, up to the first position where all the sequences have ended
+            ended = ((seq.data[:, 1:self.seq_length] != 0).sum(0) == 0).tolist()
+            seq_cnt = ended.index(1)+1 if 1 in ended else self.seq_length
 
+            if not eval_obj_ground:
+                # roi labels (the proposals matching the gt boxes of the target words) and frame masks
+                # of all the steps
+                step_mask_boxes = mask_boxes.data[:, :, :, 1:seq_cnt+1].contiguous().view(seq_batch_size, \
+                    mask_boxes.size(2), seq_cnt)
+                roi_labels = utils.bbox_target(step_mask_boxes, overlaps) # seq_batch_size, seq_cnt, rois_num
+                frm_mask_output = utils.frm_mask_target(step_mask_boxes, frm_mask.data)
+                frm_mask_output = torch.cat((frm_mask_output.new(seq_batch_size, seq_cnt, 1).fill_(0.), \
+                    frm_mask_output), dim=2).view(batch_size, self.seq_per_img, seq_cnt, rois_num+1) \
+                    | pnt_mask.view(batch_size, 1, 1, rois_num+1)
+                frm_mask_output = frm_mask_output.view(seq_batch_size, seq_cnt, rois_num+1)
+
+            for i in range(seq_cnt):
+                it = seq[:, i].clone()
                 xt = self.embed(it)
 
                 if not eval_obj_ground:
-                    roi_label = utils.bbox_target(mask_boxes[:,:,:,i+1], overlaps, input_seq[:,i+1], \
-                        input_seq_update[:,i+1], self.vocab_size) # roi_label if for the target seq
-                    roi_labels.append(roi_label.view(seq_batch_size, -1))
-
                     # use frame mask during training
-                    box_mask = mask_boxes[:,0,:,i+1].contiguous().unsqueeze(1).expand((
-                        batch_size, rois_num, mask_boxes.size(2)))
-                    frm_mask_on_prop = (torch.sum((1 - (box_mask | frm_mask)), dim=2)<=0)
-                    frm_mask_on_prop = torch.cat((frm_mask_on_prop.new(batch_size, 1).fill_(0.), \
-                        frm_mask_on_prop), dim=1) | pnt_mask
                     output, state, att2_weight, att_h, max_grd_val, grd_val = self.core(xt, fc_feats, \
-                        conv_feats, p_conv_feats, pool_feats, p_pool_feats, pnt_mask, frm_mask_on_prop, \
+                        conv_feats, p_conv_feats, pool_feats, p_pool_feats, pnt_mask, frm_mask_output[:, i], \
                         state, sim_mat_static_update)
-                    frm_mask_output.append(frm_mask_on_prop)
                 else:
                     output, state, att2_weight, att_h, max_grd_val, grd_val = self.core(xt, fc_feats, \
                         conv_feats, p_conv_feats, pool_feats, p_pool_feats, pnt_mask, pnt_mask, \
@@ -452,14 +521,10 @@ class AttModel(CaptionModel):
                 rnn_output.append(output)
                 max_grd_output.append(max_grd_val)
 
-            seq_cnt = len(rnn_output)
             rnn_output = torch.cat([_.unsqueeze(1) for _ in rnn_output], 1) # seq_batch_size, seq_cnt, vocab
             h_att_output = torch.cat([_.unsqueeze(1) for _ in h_att_output], 1)
             att2_weights = torch.cat([_.unsqueeze(1) for _ in att2_weights], 1) # seq_batch_size, seq_cnt, att_size
             max_grd_output = torch.cat([_.unsqueeze(1) for _ in max_grd_output], 1)
-            if not eval_obj_ground:
-                frm_mask_output = torch.cat([_.unsqueeze(1) for _ in frm_mask_output], 1)
-                roi_labels = torch.cat([_.unsqueeze(1) for _ in roi_labels], 1)
 
             decoded = F.log_softmax(self.beta * self.logit(rnn_output), dim=2) # text word prob
             decoded  = decoded.view((seq_cnt)*seq_batch_size, -1)
@@ -484,30 +549,31 @@ class AttModel(CaptionModel):
             else:
                 # att2_weights/ground_weights with proposal mask only
                 ground_weights = self._grounder(xt_all, g_pool_feats, pnt_mask[:,1:], bias+att2_weights)
+                if ppl_slots is not None:
+                    # packed proposals, back to the num_sampled_frm x num_prop_per_frm layout
+                    ppl_slots = ppl_slots.view(batch_size, 1, rois_num).expand(batch_size, self.seq_per_img, \
+                        rois_num).contiguous().view(seq_batch_size, rois_num)
+                    num_slots = self.num_sampled_frm*self.num_prop_per_frm
+                    att2_weights = utils.scatter_rois(att2_weights, ppl_slots, num_slots, self.min_value)
+                    ground_weights = utils.scatter_rois(ground_weights, ppl_slots, num_slots, self.min_value)
                 return cls_pred, torch.max(att2_weights.view(seq_batch_size, seq_cnt, self.num_sampled_frm, \
                     self.num_prop_per_frm), dim=-1)[1], torch.max(ground_weights.view(seq_batch_size, \
                     seq_cnt, self.num_sampled_frm, self.num_prop_per_frm), dim=-1)[1]
 
 
-    def _sample(self, segs_feat, ppls, num, ppls_feat, sample_idx, pnt_mask, opt={}):
+    def _sample(self, segs_feat, ppls, num, ppls_feat, sample_idx, pnt_mask, opt={}, vid_idx=None):
         sample_max = opt.get('sample_max', 1)
         beam_size = opt.get('beam_size', 1)
         temperature = opt.get('temperature', 1.0)
         inference_mode = opt.get('inference_mode', True)
 
-        batch_size = segs_feat.size(0)
+        batch_size = ppls.size(0)
         rois_num = ppls.size(1)
 
-        if beam_size > 1:
-            return self._sample_beam(segs_feat, ppls, num, ppls_feat, sample_idx, pnt_mask, opt)
+        if beam_size > 1 and self.att_model == 'topdown':
+            return self._sample_beam(segs_feat, ppls, num, ppls_feat, sample_idx, pnt_mask, opt, vid_idx)
 
-        conv_feats = segs_feat
-        sample_idx_mask = conv_feats.new(batch_size, conv_feats.size(1), 1).fill_(1).byte()
-        for i in range(batch_size):
-            sample_idx_mask[i, sample_idx[i,0]:sample_idx[i,1]] = 0
-        fc_feats = torch.mean(segs_feat, dim=1)
-        fc_feats = torch.cat((F.layer_norm(fc_feats, [self.fc_feat_size-self.seg_info_size]), \
-                              F.layer_norm(self.seg_info_embed(num[:, 3:7].float()), [self.seg_info_size])), dim=-1)
+        fc_feats = self._seg_fc_feats(segs_feat, num, vid_idx)
 
         pool_feats = ppls_feat
         pool_feats = self.ctx2pool_grd(pool_feats)
@@ -554,14 +620,7 @@ class AttModel(CaptionModel):
         p_pool_feats = self.ctx2pool(pool_feats)
 
         if self.att_input_mode in ('both', 'featmap'):
-            conv_feats_splits = torch.split(conv_feats, 2048, 2)
-            conv_feats = torch.cat([m(c) for (m,c) in zip(self.att_embed, conv_feats_splits)], dim=2)
-            conv_feats = conv_feats.permute(0,2,1).contiguous() # inconsistency between Torch TempConv and PyTorch Conv1d
-            conv_feats = self.att_embed_aux(conv_feats)
-            conv_feats = conv_feats.permute(0,2,1).contiguous() # inconsistency between Torch TempConv and PyTorch Conv1d
-            conv_feats = self.context_enc(conv_feats)[0]
-
-            conv_feats = conv_feats.masked_fill(sample_idx_mask, 0)
+            conv_feats = self._encode_context(segs_feat, sample_idx, vid_idx, opt.get('vid_ids'))
             p_conv_feats = self.ctx2att(conv_feats)
         else:
             conv_feats = pool_feats.new(1,1).fill_(0)
@@ -569,13 +628,16 @@ class AttModel(CaptionModel):
 
         if self.att_model == 'transformer':
             if self.att_input_mode == 'both':
-                seq = self.cap_model([conv_feats, pool_feats], [], infer=True, seq_length=self.seq_length)
+                seq = self.cap_model([conv_feats, pool_feats], [], infer=True, seq_length=self.seq_length, \
+                    beam_size=beam_size)
             elif self.att_input_mode == 'featmap':
-                seq = self.cap_model([conv_feats, conv_feats], [], infer=True, seq_length=self.seq_length)
+                seq = self.cap_model([conv_feats, conv_feats], [], infer=True, seq_length=self.seq_length, \
+                    beam_size=beam_size)
             elif self.att_input_mode == 'region':
-                seq = self.cap_model([pool_feats, pool_feats], [], infer=True, seq_length=self.seq_length)
+                seq = self.cap_model([pool_feats, pool_feats], [], infer=True, seq_length=self.seq_length, \
+                    beam_size=beam_size)
 
-            return seq, seq.new(batch_size, 1).fill_(0), seq.new(batch_size, 1).fill_(0).long()
+            return seq, seq.new(batch_size, 1).fill_(0), seq.new(batch_size, 1).fill_(0).long(), sim_mat_static
         elif self.att_model == 'topdown':
             state = self.init_hidden(batch_size)
 
@@ -624,20 +686,14 @@ class AttModel(CaptionModel):
             return seq, seqLogprobs, att2_weights, sim_mat_static
 
 
-    def _sample_beam(self, segs_feat, ppls, num, ppls_feat, sample_idx, pnt_mask, opt={}):
+    def _sample_beam(self, segs_feat, ppls, num, ppls_feat, sample_idx, pnt_mask, opt={}, vid_idx=None):
 
         batch_size = ppls.size(0)
         rois_num = ppls.size(1)
 
         beam_size = opt.get('beam_size', 10)
 
-        conv_feats = segs_feat
-        sample_idx_mask = conv_feats.new(batch_size, conv_feats.size(1), 1).fill_(1).byte()
-        for i in range(batch_size):
-            sample_idx_mask[i, sample_idx[i,0]:sample_idx[i,1]] = 0
-        fc_feats = torch.mean(segs_feat, dim=1)
-        fc_feats = torch.cat((F.layer_norm(fc_feats, [self.fc_feat_size-self.seg_info_size]), \
-                              F.layer_norm(self.seg_info_embed(num[:, 3:7].float()), [self.seg_info_size])), dim=-1)
+        fc_feats = self._seg_fc_feats(segs_feat, num, vid_idx)
 
         pool_feats = ppls_feat
         pool_feats = self.ctx2pool_grd(pool_feats)
@@ -684,59 +740,25 @@ class AttModel(CaptionModel):
         p_pool_feats = self.ctx2pool(pool_feats)
 
         if self.att_input_mode in ('both', 'featmap'):
-            conv_feats_splits = torch.split(conv_feats, 2048, 2)
-            conv_feats = torch.cat([m(c) for (m,c) in zip(self.att_embed, conv_feats_splits)], dim=2)
-            conv_feats = conv_feats.permute(0,2,1).contiguous() # inconsistency between Torch TempConv and PyTorch Conv1d
-            conv_feats = self.att_embed_aux(conv_feats)
-            conv_feats = conv_feats.permute(0,2,1).contiguous() # inconsistency between Torch TempConv and PyTorch Conv1d
-            conv_feats = self.context_enc(conv_feats)[0]
-
-            conv_feats = conv_feats.masked_fill(sample_idx_mask, 0)
+            conv_feats = self._encode_context(segs_feat, sample_idx, vid_idx, opt.get('vid_ids'))
             p_conv_feats = self.ctx2att(conv_feats)
         else:
             conv_feats = pool_feats.new(1,1).fill_(0)
             p_conv_feats = pool_feats.new(1,1).fill_(0)
 
-        vis_offset = (torch.arange(0, beam_size)*rois_num).view(beam_size).type_as(ppls.data).long()
-        roi_offset = (torch.arange(0, beam_size)*(rois_num+1)).view(beam_size).type_as(ppls.data).long()
-
-        seq = ppls.data.new(self.seq_length, batch_size).zero_().long()
-        seqLogprobs = ppls.data.new(self.seq_length, batch_size).float()
-        att2 = ppls.data.new(self.seq_length, batch_size).fill_(-1).long()
-
-        self.done_beams = [[] for _ in range(batch_size)]
-        for k in range(batch_size):
-            state = self.init_hidden(beam_size)
-            beam_fc_feats = fc_feats[k:k+1].expand(beam_size, fc_feats.size(1))
-            beam_pool_feats = pool_feats[k:k+1].expand(beam_size, rois_num, self.rnn_size).contiguous()
-            if self.att_input_mode in ('both', 'featmap'):
-                beam_conv_feats = conv_feats[k:k+1].expand(beam_size, conv_feats.size(1), self.rnn_size).contiguous()
-                beam_p_conv_feats = p_conv_feats[k:k+1].expand(beam_size, conv_feats.size(1), self.att_hid_size).contiguous()
-            else:
-                beam_conv_feats = beam_pool_feats.new(1,1).fill_(0)
-                beam_p_conv_feats = beam_pool_feats.new(1,1).fill_(0)
-            beam_p_pool_feats = p_pool_feats[k:k+1].expand(beam_size, rois_num, self.att_hid_size).contiguous()
-
-            beam_ppls = ppls[k:k+1].expand(beam_size, rois_num, 7).contiguous()
-            beam_pnt_mask = pnt_mask[k:k+1].expand(beam_size, rois_num+1).contiguous()
-
-            it = fc_feats.data.new(beam_size).long().zero_()
-            xt = self.embed(Variable(it))
-
-            beam_sim_mat_static_update = sim_mat_static_update[k:k+1].expand(beam_size, self.detect_size+1, rois_num)
-
-            rnn_output, state, att2_weight, att_h, _, _ = self.core(xt, beam_fc_feats, beam_conv_feats,
-                beam_p_conv_feats, beam_pool_feats, beam_p_pool_feats, beam_pnt_mask, beam_pnt_mask,
-                state, beam_sim_mat_static_update)
+        # all the segments are decoded together, the beams of segment k are rows k*beam_size...
+        # (k+1)*beam_size-1 and share the features of the segment (see Attention), only the small
+        # fc_feats are replicated
+        beam_fc_feats = fc_feats.unsqueeze(1).expand(batch_size, beam_size, fc_feats.size(1)).contiguous() \
+            .view(batch_size*beam_size, fc_feats.size(1))
 
-            assert(att2_weight.size(0) == beam_size)
-            att2[0, k] = torch.max(att2_weight, 1)[1][0]
+        state = self.init_hidden(batch_size*beam_size)
+        it = fc_feats.data.new(batch_size*beam_size).long().zero_()
+        xt = self.embed(Variable(it))
+        rnn_output, state, att2_weight, att_h, _, _ = self.core(xt, beam_fc_feats, conv_feats,
+            p_conv_feats, pool_feats, p_pool_feats, pnt_mask, pnt_mask, state, sim_mat_static_update)
 
-            self.done_beams[k] = self.beam_search(state, rnn_output, beam_fc_feats, beam_conv_feats, beam_p_conv_feats, \
-                                                  beam_pool_feats, beam_p_pool_feats, beam_sim_mat_static_update, beam_ppls, beam_pnt_mask, vis_offset, roi_offset, opt)
-                
-            seq[:, k] = self.done_beams[k][0]['seq'].cuda() # the first beam has highest cumulative score
-            seqLogprobs[:, k] = self.done_beams[k][0]['logps'].cuda()
-            att2[1:, k] = self.done_beams[k][0]['att2'][1:].cuda()
+        seq, seqLogprobs, att2_weights = self.beam_search(state, rnn_output, att2_weight, beam_size, (beam_fc_feats, \
+            conv_feats, p_conv_feats, pool_feats, p_pool_feats, pnt_mask, pnt_mask), (sim_mat_static_update,))
 
-        return seq.t(), seqLogprobs.t(), att2.t()
+        return seq, seqLogprobs, att2_weights, sim_mat_static
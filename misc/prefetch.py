@@ -0,0 +1,136 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import multiprocessing
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from misc.cache import _nbytes
+
+
+class PrefetchStats(object):
+    """Prefetcher counters shared between the main process and the DataLoader workers,
+    create them before the workers are started (see CacheStats).
+    """
+    def __init__(self, name):
+        self.name = name
+        self.requests = multiprocessing.Value('l', 0)
+        self.stalls = multiprocessing.Value('l', 0)
+        self.stall_ms = multiprocessing.Value('d', 0.)
+        self.depth_sum = multiprocessing.Value('l', 0)
+        self.unscheduled = multiprocessing.Value('l', 0)
+        self.throttled = multiprocessing.Value('l', 0)
+
+    def _add(self, v, n):
+        with v.get_lock():
+            v.value += n
+
+    def request(self, depth):
+        self._add(self.requests, 1)
+        self._add(self.depth_sum, depth)
+
+    def stall(self, ms):
+        self._add(self.stalls, 1)
+        self._add(self.stall_ms, ms)
+
+    def unscheduled_load(self):
+        self._add(self.unscheduled, 1)
+
+    def throttle(self):
+        self._add(self.throttled, 1)
+
+    def reset(self):
+        for v in (self.requests, self.stalls, self.stall_ms, self.depth_sum, self.unscheduled, self.throttled):
+            with v.get_lock():
+                v.value = 0
+
+    def summary(self):
+        requests = max(self.requests.value, 1)
+        return '{}: {} requests, avg queue depth {:.1f}, {} stalls ({:.1f}%, {:.1f} ms avg), {} unscheduled, ' \
+            '{} throttled by the memory cap'.format(self.name, self.requests.value, self.depth_sum.value*1./requests, \
+            self.stalls.value, self.stalls.value*100./requests, self.stall_ms.value/max(self.stalls.value, 1), \
+            self.unscheduled.value, self.throttled.value)
+
+
+class LookaheadPrefetcher(object):
+    """Runs load_fn(index) for the next depth indices of a known schedule on a thread pool.
+
+    get(index) returns the prefetched result when index is on the schedule (waiting for it if
+    it is still being read, which counts as a stall) and loads it synchronously otherwise;
+    indices requested out of order move the schedule forward.
+    No new reads are issued while the results waiting to be consumed, estimated from the
+    average result size, would exceed max_bytes; until a result has been measured, at most
+    num_threads reads are in flight.
+    """
+    def __init__(self, load_fn, schedule, depth, max_bytes, num_threads, stats=None):
+        self.load_fn = load_fn
+        self.schedule = schedule
+        self._schedule_pos = {index:pos for pos, index in enumerate(schedule)} # indices are unique within an epoch
+        self.depth = depth
+        self.max_bytes = max_bytes
+        self.stats = stats
+        self._pos = 0 # next schedule position to hand out
+        self._next_submit = 0 # next schedule position to read
+        self._futures = {}
+        self._avg_bytes = 0.
+        self._num_consumed = 0
+        self._num_threads = num_threads
+        self._pool = ThreadPoolExecutor(max_workers=num_threads)
+        self._fill()
+
+    def _fill(self):
+        # the result size is unknown before the first one, don't read ahead more than the threads can
+        depth = self.depth if self._num_consumed > 0 else min(self.depth, self._num_threads)
+        while self._next_submit < len(self.schedule) and len(self._futures) < depth:
+            if self._futures and self._avg_bytes*(len(self._futures)+1) > self.max_bytes:
+                if self.stats is not None:
+                    self.stats.throttle()
+                break
+            index = self.schedule[self._next_submit]
+            self._futures[index] = self._pool.submit(self.load_fn, index)
+            self._next_submit += 1
+
+    def _advance(self, index):
+        # move the schedule past index, dropping the reads of the indices that were skipped
+        pos = self._schedule_pos.get(index, -1)
+        if pos < self._pos:
+            return False
+        for skipped in self.schedule[self._pos:min(pos, self._next_submit)]:
+            self._futures.pop(skipped, None)
+        self._pos = pos+1
+        self._next_submit = max(self._next_submit, self._pos)
+        return True
+
+    def get(self, index):
+        if self.stats is not None:
+            self.stats.request(len(self._futures))
+        scheduled = self._advance(index)
+        future = self._futures.pop(index, None)
+        if future is not None:
+            if not future.done():
+                start = time.time()
+                result = future.result()
+                if self.stats is not None:
+                    self.stats.stall((time.time()-start)*1000)
+            else:
+                result = future.result()
+        else:
+            if self.stats is not None and not scheduled:
+                self.stats.unscheduled_load()
+            result = self.load_fn(index)
+
+        self._num_consumed += 1
+        self._avg_bytes += (_nbytes(result)-self._avg_bytes)/self._num_consumed
+        self._fill()
+        return result
+
+    def close(self):
+        self._pool.shutdown(wait=False)
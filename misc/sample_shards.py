@@ -0,0 +1,86 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import io
+import json
+import os
+import tarfile
+import numpy as np
+
+# arrays stored for every segment, next to a <seg_id>.json member with seg_id, num_frm,
+# timestamps and duration
+RECORD_ARRAYS = ('proposals', 'region_feature', 'seg_feature', 'cap_seq', 'gt_bboxs')
+
+
+class ShardWriter(object):
+    """Writes segment records into tar shards of about max_bytes each, read back
+    sequentially by iter_shard(). index.json is written by close().
+    """
+    def __init__(self, root, max_bytes, meta):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.index = dict(meta, shards=[])
+        if not os.path.isdir(root):
+            os.makedirs(root)
+        self._tar = None
+
+    def _open(self):
+        shard_file = 'shard_{:05d}.tar'.format(len(self.index['shards']))
+        self._tar = tarfile.open(os.path.join(self.root, shard_file), 'w')
+        self._bytes = 0
+        self.index['shards'].append([shard_file, 0])
+
+    def _add(self, name, payload):
+        info = tarfile.TarInfo(name)
+        info.size = len(payload)
+        self._tar.addfile(info, io.BytesIO(payload))
+        self._bytes += len(payload)
+
+    def write(self, meta, arrays):
+        if self._tar is None or self._bytes >= self.max_bytes:
+            self.close_shard()
+            self._open()
+        key = meta['seg_id']
+        for name in RECORD_ARRAYS:
+            buf = io.BytesIO()
+            np.save(buf, arrays[name])
+            self._add('{}.{}.npy'.format(key, name), buf.getvalue())
+        self._add(key+'.json', json.dumps(meta).encode('utf-8'))
+        self.index['shards'][-1][1] += 1
+
+    def close_shard(self):
+        if self._tar is not None:
+            self._tar.close()
+            self._tar = None
+            print('wrote {} ({} segments)'.format(*self.index['shards'][-1]))
+
+    def close(self):
+        self.close_shard()
+        # write the index last so that a partially written directory is never picked up
+        with open(os.path.join(self.root, 'index.json'), 'w') as f:
+            json.dump(self.index, f)
+
+
+def iter_shard(path):
+    """Yields (meta, arrays) for the records of a shard, reading the file front to back."""
+    meta, arrays = None, {}
+    with tarfile.open(path, 'r|') as tar: # stream mode, no seeks
+        for member in tar:
+            payload = tar.extractfile(member).read()
+            key, name = member.name.split('.', 1)
+            if name == 'json':
+                meta = json.loads(payload.decode('utf-8'))
+            else:
+                arrays[name[:-len('.npy')]] = np.load(io.BytesIO(payload))
+            if meta is not None and len(arrays) == len(RECORD_ARRAYS):
+                assert meta['seg_id'] == key
+                yield meta, arrays
+                meta, arrays = None, {}
@@ -0,0 +1,127 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+import torch.utils.data as data
+
+
+def padding_cost(lengths, batches):
+    # decoder token steps and attended proposals summed over the batches, both padded to the batch max
+    steps, width = 0, 0
+    for batch in batches:
+        max_lengths = lengths[batch].max(axis=0)
+        steps += max_lengths[0]*len(batch)
+        width += max_lengths[1]*len(batch)
+    return steps, width
+
+
+class BucketBatchSampler(data.Sampler):
+    """Batch sampler that groups segments with similar caption lengths and proposal counts.
+
+    Every epoch the segments are shuffled and split into pools of pool_size batches. Each
+    pool is sorted by (caption length, number of proposals) and cut into batches, and the
+    order of all the batches is shuffled again, so the batches stay random while the
+    padding to the longest caption/largest proposal set in the batch shrinks.
+
+    lengths is a num_samples x 2 array of (caption length, number of proposals), see
+    DataLoader.sample_lengths().
+    """
+    def __init__(self, lengths, batch_size, pool_size=50, drop_last=False):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.pool_size = pool_size
+        self.drop_last = drop_last
+        self.last_stats = None
+
+    def __len__(self):
+        if self.drop_last:
+            return len(self.lengths) // self.batch_size
+        return (len(self.lengths) + self.batch_size - 1) // self.batch_size
+
+    def _cut(self, indices):
+        batches = [indices[i:i+self.batch_size] for i in range(0, len(indices), self.batch_size)]
+        if self.drop_last and len(batches) > 0 and len(batches[-1]) < self.batch_size:
+            batches = batches[:-1]
+        return batches
+
+    def __iter__(self):
+        perm = np.random.permutation(len(self.lengths))
+        pool = self.batch_size*self.pool_size
+        batches = []
+        for start in range(0, len(perm), pool):
+            chunk = perm[start:start+pool]
+            # lexsort sorts by the last key first
+            order = np.lexsort((self.lengths[chunk, 1], self.lengths[chunk, 0]))
+            batches.extend(self._cut(chunk[order]))
+        batches = [batches[i] for i in np.random.permutation(len(batches))]
+
+        # compare with the plain shuffled batching of the same permutation
+        self.last_stats = (padding_cost(self.lengths, self._cut(perm)), padding_cost(self.lengths, batches))
+        return iter([b.tolist() for b in batches])
+
+    def padding_summary(self):
+        if self.last_stats is None:
+            return 'bucketed batches: no epoch sampled yet'
+        (shuffled_steps, shuffled_width), (steps, width) = self.last_stats
+        return 'bucketed batches: {} vs {} decoder token steps ({:.1f}% saved), {} vs {} attended proposals ' \
+            '({:.1f}% saved) compared to shuffled batches'.format(steps, shuffled_steps, \
+            100.*(1-steps/max(shuffled_steps, 1)), width, shuffled_width, 100.*(1-width/max(shuffled_width, 1)))
+
+
+class PlannedBatchSampler(data.Sampler):
+    """Draws the batches of an epoch from batch_sampler ahead of time, so that the upcoming
+    indices are known (e.g., to the prefetcher) before the epoch starts.
+
+    plan() draws the batches of a new epoch and must be called before every epoch,
+    iterating replays the current plan (the DataLoader may create the iterator twice).
+    """
+    def __init__(self, batch_sampler):
+        self.batch_sampler = batch_sampler
+        self.planned = None
+
+    def __len__(self):
+        return len(self.batch_sampler)
+
+    def plan(self):
+        self.planned = [list(batch) for batch in self.batch_sampler]
+        return self.planned
+
+    def __iter__(self):
+        if self.planned is None:
+            self.plan()
+        return iter(self.planned)
+
+
+class BlockShuffleSampler(data.Sampler):
+    """Sampler that shuffles blocks of samples stored close to each other, then shuffles
+    the samples within a bounded window.
+
+    blocks is a list of arrays of sample indices, each in storage order, see
+    DataLoader.sample_blocks() (runs of consecutive videos, so that the segments of a video
+    and the files or shard rows next to them are read together). Every epoch the block
+    order is shuffled and the concatenated indices are shuffled within consecutive windows
+    of window samples, so each window only touches a few blocks while the order over the
+    epoch stays close to a random permutation for SGD.
+    """
+    def __init__(self, blocks, window=1000):
+        self.blocks = [np.asarray(b) for b in blocks]
+        self.window = max(window, 1)
+        self.num_samples = sum(len(b) for b in self.blocks)
+
+    def __len__(self):
+        return self.num_samples
+
+    def __iter__(self):
+        order = np.concatenate([self.blocks[i] for i in np.random.permutation(len(self.blocks))]) \
+            if self.blocks else np.zeros(0, dtype=np.int64)
+        for start in range(0, len(order), self.window):
+            np.random.shuffle(order[start:start+self.window]) # shuffles the view in place
+        return iter(order.tolist())
@@ -28,41 +28,55 @@ import numpy as np
 
 INF = 1e10
 
+def sinusoids(positions, d):
+    # positions: n -> n x d encodings, sin at the even channels and cos at the odd ones
+    channels = torch.arange(0, d).double()
+    angles = positions.double().unsqueeze(1) / torch.pow(10000., (channels - channels.fmod(2)) / d).unsqueeze(0)
+    encodings = angles.clone()
+    encodings[:, 0::2] = angles[:, 0::2].sin()
+    encodings[:, 1::2] = angles[:, 1::2].cos()
+    return encodings.float()
+
+_encodings = {} # (d, device) -> sinusoids of the positions seen so far
+
+def positional_encodings(n, d, x):
+    # the encodings of the positions 0...n-1 (n x d) on the device of x, grown by doubling
+    key = (d, x.get_device() if x.is_cuda else -1)
+    encodings = _encodings.get(key)
+    if encodings is None or encodings.size(0) < n:
+        encodings = sinusoids(torch.arange(0, max(n, 0 if encodings is None else 2*encodings.size(0))), d)
+        if x.is_cuda:
+            encodings = encodings.cuda(x.get_device())
+        _encodings[key] = encodings
+    return encodings[:n]
+
 def positional_encodings_like(x, t=None):
     if t is None:
-        positions = torch.arange(0, x.size(1))
-        if x.is_cuda:
-           positions = positions.cuda(x.get_device())
+        encodings = positional_encodings(x.size(1), x.size(-1), x)
     else:
-        positions = t
-    encodings = torch.zeros(*x.size()[1:])
-    if x.is_cuda:
-        encodings = encodings.cuda(x.get_device())
+        encodings = sinusoids(t.cpu(), x.size(-1))
+        if x.is_cuda:
+            encodings = encodings.cuda(x.get_device())
+    return Variable(encodings)
 
+_causal_masks = {} # device -> the largest mask so far
 
-    for channel in range(x.size(-1)):
-        if channel % 2 == 0:
-            encodings[:, channel] = torch.sin(
-                positions / 10000 ** (channel / x.size(2)))
-        else:
-            encodings[:, channel] = torch.cos(
-                positions / 10000 ** ((channel - 1) / x.size(2)))
-    return Variable(encodings)
+def causal_mask(n, x):
+    # n x n, INF above the diagonal, on the device of x
+    key = x.get_device() if x.is_cuda else -1
+    tri = _causal_masks.get(key)
+    if tri is None or tri.size(0) < n:
+        tri = torch.ones(n, n).triu(1) * INF
+        if x.is_cuda:
+            tri = tri.cuda(x.get_device())
+        _causal_masks[key] = tri
+    return tri[:n, :n]
 
 def mask(targets, out):
     mask = (targets != 0)
     out_mask = mask.unsqueeze(-1).expand_as(out)
     return targets[mask], out[out_mask].view(-1, out.size(-1))
 
-# torch.matmul can't do (4, 3, 2) @ (4, 2) -> (4, 3)
-# not exactly true but keep it for legacy reason
-def matmul(x, y):
-    if x.dim() == y.dim():
-        return torch.matmul(x, y)
-    if x.dim() == y.dim() - 1:
-        return torch.matmul(x.unsqueeze(-2), y).squeeze(-2)
-    return torch.matmul(x, y.unsqueeze(-2)).squeeze(-2)
-
 class LayerNorm(nn.Module):
 
     def __init__(self, d_model, eps=1e-6):
@@ -85,42 +99,91 @@ class ResidualBlock(nn.Module):
         self.layernorm = LayerNorm(d_model)
 
     def forward(self, *x):
-        return self.layernorm(x[0] + self.dropout(self.layer(*x)))
+        return self.residual(x[0], self.layer(*x))
+
+    def residual(self, x, out):
+        return self.layernorm(x + self.dropout(out))
 
 class Attention(nn.Module):
 
-    def __init__(self, d_key, drop_ratio, causal):
+    def __init__(self, d_key, drop_ratio, causal, sdpa=None):
         super(Attention, self).__init__()
         self.scale = math.sqrt(d_key)
         self.dropout = nn.Dropout(drop_ratio)
         self.causal = causal
+        # torch.nn.functional.scaled_dot_product_attention (PyTorch >= 2.0) unless disabled
+        self.sdpa = hasattr(F, 'scaled_dot_product_attention') if sdpa is None else sdpa
 
     def forward(self, query, key, value):
-        dot_products = matmul(query, key.transpose(1, 2))
-        if query.dim() == 3 and (self is None or self.causal):
-            tri = torch.ones(key.size(1), key.size(1)).triu(1) * INF
-            if key.is_cuda:
-                tri = tri.cuda(key.get_device())
-            dot_products.data.sub_(tri.unsqueeze(0))
-        return matmul(self.dropout(F.softmax(dot_products / self.scale, dim=-1)), value)
+        # query: ... x Lq x d, key/value: ... x Lk x d, e.g., batch x heads x length x d_head; a query
+        # sequence (Lq == Lk) is causally masked, a single query step attends to all the keys
+        causal = self.causal and query.size(-2) > 1
+        if self.sdpa:
+            # scaled by d_key rather than by the head size
+            return F.scaled_dot_product_attention(query * (math.sqrt(query.size(-1)) / self.scale), key, value,
+                dropout_p=self.dropout.p if self.training else 0., is_causal=causal)
+        dot_products = torch.matmul(query / self.scale, key.transpose(-2, -1))
+        if causal:
+            dot_products.data.sub_(causal_mask(key.size(-2), key))
+        return torch.matmul(self.dropout(F.softmax(dot_products, dim=-1)), value)
 
 class MultiHead(nn.Module):
 
-    def __init__(self, d_key, d_value, n_heads, drop_ratio, causal=False):
+    def __init__(self, d_key, d_value, n_heads, drop_ratio, causal=False, sdpa=None):
         super(MultiHead, self).__init__()
-        self.attention = Attention(d_key, drop_ratio, causal=causal)
+        self.attention = Attention(d_key, drop_ratio, causal=causal, sdpa=sdpa)
         self.wq = nn.Linear(d_key, d_key, bias=False)
         self.wk = nn.Linear(d_key, d_key, bias=False)
         self.wv = nn.Linear(d_value, d_value, bias=False)
         self.wo = nn.Linear(d_value, d_key, bias=False)
         self.n_heads = n_heads
 
+    def project(self, linear, x):
+        # linear(x) split into the heads: batch x length x d -> batch x n_heads x length x d_head.
+        # The heads are the chunks of x.chunk(n_heads, -1); if d is not a multiple of n_heads, the
+        # weight is zero-padded so that the last head is too
+        weight = linear.weight
+        d_head = (weight.size(0) + self.n_heads - 1) // self.n_heads
+        if d_head*self.n_heads > weight.size(0):
+            weight = F.pad(weight, (0, 0, 0, d_head*self.n_heads - weight.size(0)))
+        x = F.linear(x, weight)
+        return x.view(x.size(0), x.size(1), self.n_heads, d_head).transpose(1, 2)
+
+    def project_kv(self, key, value):
+        # the keys and values split into the heads, e.g., of a memory attended at every decoding step
+        return self.project(self.wk, key), self.project(self.wv, value)
+
     def forward(self, query, key, value):
-        query, key, value = self.wq(query), self.wk(key), self.wv(value)
-        query, key, value = (
-            x.chunk(self.n_heads, -1) for x in (query, key, value))
-        return self.wo(torch.cat([self.attention(q, k, v)
-                          for q, k, v in zip(query, key, value)], -1))
+        return self.attend(query, *self.project_kv(key, value))
+
+    def attend(self, query, key, value):
+        # query: batch x Lq x d_key or a single step batch x d_key
+        # key/value: from project_kv, can have a row per group of query rows (e.g., the beams of a
+        # segment), the queries of a group then attend to the keys together
+        step = query.dim() == 2
+        if step:
+            query = query.unsqueeze(1)
+        batch_size, query_len = query.size(0), query.size(1)
+        group = batch_size // key.size(0)
+        assert group == 1 or not self.attention.causal
+        # all the heads (and the queries of a group) at once
+        query = self.project(self.wq, query)
+        if group > 1:
+            query = query.contiguous().view(key.size(0), group, self.n_heads, query_len, -1).transpose(1, 2) \
+                .contiguous().view(key.size(0), self.n_heads, group*query_len, -1)
+        out = self.attention(query, key, value)
+        if group > 1:
+            out = out.view(key.size(0), self.n_heads, group, query_len, -1).permute(0, 2, 3, 1, 4)
+        else:
+            out = out.transpose(1, 2)
+        out = out.contiguous().view(batch_size, query_len, -1)
+        weight = self.wo.weight
+        if out.size(-1) > weight.size(1): # padded heads
+            weight = F.pad(weight, (0, out.size(-1) - weight.size(1)))
+        out = F.linear(out, weight)
+        if step:
+            out = out.squeeze(1)
+        return out
 
 class FeedForward(nn.Module):
 
@@ -134,10 +197,10 @@ class FeedForward(nn.Module):
 
 class EncoderLayer(nn.Module):
 
-    def __init__(self, d_model, d_hidden, n_heads, drop_ratio):
+    def __init__(self, d_model, d_hidden, n_heads, drop_ratio, sdpa=None):
         super(EncoderLayer, self).__init__()
         self.selfattn = ResidualBlock(
-            MultiHead(d_model, d_model, n_heads, drop_ratio),
+            MultiHead(d_model, d_model, n_heads, drop_ratio, sdpa=sdpa),
             d_model, drop_ratio)
         self.feedforward = ResidualBlock(FeedForward(d_model, d_hidden),
                                          d_model, drop_ratio)
@@ -147,13 +210,13 @@ class EncoderLayer(nn.Module):
 
 class DecoderLayer(nn.Module):
 
-    def __init__(self, d_model, d_hidden, n_heads, drop_ratio):
+    def __init__(self, d_model, d_hidden, n_heads, drop_ratio, sdpa=None):
         super(DecoderLayer, self).__init__()
         self.selfattn = ResidualBlock(
-            MultiHead(d_model, d_model, n_heads, drop_ratio, causal=True),
+            MultiHead(d_model, d_model, n_heads, drop_ratio, causal=True, sdpa=sdpa),
             d_model, drop_ratio)
         self.attention = ResidualBlock(
-            MultiHead(d_model, d_model, n_heads, drop_ratio),
+            MultiHead(d_model, d_model, n_heads, drop_ratio, sdpa=sdpa),
             d_model, drop_ratio)
         self.feedforward = ResidualBlock(FeedForward(d_model, d_hidden),
                                          d_model, drop_ratio)
@@ -162,14 +225,27 @@ class DecoderLayer(nn.Module):
         x = self.selfattn(x, x, x)
         return self.feedforward(self.attention(x, encoding, encoding))
 
+    def step(self, x, memory, cache):
+        # x: batch x d_model, the input at the next position
+        # memory: the keys/values of the encoding (MultiHead.project_kv)
+        # cache: the self-attention keys/values of the previous positions, extended in place
+        selfattn = self.selfattn.layer
+        key, value = selfattn.project_kv(x.unsqueeze(1), x.unsqueeze(1))
+        if cache:
+            key, value = torch.cat((cache[0], key), 2), torch.cat((cache[1], value), 2)
+        cache[:] = [key, value]
+        x = self.selfattn.residual(x, selfattn.attend(x, key, value))
+        x = self.attention.residual(x, self.attention.layer.attend(x, *memory))
+        return self.feedforward(x)
+
 class Encoder(nn.Module):
 
     def __init__(self, d_model, d_hidden, n_vocab, n_layers, n_heads,
-                 drop_ratio, pe):
+                 drop_ratio, pe, sdpa=None):
         super(Encoder, self).__init__()
         # self.linear = nn.Linear(d_model*2, d_model)
         self.layers = nn.ModuleList(
-            [EncoderLayer(d_model, d_hidden, n_heads, drop_ratio)
+            [EncoderLayer(d_model, d_hidden, n_heads, drop_ratio, sdpa)
              for i in range(n_layers)])
         self.dropout = nn.Dropout(drop_ratio)
         self.pe = pe
@@ -192,10 +268,10 @@ class Encoder(nn.Module):
 class Decoder(nn.Module):
 
     def __init__(self, d_model, d_hidden, vocab_size, n_layers, n_heads,
-                 drop_ratio):
+                 drop_ratio, sdpa=None):
         super(Decoder, self).__init__()
         self.layers = nn.ModuleList(
-            [DecoderLayer(d_model, d_hidden, n_heads, drop_ratio)
+            [DecoderLayer(d_model, d_hidden, n_heads, drop_ratio, sdpa)
              for i in range(n_layers)])
         self.out = nn.Linear(d_model, vocab_size)
         self.dropout = nn.Dropout(drop_ratio)
@@ -204,13 +280,31 @@ class Decoder(nn.Module):
         self.d_out = vocab_size
 
     def forward(self, x, encoding):
-        x = F.embedding(x, self.out.weight * math.sqrt(self.d_model))
+        x = F.embedding(x, self.embed_weight())
         x = x+positional_encodings_like(x)
         x = self.dropout(x)
         for layer, enc in zip(self.layers, encoding):
             x = layer(x, enc)
         return x
 
+    def memory(self, encoding):
+        # the keys/values of the encoding of every layer, projected once per decoding
+        return [layer.attention.layer.project_kv(enc, enc) for layer, enc in zip(self.layers, encoding)]
+
+    def embed_weight(self):
+        # the scaled output weight the words are embedded with, computed once per decoding
+        return self.out.weight * math.sqrt(self.d_model)
+
+    def step(self, words, t, memory, cache, embedW):
+        # decoding step t with the previous words, B -> B x d_model, the keys/values of the previous
+        # steps are in cache (a list per layer, see DecoderLayer.step)
+        x = F.embedding(words, embedW)
+        x = x + Variable(positional_encodings(t+1, self.d_model, x.data)[t])
+        x = self.dropout(x)
+        for layer, mem, layer_cache in zip(self.layers, memory, cache):
+            x = layer.step(x, mem, layer_cache)
+        return x
+
     def greedy(self, encoding, T):
         B, _, H = encoding[0].size()
         # change T to 20, max # of words in a sentence
@@ -218,36 +312,78 @@ class Decoder(nn.Module):
         # T *= 2
         prediction = Variable(encoding[0].data.new(B, T).long().fill_(
             0))
-        hiddens = [Variable(encoding[0].data.new(B, T, H).zero_())
-                   for l in range(len(self.layers) + 1)]
-        embedW = self.out.weight * math.sqrt(self.d_model)
-        hiddens[0] = hiddens[0] + positional_encodings_like(hiddens[0])
+        memory = self.memory(encoding)
+        cache = [[] for l in range(len(self.layers))]
+        embedW = self.embed_weight()
+        words = Variable(encoding[0].data.new(B).long().fill_(0))
         for t in range(T):
-            if t == 0:
-                hiddens[0][:, t] = hiddens[0][:, t] + F.embedding(Variable(
-                    encoding[0].data.new(B).long().fill_(
-                        0)), embedW)
-            else:
-                hiddens[0][:, t] = hiddens[0][:, t] + F.embedding(prediction[:, t - 1],
-                                                                embedW)
-            hiddens[0][:, t] = self.dropout(hiddens[0][:, t])
-            for l in range(len(self.layers)):
-                x = hiddens[l][:, :t + 1]
-                x = self.layers[l].selfattn(hiddens[l][:, t], x, x)
-                hiddens[l + 1][:, t] = self.layers[l].feedforward(
-                    self.layers[l].attention(x, encoding[l], encoding[l]))
-
-            _, prediction[:, t] = self.out(hiddens[-1][:, t]).max(-1)
+            _, prediction[:, t] = self.out(self.step(words, t, memory, cache, embedW)).max(-1)
+            words = prediction[:, t]
         return prediction
 
+    def beam_search(self, encoding, T, beam_size):
+        # as CaptionModel.beam_search, all the segments at once: the beams of segment k are rows
+        # k*beam_size...(k+1)*beam_size-1 (and share the memory of the segment), a beam is finished
+        # when it emits the end token (0) or runs out of steps, and the best finished beam of every
+        # segment (by the sum of the log probabilities) is returned
+        B = encoding[0].size(0)
+        num_rows = B*beam_size
+        neg_inf = float('-inf')
+        memory = self.memory(encoding)
+        cache = [[] for l in range(len(self.layers))]
+        embedW = self.embed_weight()
+
+        beam_seq = encoding[0].data.new(num_rows, T).long().zero_()
+        # all the beams start from the same <bos>, only expand the first one at t=0
+        beam_logprobs_sum = encoding[0].data.new(B, beam_size).zero_()
+        beam_logprobs_sum[:, 1:] = neg_inf
+        done_seq = beam_seq.new(B, T).zero_()
+        done_logprobs_sum = beam_logprobs_sum.new(B).fill_(neg_inf)
+        beam_offset = torch.arange(0, B).type_as(beam_seq).view(B, 1)*beam_size
+        words = beam_seq.new(num_rows).zero_()
+
+        for t in range(T):
+            logprobs = F.log_softmax(self.out(self.step(Variable(words), t, memory, cache, embedW)), dim=1).data
+            vocab_size = logprobs.size(1)
+
+            # top beam_size (beam, word) expansions of every segment
+            candidate_logprobs = (beam_logprobs_sum.view(num_rows, 1) + logprobs).view(B, beam_size*vocab_size)
+            beam_logprobs_sum, candidates = torch.topk(candidate_logprobs, beam_size, dim=1)
+            words = candidates % vocab_size
+            parents = ((candidates - words) // vocab_size + beam_offset).view(-1)
+            words = words.view(-1)
+
+            # fork the parent beams
+            beam_seq = beam_seq.index_select(0, parents)
+            beam_seq[:, t] = words
+            for layer_cache in cache:
+                layer_cache[:] = [x.index_select(0, parents) for x in layer_cache]
+
+            # keep the best finished beam of every segment and stop extending the finished ones
+            if t == T - 1:
+                finished = beam_logprobs_sum > neg_inf
+            else:
+                finished = (words.view(B, beam_size) == 0) & (beam_logprobs_sum > neg_inf)
+            best_logprobs_sum, best_beam = beam_logprobs_sum.masked_fill(finished == 0, neg_inf).max(1)
+            update = best_logprobs_sum > done_logprobs_sum
+            best_rows = (best_beam.view(B, 1) + beam_offset).view(-1)
+            done_seq[update] = beam_seq.index_select(0, best_rows)[update]
+            done_logprobs_sum[update] = best_logprobs_sum[update]
+            beam_logprobs_sum = beam_logprobs_sum.masked_fill(finished, neg_inf)
+
+            if (beam_logprobs_sum == neg_inf).all():
+                break
+
+        return done_seq
+
 
 class Transformer(nn.Module):
 
     def __init__(self, d_model, n_vocab_src, vocab_trg, d_hidden=2048,
-                 n_layers=6, n_heads=8, drop_ratio=0.1, pe=False):
+                 n_layers=6, n_heads=8, drop_ratio=0.1, pe=False, sdpa=None):
         super(Transformer, self).__init__()
         self.encoder = Encoder(d_model, d_hidden, n_vocab_src, n_layers,
-                               n_heads, drop_ratio, pe)
+                               n_heads, drop_ratio, pe, sdpa)
 
     def forward(self, x):
         encoding = self.encoder(x)
@@ -262,14 +398,16 @@ class Transformer(nn.Module):
 class TransformerDecoder(nn.Module):
 
     def __init__(self, d_model, n_vocab_src, vocab_trg, d_hidden=2048,
-                 n_layers=2, n_heads=6, drop_ratio=0.2):
+                 n_layers=2, n_heads=6, drop_ratio=0.2, sdpa=None):
         super(TransformerDecoder, self).__init__()
         self.decoder = Decoder(d_model, d_hidden, vocab_trg, n_layers,
-                              n_heads, drop_ratio)
+                              n_heads, drop_ratio, sdpa)
         self.n_layers = n_layers
 
-    def forward(self, encoding, s, ss_ratio=1, infer=False, seq_length=20):
+    def forward(self, encoding, s, ss_ratio=1, infer=False, seq_length=20, beam_size=1):
         if infer:
+            if beam_size > 1:
+                return self.decoder.beam_search(encoding, seq_length, beam_size)
             greedy = self.decoder.greedy(encoding, seq_length)
             return greedy
 
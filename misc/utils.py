@@ -296,6 +296,16 @@ def bbox_overlaps(rois, gt_box, frm_mask):
 
     return overlaps
 
+def scatter_rois(x, ppl_slots, num_slots, fill=0):
+    # x: N, ..., num_rois values of packed proposals (--packed_proposals)
+    # ppl_slots: N, num_rois positions in the fixed layout, num_slots for padding
+    # returns N, ..., num_slots with fill at the slots of the dropped proposals
+    N, num_rois = ppl_slots.size()
+    out = x.new(x.size()[:-1] + (num_slots+1,)).fill_(fill)
+    index = ppl_slots.to(x.device).view((N,) + (1,)*(x.dim()-2) + (num_rois,)).expand_as(x)
+    out.scatter_(x.dim()-1, index, x)
+    return out[..., :num_slots]
+
 def sim_mat_target(overlaps, pad_gt_bboxs):
     # overlaps: B, num_rois, num_box
     # pad_gt_bboxs: B, num_box (class labels)
@@ -304,28 +314,28 @@ def sim_mat_target(overlaps, pad_gt_bboxs):
     masked_labels = (overlaps > 0.5).long() * pad_gt_bboxs.view(B, 1, num_box).long() # could try a higher threshold
     return masked_labels.permute(0,2,1).contiguous()
 
-def bbox_target(mask, overlaps, seq, seq_update, vocab_size):
-
-    mask = mask.data.contiguous()
-    overlaps_copy = overlaps.clone()
-
-    max_rois = overlaps.size(1)
-    batch_size = overlaps.size(0)
-
-    overlaps_copy.masked_fill_(mask.view(batch_size, 1, -1).expand_as(overlaps_copy), 0)
-    max_overlaps, gt_assignment = torch.max(overlaps_copy, 2)
-
-    # get the labels.
-    labels = (max_overlaps > 0.5).float()
-    no_proposal_idx = (labels.sum(1) > 0) != (seq.data[:,2] > 0)
-
-    # (deprecated) convert vis word to text word if there is not matched proposal
-    if no_proposal_idx.sum() > 0:
-        seq_update[:,0][no_proposal_idx] = seq_update[:,3][no_proposal_idx]
-        seq_update[:,1][no_proposal_idx] = 0
-        seq_update[:,2][no_proposal_idx] = 0
-
-    return labels
+def _step_box_hits(hits, mask):
+    # hits: N, num_rois, num_box (1 if the roi hits the box)
+    # mask: B, num_box, T (1 if the gt box is not referred to at the timestep), with a row of hits
+    # per group of B//N rows of mask (e.g., the seq_per_img captions of a segment)
+    # returns B, T, num_rois, the number of boxes of the timestep hit by the roi
+    N, num_rois, num_box = hits.size()
+    T = mask.size(2)
+    steps = (mask == 0).float().view(N, -1, num_box, T).permute(0,2,1,3).contiguous().view(N, num_box, -1)
+    counts = torch.bmm(hits.float(), steps) # N, num_rois, B//N*T
+    return counts.view(N, num_rois, -1, T).permute(0,2,3,1).contiguous().view(-1, T, num_rois)
+
+def bbox_target(mask, overlaps):
+    # roi labels of all the timesteps at once, 1 if the roi overlaps a box of the timestep by more than 0.5
+    # mask: B, num_box, T; overlaps: B (or a row per group, see _step_box_hits), num_rois, num_box
+    # returns B, T, num_rois
+    return (_step_box_hits(overlaps > 0.5, mask) > 0).float()
+
+def frm_mask_target(mask, frm_mask):
+    # frame masks of all the timesteps at once, 1 if the roi is in none of the frames of the boxes of the timestep
+    # mask: B, num_box, T; frm_mask: B (or a row per group), num_rois, num_box (1 if the roi is not in the frame of the box)
+    # returns B, T, num_rois
+    return _step_box_hits(frm_mask == 0, mask) <= 0
 
 def _affine_grid_gen(rois, input_size, grid_size):
 
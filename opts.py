@@ -28,6 +28,65 @@ def parse_opt():
                     help='path to the npy flies containing region features')
     parser.add_argument('--seg_feature_root', type=str, default='',
                     help='path to the npy files containing frame-wise features')
+    parser.add_argument('--proposal_labels_npy', type=str, default='',
+                    help='npy export of the proposal labels (prepro/export_proposal_labels.py) to memory-map instead of reading the h5 file')
+    parser.add_argument('--region_feat_shards', type=str, default='',
+                    help='directory of packed region feature shards (prepro/pack_region_feats.py), used instead of feature_root if set, float16/int8 shards are dequantized into the sample buffers')
+    parser.add_argument('--feature_manifest', type=str, default='',
+                    help='feature availability manifest (prepro/build_feature_manifest.py), replaces the per-segment file checks at startup')
+    parser.add_argument('--manifest_check', action='store_true',
+                    help='fall back to the per-segment file checks if the feature directories changed since the manifest was built')
+    parser.add_argument('--prepared_samples', type=str, default='',
+                    help='directory of samples compiled by prepro/prepare_samples.py, replaces input_json/input_raw_cap in the DataLoader')
+    parser.add_argument('--glove_cache_dir', type=str, default='',
+                    help='directory to cache the GloVe class/word embedding tables in (off by default); the random vectors of the out-of-GloVe words are then reused by later runs, whatever their seed')
+    parser.add_argument('--local_cache_dir', type=str, default='',
+                    help='directory on a local disk (e.g., SSD) to keep read-through copies of the feature files or region feature shards, for feature roots on network storage')
+    parser.add_argument('--local_cache_gb', type=float, default=100,
+                    help='size cap (GB) of the local feature file cache, least recently used files are evicted')
+    parser.add_argument('--seg_feat_cache_mb', type=int, default=0,
+                    help='per-worker LRU cache budget (MB) for the per-video frame-wise features, 0 to disable')
+    parser.add_argument('--seg_feat_cache_dir', type=str, default='',
+                    help='directory for a cache of the frame-wise features shared across workers, e.g., on /dev/shm')
+    parser.add_argument('--seg_feat_cache_dir_mb', type=int, default=4096,
+                    help='budget (MB) of the shared frame-wise feature cache')
+    parser.add_argument('--sample_cache_dir', type=str, default='',
+                    help='directory for a cache of the per-segment proposal arrays (proposals, masks, region features) shared across workers and epochs, e.g., on /dev/shm; the caption selection is still drawn per sample')
+    parser.add_argument('--sample_cache_mb', type=int, default=16384,
+                    help='budget (MB) of the sample cache, least recently used entries are evicted')
+    parser.add_argument('--sample_cache_compress', action='store_true',
+                    help='compress the sample cache entries (zlib), more entries fit in the budget at some CPU cost')
+    parser.add_argument('--packed_proposals', action='store_true',
+                    help='load only the proposals that pass prop_thresh/exclude_bgd_det and pad each batch to its largest proposal set (changes the results with obj_interact or the transformer decoder, which do not mask proposals)')
+    parser.add_argument('--dedup_video_feats', action='store_true',
+                    help='batch the frame-wise features once per video with a segment-to-video index and encode them once per video, mostly for inference over all the segments of a video (in training, BatchNorm counts each video of a batch once); not supported with --mGPUs')
+    parser.add_argument('--context_cache_mb', type=int, default=0,
+                    help='budget (MB, on the model device) of the eval-time cache of the per-video context encodings of the frame-wise features, 0 to disable; not supported with --mGPUs')
+    parser.add_argument('--feat_half', action='store_true',
+                    help='build the region/frame-wise feature buffers of the samples in float16 to halve worker memory and IPC volume')
+
+    parser.add_argument('--sample_shards', type=str, default='',
+                    help='directory of sequential sample shards (prepro/write_sample_shards.py) to stream the training split from, requires PyTorch 1.2+')
+    parser.add_argument('--shard_shuffle_buffer', type=int, default=1000,
+                    help='number of records per worker in the shuffle buffer when streaming from sample shards')
+    parser.add_argument('--bucket_batches', action='store_true',
+                    help='group training segments with similar caption lengths/proposal counts into the same batch')
+    parser.add_argument('--bucket_pool_size', type=int, default=50,
+                    help='number of batches shuffled together and sorted into buckets, larger pools give less padding but less randomness')
+
+    parser.add_argument('--block_shuffle', action='store_true',
+                    help='shuffle blocks of consecutive videos and then the segments within a bounded window instead of fully at random, keeps the feature reads clustered')
+    parser.add_argument('--shuffle_block_videos', type=int, default=1,
+                    help='number of consecutive videos (in feature file/shard order) per block of --block_shuffle')
+    parser.add_argument('--shuffle_window', type=int, default=1000,
+                    help='number of samples shuffled together by --block_shuffle, larger windows are closer to a random order')
+
+    parser.add_argument('--prefetch_depth', type=int, default=0,
+                    help='number of upcoming samples each worker reads ahead on a thread pool, 0 to disable')
+    parser.add_argument('--prefetch_threads', type=int, default=4,
+                    help='number of reader threads per worker for the prefetcher')
+    parser.add_argument('--prefetch_mb', type=int, default=512,
+                    help='per-worker memory cap (MB) of the samples read ahead by the prefetcher')
 
     parser.add_argument('--num_workers', type=int, default=20,
                     help='number of worker to load data')
@@ -67,6 +126,8 @@ def parse_opt():
 
     parser.add_argument('--enable_BUTD', action='store_true', help='if enable, the region feature will not include location embedding nor class encoding')
     parser.add_argument('--obj_interact', action='store_true', help='self-attention encoding for region features')
+    parser.add_argument('--disable_transformer_sdpa', action='store_true',
+                    help='compute the attention of obj_interact and the transformer decoder with matmul/softmax instead of torch.nn.functional.scaled_dot_product_attention (used by default with PyTorch >= 2.0)')
     parser.add_argument('--exclude_bgd_det', action='store_true', help='exclude __background__ RoIs')
 
     parser.add_argument('--w_att2', type=float, default=0)
@@ -138,6 +199,7 @@ def parse_opt():
     parser.add_argument('--eval_obj_grounding', action='store_true',
                     help='whether evaluate object grounding accuracy')
     parser.add_argument('--vis_attn', action='store_true', help='visualize attention')
+    parser.add_argument('--vis_frame_scale', type=float, default=1., help='downscale factor of the frames drawn by --vis_attn')
     parser.add_argument('--enable_visdom', action='store_true')
     parser.add_argument('--visdom_server', type=str, default='', help='update it with your server url')
 
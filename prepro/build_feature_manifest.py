@@ -0,0 +1,54 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+
+# Record the available region (feature_root/<seg_id>.npy) and frame-wise
+# (seg_feature_root/<vid>_resnet.npy, <vid>_bn.npy) feature files with their sizes and
+# mtimes in one file, see --feature_manifest in opts.py and misc/feature_store.py.
+
+import os
+import json
+import argparse
+
+
+def scan_dir(root):
+  files = {}
+  for entry in os.scandir(root):
+    if entry.name.endswith('.npy') and entry.is_file():
+      st = entry.stat()
+      files[entry.name[:-len('.npy')]] = [st.st_size, st.st_mtime]
+  return files
+
+
+def main(params):
+  manifest = {'roots':{}}
+  for name in ('feature_root', 'seg_feature_root'):
+    root = params[name]
+    manifest['roots'][name] = [os.path.abspath(root), os.stat(root).st_mtime]
+  manifest['region'] = scan_dir(params['feature_root'])
+  manifest['frame'] = scan_dir(params['seg_feature_root'])
+  print('found {} region feature files and {} frame-wise feature files'.format(len(manifest['region']), \
+    len(manifest['frame'])))
+
+  tmp_file = params['output_manifest']+'.tmp'
+  with open(tmp_file, 'w') as f:
+    json.dump(manifest, f)
+  os.rename(tmp_file, params['output_manifest'])
+  print('wrote ', params['output_manifest'])
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser()
+
+  parser.add_argument('--feature_root', default='data/anet/fc6_feat_100rois', help='directory of the per-segment region feature files')
+  parser.add_argument('--seg_feature_root', default='data/anet/rgb_motion_1d', help='directory of the frame-wise feature files')
+  parser.add_argument('--output_manifest', default='data/anet/feature_manifest.json', help='output json file')
+
+  args = parser.parse_args()
+  params = vars(args) # convert to ordinary dict
+  print('parsed input parameters:')
+  print(json.dumps(params, indent = 2))
+  main(params)
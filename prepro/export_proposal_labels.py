@@ -0,0 +1,43 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+
+# Export dets_labels of the detection h5 file to an .npy file that the data loaders can
+# memory-map (--proposal_labels_npy), copied block by block to keep the memory bounded.
+
+import os
+import json
+import argparse
+import h5py
+import numpy as np
+
+
+def main(params):
+  with h5py.File(params['proposal_h5'], 'r') as f:
+    labels = f['dets_labels']
+    block = max(labels.chunks[0] if labels.chunks is not None else 1, params['block_rows'])
+    tmp_file = params['output_npy']+'.tmp.npy'
+    out = np.lib.format.open_memmap(tmp_file, mode='w+', dtype=labels.dtype, shape=labels.shape)
+    for start in range(0, labels.shape[0], block):
+      out[start:start+block] = labels[start:start+block]
+    out.flush()
+    del out
+  os.rename(tmp_file, params['output_npy'])
+  print('wrote {} {} to {}'.format(labels.shape, labels.dtype, params['output_npy']))
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser()
+
+  parser.add_argument('--proposal_h5', default='data/anet/anet_detection_vg_fc6_feat_100rois.h5', help='proposal file')
+  parser.add_argument('--output_npy', default='data/anet/anet_detection_vg_fc6_feat_100rois_labels.npy', help='output npy file')
+  parser.add_argument('--block_rows', default=4096, type=int, help='number of segments copied at a time')
+
+  args = parser.parse_args()
+  params = vars(args) # convert to ordinary dict
+  print('parsed input parameters:')
+  print(json.dumps(params, indent = 2))
+  main(params)
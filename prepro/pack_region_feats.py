@@ -0,0 +1,141 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+
+# Pack the per-segment region feature files (feature_root/<seg_id>.npy) into a few
+# large shards with an offset index, see misc/feature_store.py for the reader.
+# With --dtype float16 or int8 the features are stored at reduced precision (half or a
+# quarter of the float32 size); int8 uses symmetric per-segment, per-channel scales,
+# stored in scales.npy. --verify reads segments back and reports the precision loss.
+
+import os
+import sys
+import json
+import argparse
+import numpy as np
+
+_SCRIPTPATH_ = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(_SCRIPTPATH_, '..'))
+from misc.feature_store import RegionFeatureShards, copy_rows
+
+
+def scan_features(feature_root):
+  # read the npy headers only, no feature data is touched here
+  segs = []
+  for fname in sorted(os.listdir(feature_root)):
+    if not fname.endswith('.npy'):
+      continue
+    feat = np.load(os.path.join(feature_root, fname), mmap_mode='r')
+    num_rows = int(np.prod(feat.shape[:-1]))
+    segs.append((fname[:-len('.npy')], num_rows, feat.shape[-1], feat.dtype))
+  return segs
+
+
+def quantize(feat):
+  # symmetric int8 with one scale per channel, all-zero channels get a scale of 1
+  scale = np.abs(feat).max(axis=0).astype(np.float32) / 127.
+  scale[scale == 0] = 1.
+  return np.clip(np.round(feat / scale), -127, 127).astype(np.int8), scale
+
+
+def verify(params, segs):
+  # read random segments back through the loader path and compare with the source files
+  store = RegionFeatureShards(params['output_dir'])
+  rng = np.random.RandomState(0)
+  picked = rng.choice(len(segs), min(params['verify'], len(segs)), replace=False)
+  max_abs, sum_abs, sum_sq_err, sum_sq, count = 0., 0., 0., 0., 0
+  for i in picked:
+    seg_id, num_rows, feat_dim, _ = segs[i]
+    ref = np.load(os.path.join(params['feature_root'], seg_id+'.npy')).reshape(num_rows, feat_dim).astype(np.float64)
+    out = np.zeros((num_rows, feat_dim), dtype=np.float32)
+    copy_rows(out, store[seg_id])
+    err = np.abs(out - ref)
+    max_abs = max(max_abs, err.max())
+    sum_abs += err.sum()
+    sum_sq_err += (err**2).sum()
+    sum_sq += (ref**2).sum()
+    count += err.size
+  print('verified {} segments: max abs error {:.4g}, mean abs error {:.4g}, relative rms error {:.4g}'.format(
+    len(picked), max_abs, sum_abs/max(count, 1), np.sqrt(sum_sq_err/max(sum_sq, 1e-12))))
+
+
+def main(params):
+  segs = scan_features(params['feature_root'])
+  assert len(segs) > 0, 'no feature files found under {}'.format(params['feature_root'])
+  feat_dim = segs[0][2]
+  src_dtype = segs[0][3]
+  assert all(s[2] == feat_dim for s in segs), 'all segments must share the same feature dimension'
+  print('found {} segments, feature dim {}, dtype {}'.format(len(segs), feat_dim, src_dtype))
+  dtype = np.dtype(params['dtype']) if params['dtype'] else src_dtype
+  quantized = dtype == np.int8
+
+  # group the segments into shards of roughly shard_size_gb each
+  max_rows = max(1, int(params['shard_size_gb']*(1024**3) // (feat_dim*dtype.itemsize)))
+  shard_segs = [[]]
+  shard_rows = 0
+  for seg in segs:
+    if shard_rows > 0 and shard_rows + seg[1] > max_rows:
+      shard_segs.append([])
+      shard_rows = 0
+    shard_segs[-1].append(seg)
+    shard_rows += seg[1]
+
+  if not os.path.isdir(params['output_dir']):
+    os.makedirs(params['output_dir'])
+
+  index = {'feat_dim':feat_dim, 'dtype':dtype.name, 'shards':[], 'segments':{}}
+  if quantized:
+    scales = np.lib.format.open_memmap(os.path.join(params['output_dir'], 'scales.npy'), mode='w+',
+      dtype=np.float32, shape=(len(segs), feat_dim))
+  scale_row = 0
+  for shard_idx, segs_in_shard in enumerate(shard_segs):
+    shard_file = 'shard_{:05d}.npy'.format(shard_idx)
+    total_rows = sum(s[1] for s in segs_in_shard)
+    shard = np.lib.format.open_memmap(os.path.join(params['output_dir'], shard_file), mode='w+',
+      dtype=dtype, shape=(total_rows, feat_dim))
+    row_start = 0
+    for seg_id, num_rows, _, _ in segs_in_shard:
+      feat = np.load(os.path.join(params['feature_root'], seg_id+'.npy')).reshape(num_rows, feat_dim)
+      if quantized:
+        shard[row_start:row_start+num_rows], scales[scale_row] = quantize(feat)
+        index['segments'][seg_id] = [shard_idx, row_start, num_rows, scale_row]
+        scale_row += 1
+      else:
+        shard[row_start:row_start+num_rows] = feat
+        index['segments'][seg_id] = [shard_idx, row_start, num_rows]
+      row_start += num_rows
+    shard.flush()
+    del shard
+    index['shards'].append(shard_file)
+    print('wrote {} with {} segments ({} rows)'.format(shard_file, len(segs_in_shard), total_rows))
+
+  if quantized:
+    scales.flush()
+    del scales
+
+  # write the index last so that a partially packed directory is never picked up
+  with open(os.path.join(params['output_dir'], 'index.json'), 'w') as f:
+    json.dump(index, f)
+  print('wrote ', os.path.join(params['output_dir'], 'index.json'))
+
+  if params['verify'] > 0:
+    verify(params, segs)
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser()
+
+  parser.add_argument('--feature_root', default='data/anet/fc6_feat_100rois', help='directory of the per-segment region feature files')
+  parser.add_argument('--output_dir', default='data/anet/fc6_feat_100rois_shards', help='output directory for the shards and index.json')
+  parser.add_argument('--shard_size_gb', default=4., type=float, help='approximate size of each shard file')
+  parser.add_argument('--dtype', default='', choices=['', 'float32', 'float16', 'int8'], help='storage dtype, empty to keep the dtype of the feature files')
+  parser.add_argument('--verify', default=0, type=int, help='number of segments to read back and compare with the feature files after packing')
+
+  args = parser.parse_args()
+  params = vars(args) # convert to ordinary dict
+  print('parsed input parameters:')
+  print(json.dumps(params, indent = 2))
+  main(params)
@@ -0,0 +1,49 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+
+# Compile the caption annotations (cap_anet_trainval.json + dic_anet.json) and the
+# segment boundaries into flat numpy arrays (caption/detection token ids, gt boxes with
+# offsets, timestamps), see --prepared_samples in opts.py and misc/catalog.py.
+# The arrays depend on seq_length and on whether the hidden testing split is used, so
+# pass the same values as for training/evaluation.
+
+import os
+import sys
+import json
+import argparse
+
+_SCRIPTPATH_ = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(_SCRIPTPATH_, '..'))
+from misc.catalog import MetadataCatalog
+
+
+def main(params):
+  info = json.load(open(params['input_dic']))
+  caption_file = json.load(open(params['input_json']))
+  raw_caption_file = json.load(open(params['input_raw_cap']))
+
+  catalog = MetadataCatalog.build(info, caption_file, raw_caption_file, params['seq_length'], params['test_mode'])
+  catalog.save(params['output_dir'])
+  print('wrote {} segments ({} with captions, {} gt boxes) to {}'.format(len(catalog), \
+    int(catalog.has_annotation.sum()), catalog.gt_boxes.shape[0], params['output_dir']))
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser()
+
+  parser.add_argument('--input_json', default='data/anet/cap_anet_trainval.json', help='caption annotation file')
+  parser.add_argument('--input_dic', default='data/anet/dic_anet.json', help='vocabulary/segment file')
+  parser.add_argument('--input_raw_cap', default='data/anet/anet_captions_all_splits.json', help='caption file with the segment boundaries')
+  parser.add_argument('--output_dir', default='data/anet/prepared_samples', help='output directory')
+  parser.add_argument('--seq_length', default=20, type=int, help='must match --seq_length in opts.py')
+  parser.add_argument('--test_mode', action='store_true', help='build dummy gt boxes as for the hidden testing split (--val_split testing)')
+
+  args = parser.parse_args()
+  params = vars(args) # convert to ordinary dict
+  print('parsed input parameters:')
+  print(json.dumps(params, indent = 2))
+  main(params)
@@ -0,0 +1,82 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+
+# Write the segments of a split into sequential tar shards, one record per segment with
+# its region features, frame-wise features (first t_attn_size frames), proposals and
+# caption arrays. See --sample_shards in opts.py and misc/sample_shards.py.
+# The frame-wise features are per video, so they are repeated for every segment.
+
+import os
+import sys
+import json
+import argparse
+import numpy as np
+
+_SCRIPTPATH_ = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(_SCRIPTPATH_, '..'))
+from misc.feature_store import ProposalStore, load_seg_feature
+from misc.catalog import get_catalog
+from misc.sample_shards import ShardWriter
+
+
+def main(params):
+  catalog = get_catalog(params['input_dic'], params['input_json'], params['input_raw_cap'], params['seq_length'],
+    params['test_mode'])
+  proposal_store = ProposalStore(params['proposal_h5'])
+
+  feat_dtype = np.dtype(params['feat_dtype'])
+  meta = {'split':params['split'], 'seq_length':params['seq_length'], 'test_mode':params['test_mode'],
+          't_attn_size':params['t_attn_size'], 'feat_dtype':feat_dtype.name}
+  writer = ShardWriter(os.path.join(params['output_dir'], params['split']), params['shard_size_mb']*1024**2, meta)
+
+  # segments are kept in the dic order, i.e., grouped by video
+  num_written = 0
+  for ix in np.nonzero(catalog.splits == params['split'])[0]:
+    seg_id = str(catalog.seg_ids[ix])
+    vid_id = seg_id.split('_segment_')[0]
+    region_file = os.path.join(params['feature_root'], seg_id+'.npy')
+    if not os.path.isfile(region_file) or \
+        not os.path.isfile(os.path.join(params['seg_feature_root'], vid_id[2:]+'_bn.npy')):
+      continue
+
+    region_feature = np.load(region_file)
+    region_feature = region_feature.reshape(-1, region_feature.shape[2]).astype(feat_dtype, copy=False)
+    proposals = proposal_store[ix]
+    assert(proposals.shape[0] == region_feature.shape[0])
+    seg_feature, num_frm = load_seg_feature(params['seg_feature_root'], vid_id, params['t_attn_size'], feat_dtype)
+    cap_seq, gt_bboxs, timestamps, dur = catalog.annotation(ix)
+
+    writer.write({'seg_id':seg_id, 'num_frm':num_frm, 'timestamps':timestamps.tolist(), 'duration':float(dur)},
+                 {'proposals':proposals, 'region_feature':region_feature, 'seg_feature':seg_feature,
+                  'cap_seq':cap_seq, 'gt_bboxs':gt_bboxs})
+    num_written += 1
+  writer.close()
+  print('wrote {} segments of split {} to {}'.format(num_written, params['split'], writer.root))
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser()
+
+  parser.add_argument('--input_json', default='data/anet/cap_anet_trainval.json', help='caption annotation file')
+  parser.add_argument('--input_dic', default='data/anet/dic_anet.json', help='vocabulary/segment file')
+  parser.add_argument('--input_raw_cap', default='data/anet/anet_captions_all_splits.json', help='caption file with the segment boundaries')
+  parser.add_argument('--proposal_h5', default='data/anet/anet_detection_vg_fc6_feat_100rois.h5', help='proposal file')
+  parser.add_argument('--feature_root', default='data/anet/fc6_feat_100rois', help='directory of the per-segment region feature files')
+  parser.add_argument('--seg_feature_root', default='data/anet/rgb_motion_1d', help='directory of the frame-wise feature files')
+  parser.add_argument('--split', default='training', help='split to write')
+  parser.add_argument('--output_dir', default='data/anet/sample_shards', help='output directory, the shards go to output_dir/split')
+  parser.add_argument('--shard_size_mb', default=1024, type=int, help='approximate size of each shard')
+  parser.add_argument('--feat_dtype', default='float32', choices=['float32', 'float16'], help='dtype of the stored features')
+  parser.add_argument('--seq_length', default=20, type=int, help='must match --seq_length in opts.py')
+  parser.add_argument('--t_attn_size', default=480, type=int, help='must match --t_attn_size in opts.py')
+  parser.add_argument('--test_mode', action='store_true', help='build dummy gt boxes as for the hidden testing split')
+
+  args = parser.parse_args()
+  params = vars(args) # convert to ordinary dict
+  print('parsed input parameters:')
+  print(json.dumps(params, indent = 2))
+  main(params)
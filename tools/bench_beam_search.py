@@ -0,0 +1,185 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+
+# Latency benchmark of the batched beam search (CaptionModel.beam_search) against the
+# previous per-segment implementation (Python candidate lists sorted per step, kept
+# below as legacy_beam_search with its core call fixed and without .cuda()), on the
+# CPU and, if available, the GPU. Uses a randomly initialized TopDownModel and random
+# inputs of the sizes given by the usual model options, so the captions rarely end
+# before seq_length (the worst case for both). Also reports how many captions agree
+# (candidates with equal scores may be ordered differently, more often with random weights).
+# Usage: python tools/bench_beam_search.py --bench_beam_sizes 3 5 --bench_batch_size 50 [main.py options...]
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import os
+import sys
+import time
+import types
+import numpy as np
+import torch
+import torch.nn.functional as F
+import yaml
+
+_SCRIPTPATH_ = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(_SCRIPTPATH_, '..'))
+import opts
+from misc import utils, AttModel
+
+
+def legacy_segment_beam_search(self, state, rnn_output, beam_size, core_inputs, core_extra_inputs):
+    # beam search of a single segment, as in the previous CaptionModel.beam_search
+    device = rnn_output.device
+    beam_seq = torch.LongTensor(self.seq_length, beam_size).zero_()
+    beam_seq_logprobs = torch.FloatTensor(self.seq_length, beam_size).zero_()
+    beam_logprobs_sum = torch.zeros(beam_size)
+    done_beams = []
+    for t in range(self.seq_length):
+        logprobsf = F.log_softmax(self.logit(rnn_output), dim=1).data.cpu()
+        ys, ix = torch.sort(logprobsf, 1, True)
+        candidates = []
+        for c in range(min(beam_size, ys.size(1))):
+            for q in range(1 if t == 0 else beam_size):
+                candidates.append({'c':ix[q,c], 'q':q, 'p':beam_logprobs_sum[q] + ys[q,c], 'r':ys[q,c]})
+        candidates = sorted(candidates, key=lambda x: -x['p'])
+
+        new_state = [_.clone() for _ in state]
+        new_rnn_output = rnn_output.clone()
+        beam_seq_prev = beam_seq[:t].clone()
+        beam_seq_logprobs_prev = beam_seq_logprobs[:t].clone()
+        for vix in range(beam_size):
+            v = candidates[vix]
+            beam_seq[:t, vix] = beam_seq_prev[:, v['q']]
+            beam_seq_logprobs[:t, vix] = beam_seq_logprobs_prev[:, v['q']]
+            for state_ix in range(len(new_state)):
+                new_state[state_ix][:, vix] = state[state_ix][:, v['q']]
+            new_rnn_output[vix] = rnn_output[v['q']]
+            beam_seq[t, vix] = v['c']
+            beam_seq_logprobs[t, vix] = v['r']
+            beam_logprobs_sum[vix] = v['p']
+        state, rnn_output = new_state, new_rnn_output
+
+        for vix in range(beam_size):
+            if beam_seq[t, vix] == 0 or t == self.seq_length - 1:
+                done_beams.append({'seq':beam_seq[:, vix].clone(), 'logps':beam_seq_logprobs[:, vix].clone(),
+                                   'p':beam_logprobs_sum[vix].item()})
+                beam_logprobs_sum[vix] = -1000
+
+        xt = self.embed(beam_seq[t].to(device))
+        rnn_output, state, _, _, _, _ = self.core(xt, *(tuple(core_inputs) + (state,) + tuple(core_extra_inputs)))
+    return sorted(done_beams, key=lambda x: -x['p'])
+
+
+def legacy_beam_search(self, state, rnn_output, att2_weight, beam_size, core_inputs, core_extra_inputs=()):
+    # same interface as CaptionModel.beam_search, one segment at a time (no region attention output)
+    num_rows = rnn_output.size(0)
+    batch_size = num_rows // beam_size
+    seq = rnn_output.data.new(batch_size, self.seq_length).long().zero_()
+    seq_logprobs = rnn_output.data.new(batch_size, self.seq_length).zero_()
+    att2 = rnn_output.data.new(batch_size, self.seq_length, att2_weight.size(1)).zero_()
+    for k in range(batch_size):
+        rows = slice(k*beam_size, (k+1)*beam_size)
+        # the inputs have a row per beam (fc_feats) or per segment, the rest are dummies
+        select = lambda inputs: tuple(x[rows] if x.size(0) == num_rows else x[k:k+1] if x.size(0) == batch_size \
+            else x for x in inputs)
+        done_beams = legacy_segment_beam_search(self, [s[:, rows] for s in state], rnn_output[rows], beam_size,
+            select(core_inputs), select(core_extra_inputs))
+        seq[k] = done_beams[0]['seq'].to(seq.device)
+        seq_logprobs[k] = done_beams[0]['logps'].to(seq.device)
+    return seq, seq_logprobs, att2
+
+
+def make_inputs(opt, batch_size, device, seed):
+    g = torch.Generator().manual_seed(seed)
+    rois_num = opt.num_sampled_frm*opt.num_prop_per_frm
+    segs_feat = torch.randn(batch_size, opt.t_attn_size, 3072, generator=g)
+    ppls = torch.zeros(batch_size, rois_num, 7)
+    xy = torch.rand(batch_size, rois_num, 2, generator=g)*600
+    ppls[:,:,0:2] = xy
+    ppls[:,:,2:4] = xy + 20 + torch.rand(batch_size, rois_num, 2, generator=g)*100
+    ppls[:,:,4] = torch.arange(rois_num).float().div(opt.num_prop_per_frm).floor()
+    ppls[:,:,6] = torch.rand(batch_size, rois_num, generator=g)
+    ppls_feat = torch.randn(batch_size, rois_num, opt.att_feat_size, generator=g)
+    num = torch.zeros(batch_size, 7)
+    num[:,1] = rois_num
+    num[:,4] = 3
+    num[:,5] = 0.1
+    num[:,6] = 0.6
+    sample_idx = torch.LongTensor([[0, opt.t_attn_size//2]]*batch_size)
+    pnt_mask = torch.cat((torch.zeros(batch_size, 1), (ppls[:,:,6] < opt.prop_thresh).float()), 1).byte()
+    return [x.to(device) for x in (segs_feat, ppls, num, ppls_feat, sample_idx, pnt_mask)]
+
+
+def run(model, inputs, beam_size, repeat):
+    segs_feat, ppls, num, ppls_feat, sample_idx, pnt_mask = inputs
+    dummy = ppls.new(ppls.size(0)).byte().fill_(0)
+    times = []
+    with torch.no_grad():
+        for _ in range(repeat):
+            if ppls.is_cuda:
+                torch.cuda.synchronize()
+            start = time.time()
+            seq, att2_weights, sim_mat = model(segs_feat, dummy, dummy, num, ppls, dummy, dummy, ppls_feat, dummy,
+                sample_idx, pnt_mask, 'sample', {'beam_size':beam_size})
+            if ppls.is_cuda:
+                torch.cuda.synchronize()
+            times.append(time.time() - start)
+    return seq.cpu(), np.median(times)*1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--bench_beam_sizes', type=int, nargs='+', default=[3, 5])
+    parser.add_argument('--bench_batch_size', type=int, default=50)
+    parser.add_argument('--bench_vocab_size', type=int, default=5000)
+    parser.add_argument('--bench_detect_size', type=int, default=431)
+    parser.add_argument('--bench_repeat', type=int, default=3)
+    args, remaining = parser.parse_known_args()
+    sys.argv = sys.argv[:1] + remaining
+
+    opt = opts.parse_opt()
+    if opt.path_opt is not None:
+        with open(opt.path_opt, 'r') as handle:
+            options_yaml = yaml.load(handle)
+        utils.update_values(options_yaml, vars(opt))
+    opt.test_mode = False
+    opt.transfer_mode = 'none' # no GloVe/detector class transfer for random weights
+    opt.vocab_size = args.bench_vocab_size
+    opt.detect_size = args.bench_detect_size
+    opt.wtoi = {'UNK':args.bench_vocab_size-1}
+    opt.itod = {i:str(i) for i in range(1, args.bench_detect_size+1)}
+    opt.enable_visdom = False
+    assert opt.att_model == 'topdown', 'the benchmark runs the TopDownModel beam search'
+    assert min(args.bench_beam_sizes) > 1, 'beam size 1 is greedy decoding'
+
+    torch.manual_seed(opt.seed)
+    model = AttModel.TopDownModel(opt)
+    model.eval()
+    legacy_model = types.MethodType(legacy_beam_search, model)
+
+    devices = ['cpu'] + (['cuda'] if torch.cuda.is_available() else [])
+    print('batch size {}, seq_length {}, vocabulary {}, {} proposals'.format(args.bench_batch_size, opt.seq_length,
+        args.bench_vocab_size, opt.num_sampled_frm*opt.num_prop_per_frm))
+    print('{:<8}{:>6}{:>14}{:>14}{:>10}{:>12}'.format('device', 'beam', 'legacy ms', 'batched ms', 'speedup', 'same seq'))
+    for device in devices:
+        model.to(device)
+        inputs = make_inputs(opt, args.bench_batch_size, device, opt.seed)
+        for beam_size in args.bench_beam_sizes:
+            model.beam_search = legacy_model
+            legacy_seq, legacy_ms = run(model, inputs, beam_size, args.bench_repeat)
+            del model.beam_search # back to CaptionModel.beam_search
+            seq, ms = run(model, inputs, beam_size, args.bench_repeat)
+            same = sum(torch.equal(a, b) for a, b in zip(seq, legacy_seq))
+            print('{:<8}{:>6}{:>14.1f}{:>14.1f}{:>9.1f}x{:>11.1f}%'.format(device, beam_size, legacy_ms, ms,
+                legacy_ms/ms, same*100./len(seq)))
+
+
+if __name__ == '__main__':
+    main()
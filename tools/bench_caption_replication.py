@@ -0,0 +1,187 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+
+# Peak memory of a training step (forward + backward) with seq_per_img > 1, where the
+# captions of a segment share the features of the segment, against the previous
+# replication of the visual features per caption. The replicated run feeds every caption
+# its own copy of the segment (each segment repeated seq_per_img times, seq_per_img 1),
+# which embeds and attends over the same copies the previous _forward made. Uses a randomly
+# initialized TopDownModel in eval mode (no dropout) and random inputs of the sizes given by
+# the usual model options; the losses of the two runs must agree. The peak is
+# torch.cuda.max_memory_allocated on the GPU, or the growth of the peak RSS of a fresh
+# process per run on the CPU.
+# Usage: python tools/bench_caption_replication.py --bench_seq_per_img 5 --bench_batch_size 5 [main.py options...]
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import os
+import resource
+import subprocess
+import sys
+import time
+import torch
+import yaml
+
+_SCRIPTPATH_ = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(_SCRIPTPATH_, '..'))
+import opts
+from misc import utils, AttModel
+
+
+def make_inputs(opt, batch_size, seq_per_img, device, seed):
+    # a training batch: random proposals and features, and captions of random words, about a
+    # third of them visual words grounded in one of the gt boxes
+    g = torch.Generator().manual_seed(seed)
+    rois_num = opt.num_sampled_frm*opt.num_prop_per_frm
+    num_box, seq_length = 10, opt.seq_length
+    vocab_size, detect_size = opt.vocab_size, opt.detect_size
+    segs_feat = torch.randn(batch_size, opt.t_attn_size, 3072, generator=g)
+    ppls = torch.zeros(batch_size, rois_num, 7)
+    xy = torch.rand(batch_size, rois_num, 2, generator=g)*600
+    ppls[:,:,0:2] = xy
+    ppls[:,:,2:4] = xy + 20 + torch.rand(batch_size, rois_num, 2, generator=g)*100
+    ppls[:,:,4] = torch.arange(rois_num).float().div(opt.num_prop_per_frm).floor()
+    ppls[:,:,5] = torch.randint(1, detect_size+1, (batch_size, rois_num), generator=g).float()
+    ppls[:,:,6] = torch.rand(batch_size, rois_num, generator=g)
+    ppls_feat = torch.randn(batch_size, rois_num, opt.att_feat_size, generator=g)
+    gt_boxes = torch.zeros(batch_size, num_box, 6)
+    gt_boxes[:,:,:5] = ppls[:, :num_box, :5]
+    gt_boxes[:,:,5] = torch.randint(1, detect_size+1, (batch_size, num_box), generator=g).float()
+
+    words = torch.randint(1, vocab_size-1, (batch_size, 10, seq_length), generator=g)
+    gt_seq = words.clone()
+    vis = (torch.rand(batch_size, seq_per_img, seq_length, generator=g) < 0.3)
+    det = torch.randint(1, detect_size+1, (batch_size, seq_per_img, seq_length), generator=g)
+    input_seq = torch.zeros(batch_size, seq_per_img, seq_length+1, 4).long()
+    input_seq[:,:,1:,0] = torch.where(vis, det+vocab_size, words[:, :seq_per_img])
+    input_seq[:,:,1:,1] = det*vis.long()
+    input_seq[:,:,1:,2] = vis.long()
+    input_seq[:,:,1:,3] = words[:, :seq_per_img]
+    mask_boxes = torch.ones(batch_size, seq_per_img, num_box, seq_length+1).byte()
+    box = torch.randint(0, num_box, (batch_size, seq_per_img, seq_length), generator=g)
+    for b, c, t in vis.nonzero().tolist():
+        mask_boxes[b, c, box[b, c, t], t+1] = 0
+
+    num = torch.zeros(batch_size, 7)
+    num[:,0] = 10
+    num[:,1] = rois_num
+    num[:,2] = num_box
+    num[:,4] = 3
+    num[:,5] = 0.1
+    num[:,6] = 0.6
+    frm_mask = (ppls[:,:,4].unsqueeze(2) != gt_boxes[:,:,4].unsqueeze(1)).byte()
+    sample_idx = torch.LongTensor([[0, opt.t_attn_size//2]]*batch_size)
+    pnt_mask = torch.cat((torch.zeros(batch_size, 1), (ppls[:,:,6] < opt.prop_thresh).float()), 1).byte()
+    return [x.to(device) for x in (segs_feat, input_seq, gt_seq, num, ppls, gt_boxes, mask_boxes, ppls_feat, \
+        frm_mask, sample_idx, pnt_mask)]
+
+
+def replicate_inputs(inputs, seq_per_img):
+    # a copy of the segment per caption, the captions at position 0 of their copy
+    segs_feat, input_seq, gt_seq, num, ppls, gt_boxes, mask_boxes, ppls_feat, frm_mask, sample_idx, pnt_mask = inputs
+    batch_size = segs_feat.size(0)
+    repeat = lambda x: x.unsqueeze(1).expand(batch_size, seq_per_img, *x.size()[1:]).contiguous() \
+        .view(batch_size*seq_per_img, *x.size()[1:])
+    gt_seq = gt_seq[:, :seq_per_img].contiguous().view(batch_size*seq_per_img, 1, gt_seq.size(2))
+    input_seq = input_seq.view(batch_size*seq_per_img, 1, *input_seq.size()[2:])
+    mask_boxes = mask_boxes.view(batch_size*seq_per_img, 1, *mask_boxes.size()[2:])
+    return [repeat(segs_feat), input_seq, gt_seq, repeat(num), repeat(ppls), repeat(gt_boxes), mask_boxes, \
+        repeat(ppls_feat), repeat(frm_mask), repeat(sample_idx), repeat(pnt_mask)]
+
+
+def run(model, inputs, seq_per_img, replicated):
+    # one forward + backward, returns the losses, the peak memory growth (bytes) and the time (ms)
+    if replicated:
+        inputs = replicate_inputs(inputs, seq_per_img)
+    model.seq_per_img = 1 if replicated else seq_per_img
+    device = inputs[0].device
+    model.zero_grad()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+        torch.cuda.reset_max_memory_allocated()
+        base = torch.cuda.memory_allocated()
+    else:
+        base = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*1024
+    start = time.time()
+    losses = model(*(inputs + ['MLE']))
+    sum(losses).backward()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+        peak = torch.cuda.max_memory_allocated() - base
+    else:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*1024 - base
+    elapsed = (time.time() - start)*1000
+    return [l.item() for l in losses], peak, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--bench_seq_per_img', type=int, default=5)
+    parser.add_argument('--bench_batch_size', type=int, default=5)
+    parser.add_argument('--bench_vocab_size', type=int, default=5000)
+    parser.add_argument('--bench_detect_size', type=int, default=431)
+    parser.add_argument('--bench_run', type=str, default='', help='internal: replicated|shared on the CPU')
+    args, remaining = parser.parse_known_args()
+
+    if not args.bench_run and not torch.cuda.is_available():
+        # the peak RSS only grows, measure every run in its own process
+        results = []
+        for name in ('replicated', 'shared'):
+            out = subprocess.check_output([sys.executable, os.path.abspath(__file__), '--bench_run', name] + \
+                sys.argv[1:]).decode('utf-8').strip().split('\n')[-1].split()
+            results.append((name, [float(x) for x in out[:-2]], float(out[-2]), float(out[-1])))
+        report('cpu', args, results)
+        return
+
+    sys.argv = sys.argv[:1] + remaining
+    opt = opts.parse_opt()
+    if opt.path_opt is not None:
+        with open(opt.path_opt, 'r') as handle:
+            options_yaml = yaml.load(handle)
+        utils.update_values(options_yaml, vars(opt))
+    opt.test_mode = False
+    opt.transfer_mode = 'none' # no GloVe/detector class transfer for random weights
+    opt.seq_per_img = args.bench_seq_per_img
+    opt.vocab_size = args.bench_vocab_size
+    opt.detect_size = args.bench_detect_size
+    opt.wtoi = {'UNK':args.bench_vocab_size-1}
+    opt.itod = {i:str(i) for i in range(1, args.bench_detect_size+1)}
+    opt.enable_visdom = False
+    assert opt.att_model == 'topdown', 'the benchmark runs the TopDownModel'
+
+    torch.manual_seed(opt.seed)
+    model = AttModel.TopDownModel(opt)
+    model.eval()
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    model.to(device)
+    inputs = make_inputs(opt, args.bench_batch_size, args.bench_seq_per_img, device, opt.seed)
+
+    if args.bench_run:
+        losses, peak, ms = run(model, inputs, args.bench_seq_per_img, args.bench_run == 'replicated')
+        print(' '.join(str(x) for x in losses + [peak, ms]))
+        return
+    results = []
+    for name in ('replicated', 'shared'):
+        run(model, inputs, args.bench_seq_per_img, name == 'replicated') # warm up
+        results.append((name,) + run(model, inputs, args.bench_seq_per_img, name == 'replicated'))
+    report(device, args, results)
+
+
+def report(device, args, results):
+    print('{}, batch size {}, seq_per_img {} ({})'.format(device, args.bench_batch_size, args.bench_seq_per_img, \
+        'torch.cuda.max_memory_allocated' if device == 'cuda' else 'peak RSS growth of a fresh process'))
+    print('{:<12}{:>14}{:>12}   {}'.format('features', 'peak MB', 'ms', 'losses (lm, att2, ground, cls)'))
+    for name, losses, peak, ms in results:
+        print('{:<12}{:>14.1f}{:>12.1f}   {}'.format(name, peak/1024.**2, ms, ', '.join('{:.5f}'.format(l) \
+            for l in losses)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,169 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+
+# Per-sample allocation benchmark of DataLoader.__getitem__. Reports the peak numpy
+# memory allocated while building a sample (tracked by tracemalloc) and the bytes of the
+# returned sample, i.e., what a worker sends to the main process, for the float32 and
+# the --feat_half float16 feature buffers. The legacy numbers are measured the same way on
+# legacy_getitem below, the previous __getitem__ allocation path (padded buffers allocated
+# in float64 and converted with .float()/.long()/.byte()) on the same inputs.
+# Usage: python tools/bench_sample_alloc.py --bench_samples 50 [main.py options...]
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import os
+import random
+import sys
+import time
+import tracemalloc
+import numpy as np
+import torch
+import yaml
+
+_SCRIPTPATH_ = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(_SCRIPTPATH_, '..'))
+import opts
+from misc import utils
+from misc.dataloader_anet import DataLoader
+from misc.feature_store import load_seg_feature
+
+
+def sample_nbytes(sample):
+    nbytes = 0
+    for x in sample:
+        if isinstance(x, np.ndarray):
+            nbytes += x.nbytes
+        elif torch.is_tensor(x):
+            nbytes += x.numel()*x.element_size()
+    return nbytes
+
+
+def legacy_getitem(self, index):
+    # the previous __getitem__ from the catalog annotations on, without the frames for visualization
+    ix = self.split_ix[index]
+    seg_id = str(self.catalog.seg_ids[ix])
+    vid_id = seg_id.split('_segment_')[0]
+    seg_id_ix = int(seg_id.split('_segment_')[1])
+    cap_seq, gt_bboxs, timestamps, dur = self.catalog.annotation(ix)
+    cap_seq, gt_bboxs = cap_seq.astype(np.float64), gt_bboxs.astype(np.float64)
+
+    proposals = np.array(self.proposal_store[ix], dtype=np.float64)
+    region_feature = self.load_region_feature(seg_id)
+    pnt_mask = self.get_pnt_mask(proposals)
+    seg_feature, num_frm = load_seg_feature(self.seg_feature_root, vid_id, self.t_attn_size, dtype=np.float64)
+
+    sample_idx = np.array([np.round(num_frm*timestamps[0]*1./dur), np.round(num_frm*timestamps[1]*1./dur)])
+    sample_idx = np.clip(np.round(sample_idx), 0, self.t_attn_size).astype(int)
+
+    ncap = cap_seq.shape[0]
+    box_mask = np.ones((ncap, gt_bboxs.shape[0], self.seq_length))
+    for i in range(gt_bboxs.shape[0]):
+        box_mask[0, i, int(gt_bboxs[i][7])] = 0
+    gt_bboxs = gt_bboxs[:,:6]
+
+    if ncap < self.seq_per_img:
+        seq_batch = np.zeros([self.seq_per_img, self.seq_length, 4])
+        mask_batch = np.zeros([self.seq_per_img, gt_bboxs.shape[0], self.seq_length])
+        for q in range(self.seq_per_img):
+            ixl = random.randint(0,ncap)
+            seq_batch[q,:] = cap_seq[ixl,:,:4]
+            mask_batch[q,:] = box_mask[ixl]
+    else:
+        ixl = random.randint(0, ncap - self.seq_per_img)
+        seq_batch = cap_seq[ixl:ixl+self.seq_per_img,:,:4]
+        mask_batch = box_mask[ixl:ixl+self.seq_per_img]
+
+    input_seq = np.zeros([self.seq_per_img, self.seq_length+1, 4])
+    input_seq[:,1:] = seq_batch
+    gt_seq = np.zeros([10, self.seq_length])
+    gt_seq[:ncap,:] = cap_seq[:,:,4]
+
+    pad_proposals = np.zeros((self.max_proposal, 7))
+    pad_pnt_mask = np.ones((self.max_proposal))
+    pad_gt_bboxs = np.zeros((self.max_gt_box, 6))
+    pad_box_mask = np.ones((self.seq_per_img, self.max_gt_box, self.seq_length+1))
+    pad_region_feature = np.zeros((self.max_proposal, self.att_feat_size))
+    pad_frm_mask = np.ones((self.max_proposal, self.max_gt_box))
+
+    num_box = min(gt_bboxs.shape[0], self.max_gt_box)
+    num_pps = min(proposals.shape[0], self.max_proposal)
+    pad_proposals[:num_pps] = proposals[:num_pps]
+    pad_pnt_mask[:num_pps] = pnt_mask[:num_pps]
+    pad_gt_bboxs[:num_box] = gt_bboxs[:num_box]
+    pad_box_mask[:,:num_box,1:] = mask_batch[:,:num_box,:]
+    pad_region_feature[:num_pps] = region_feature[:num_pps]
+    pad_frm_mask[:num_pps, :num_box] = self.get_frm_mask(pad_proposals[:num_pps, 4], pad_gt_bboxs[:num_box, 4])
+
+    input_seq = torch.from_numpy(input_seq).long()
+    gt_seq = torch.from_numpy(gt_seq).long()
+    pad_proposals = torch.from_numpy(pad_proposals).float()
+    pad_pnt_mask = torch.from_numpy(pad_pnt_mask).byte()
+    pad_gt_bboxs = torch.from_numpy(pad_gt_bboxs).float()
+    pad_box_mask = torch.from_numpy(pad_box_mask).byte()
+    pad_region_feature = torch.from_numpy(pad_region_feature).float()
+    pad_proposals.masked_fill_(pad_pnt_mask.view(-1, 1), 0.)
+    pad_region_feature.masked_fill_(pad_pnt_mask.view(-1, 1), 0.)
+    pad_frm_mask = torch.from_numpy(pad_frm_mask).byte()
+    num = torch.FloatTensor([ncap, num_pps, num_box, seg_id_ix,
+        self.catalog.num_seg_in_video[self.catalog.index(seg_id)], timestamps[0]*1./dur, timestamps[1]*1./dur])
+    sample_idx = torch.from_numpy(sample_idx).long()
+    return seg_feature, input_seq, gt_seq, num, pad_proposals, pad_gt_bboxs, pad_box_mask, seg_id, \
+        pad_region_feature, pad_frm_mask, sample_idx, pad_pnt_mask
+
+
+def bench(opt, num_samples, legacy=False):
+    dataset = DataLoader(opt, split=opt.train_split, seq_per_img=opt.seq_per_img)
+    getitem = (lambda i: legacy_getitem(dataset, i)) if legacy else dataset.__getitem__
+    num_samples = min(num_samples, len(dataset))
+    getitem(0) # warms up the lazily opened files
+
+    peaks, returned = [], []
+    start = time.time()
+    for i in range(num_samples):
+        tracemalloc.start()
+        sample = getitem(i)
+        peaks.append(tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+        returned.append(sample_nbytes(sample))
+        del sample
+    elapsed = time.time() - start
+    return np.mean(peaks), np.mean(returned), elapsed*1000/num_samples
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--bench_samples', type=int, default=50)
+    args, remaining = parser.parse_known_args()
+    sys.argv = sys.argv[:1] + remaining
+
+    opt = opts.parse_opt()
+    if opt.path_opt is not None:
+        with open(opt.path_opt, 'r') as handle:
+            options_yaml = yaml.load(handle)
+        utils.update_values(options_yaml, vars(opt))
+    opt.test_mode = (opt.val_split == 'testing')
+    opt.seg_feat_cache_mb = 0 # measure the full sample construction
+    opt.seg_feat_cache_dir = ''
+    opt.sample_cache_dir = ''
+
+    assert not opt.packed_proposals, 'the legacy path pads to max_proposal, compare without --packed_proposals'
+
+    results = []
+    for name, feat_half, legacy in (('legacy', False, True), ('float32', False, False), ('float16', True, False)):
+        opt.feat_half = feat_half
+        results.append((name,) + bench(opt, args.bench_samples, legacy))
+
+    print('{:<10}{:>18}{:>18}{:>12}'.format('features', 'allocated MB', 'returned MB', 'ms/sample'))
+    for name, peak, returned, ms in results:
+        print('{:<10}{:>18.2f}{:>18.2f}{:>12.2f}'.format(name, peak/1024.**2, returned/1024.**2, ms))
+
+
+if __name__ == '__main__':
+    main()
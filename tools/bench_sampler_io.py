@@ -0,0 +1,101 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+
+# I/O benchmark of the training sample order: loads the first batches of an epoch with
+# the default fully random sampler and with the --block_shuffle sampler and reports the
+# load throughput, how clustered the reads are (distinct videos per batch, mean jump in
+# the feature file/shard order between consecutive reads) and the hit rates of the
+# enabled caches (e.g., --seg_feat_cache_mb). For cold reads, drop the page cache between
+# the runs (or pass --bench_samplers in the other order).
+# Usage: python tools/bench_sampler_io.py --bench_batches 200 --shuffle_window 1000 [main.py options...]
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import os
+import sys
+import time
+import numpy as np
+import torch
+import yaml
+
+_SCRIPTPATH_ = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(_SCRIPTPATH_, '..'))
+import opts
+from misc import utils
+from misc.dataloader_anet import DataLoader
+from misc.samplers import BlockShuffleSampler
+
+
+def read_order_stats(dataset, blocks, batches):
+    # storage position and video of every sample, from the blocks of single videos
+    pos = np.zeros(len(dataset), dtype=np.int64)
+    vid = np.zeros(len(dataset), dtype=np.int64)
+    for v, block in enumerate(blocks):
+        vid[block] = v
+    pos[np.concatenate(blocks)] = np.arange(len(dataset))
+    reads = np.concatenate(batches)
+    jumps = np.abs(np.diff(pos[reads])) if len(reads) > 1 else np.zeros(1)
+    videos = np.mean([len(np.unique(vid[b])) for b in batches])
+    return videos, np.mean(jumps)
+
+
+def bench(opt, dataset, name, batch_sampler, num_batches):
+    batches = []
+    for batch in batch_sampler:
+        batches.append(np.asarray(batch))
+        if len(batches) == num_batches:
+            break
+    loader = torch.utils.data.DataLoader(dataset, batch_sampler=batches, num_workers=opt.num_workers,
+                                         worker_init_fn=dataset.init_worker, collate_fn=dataset.collate)
+    for stats in dataset.cache_stats():
+        stats.reset()
+    start = time.time()
+    for _ in loader:
+        pass
+    elapsed = time.time() - start
+    num_samples = sum(len(b) for b in batches)
+    videos, jump = read_order_stats(dataset, dataset.sample_blocks(1), batches)
+    print('{:<8}{:>14.1f}{:>16.2f}{:>16.1f}'.format(name, num_samples/elapsed, videos, jump))
+    for stats in dataset.cache_stats():
+        print('    '+stats.summary())
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--bench_batches', type=int, default=200)
+    parser.add_argument('--bench_samplers', type=str, nargs='+', default=['random', 'block'],
+                        choices=['random', 'block'])
+    args, remaining = parser.parse_known_args()
+    sys.argv = sys.argv[:1] + remaining
+
+    opt = opts.parse_opt()
+    if opt.path_opt is not None:
+        with open(opt.path_opt, 'r') as handle:
+            options_yaml = yaml.load(handle)
+        utils.update_values(options_yaml, vars(opt))
+    opt.test_mode = (opt.val_split == 'testing')
+    opt.prefetch_depth = 0 # the batches are given as a plain list
+    np.random.seed(opt.seed)
+
+    dataset = DataLoader(opt, split=opt.train_split, seq_per_img=opt.seq_per_img)
+    print('{} samples, batch size {}, {} workers, {} batches per sampler'.format(len(dataset), opt.batch_size,
+        opt.num_workers, args.bench_batches))
+    print('{:<8}{:>14}{:>16}{:>16}'.format('sampler', 'samples/s', 'videos/batch', 'mean jump'))
+    for name in args.bench_samplers:
+        if name == 'random':
+            sampler = torch.utils.data.RandomSampler(dataset)
+        else:
+            sampler = BlockShuffleSampler(dataset.sample_blocks(opt.shuffle_block_videos), opt.shuffle_window)
+        bench(opt, dataset, name, torch.utils.data.BatchSampler(sampler, opt.batch_size, False), args.bench_batches)
+    print('mean jump: distance in the feature file/shard order between consecutive reads, in samples')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,149 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+
+# Compare the bytes read per sample when loading the frame-wise rgb/motion features
+# in full (the legacy np.load + np.concatenate path) against the memory-mapped path
+# in misc/feature_store.py that only touches the first t_attn_size frames.
+# The bytes are the read_bytes of /proc/self/io (the reads that reached the storage),
+# next to the sizes of the arrays/rows (the estimates, the only figure if /proc/self/io
+# is not available). Readahead can make the memory-mapped reads larger than the rows.
+# The files of a pass are dropped from the page cache before it (posix_fadvise), or
+# the two passes use separate halves of the videos where that is not available. The
+# time to open the memory maps is reported separately from the time to read the rows.
+# Usage: python tools/bench_seg_feature_io.py --seg_feature_root data/anet/rgb_motion_1d
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import os
+import sys
+import time
+import numpy as np
+
+_SCRIPTPATH_ = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(_SCRIPTPATH_, '..'))
+from misc.feature_store import load_seg_feature
+
+
+def load_seg_feature_legacy(seg_feature_root, vid_id, t_attn_size):
+    seg_rgb_feature = np.load(os.path.join(seg_feature_root, vid_id[2:]+'_resnet.npy'))
+    seg_motion_feature = np.load(os.path.join(seg_feature_root, vid_id[2:]+'_bn.npy'))
+    seg_feature_raw = np.concatenate((seg_rgb_feature, seg_motion_feature), axis=1)
+    num_frm = seg_feature_raw.shape[0]
+    seg_feature = np.zeros((t_attn_size, seg_feature_raw.shape[1]))
+    seg_feature[:min(t_attn_size, num_frm)] = seg_feature_raw[:t_attn_size]
+    return seg_feature, num_frm, seg_rgb_feature.nbytes+seg_motion_feature.nbytes
+
+
+def read_bytes():
+    # bytes this process caused to be read from the storage, None if not available
+    try:
+        with open('/proc/self/io') as f:
+            for line in f:
+                if line.startswith('read_bytes:'):
+                    return int(line.split()[1])
+    except (IOError, OSError):
+        pass
+    return None
+
+
+def drop_page_cache(paths):
+    # evict the pages of the files from the page cache, False if not supported
+    if not hasattr(os, 'posix_fadvise'):
+        return False
+    for path in paths:
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        except OSError:
+            return False
+        finally:
+            os.close(fd)
+    return True
+
+
+class TimedLoader(object):
+    """np.load with the time spent opening the files, passed as the file_cache of load_seg_feature."""
+    def __init__(self):
+        self.open_time = 0.
+        self.row_bytes = 0 # bytes per row of the files opened since reset
+
+    def load(self, path, mmap_mode=None):
+        start = time.time()
+        array = np.load(path, mmap_mode=mmap_mode)
+        self.open_time += time.time() - start
+        self.row_bytes += array.strides[0]
+        return array
+
+
+def feature_files(seg_feature_root, vid_ids):
+    return [os.path.join(seg_feature_root, vid_id[2:]+suffix) for vid_id in vid_ids \
+        for suffix in ('_resnet.npy', '_bn.npy')]
+
+
+def run_pass(load, seg_feature_root, vid_ids, drop):
+    # returns the time and the measured (or None) and estimated bytes of loading the videos
+    if drop:
+        drop_page_cache(feature_files(seg_feature_root, vid_ids))
+    estimated_bytes = 0
+    io_start = read_bytes()
+    start = time.time()
+    for vid_id in vid_ids:
+        estimated_bytes += load(vid_id)
+    elapsed = time.time() - start
+    io_end = read_bytes()
+    measured_bytes = io_end - io_start if io_start is not None and io_end is not None else None
+    return elapsed, measured_bytes, estimated_bytes
+
+
+def main(args):
+    vid_ids = sorted(['v_'+f[:-len('_bn.npy')] for f in os.listdir(args.seg_feature_root) \
+        if f.endswith('_bn.npy')])[:args.num_videos]
+    assert len(vid_ids) > 0, 'no feature files found under {}'.format(args.seg_feature_root)
+
+    drop = drop_page_cache(feature_files(args.seg_feature_root, vid_ids[:1]))
+    if drop:
+        legacy_ids, mmap_ids = vid_ids, vid_ids
+    else:
+        # the page cache can't be dropped, read separate videos in the two passes
+        assert len(vid_ids) > 1, 'need at least two videos to read separate sets'
+        legacy_ids, mmap_ids = vid_ids[0::2], vid_ids[1::2]
+
+    def load_legacy(vid_id):
+        return load_seg_feature_legacy(args.seg_feature_root, vid_id, args.t_attn_size)[2]
+
+    loader = TimedLoader()
+    def load_mmap(vid_id):
+        loader.row_bytes = 0
+        seg_feature, num_frm = load_seg_feature(args.seg_feature_root, vid_id, args.t_attn_size, file_cache=loader)
+        # rows touched through the memory map, counted only for the estimate
+        return min(args.t_attn_size, num_frm)*loader.row_bytes
+
+    results = [('legacy', len(legacy_ids)) + run_pass(load_legacy, args.seg_feature_root, legacy_ids, drop),
+               ('mmap', len(mmap_ids)) + run_pass(load_mmap, args.seg_feature_root, mmap_ids, drop)]
+
+    print('{} videos, t_attn_size {}, {}'.format(len(vid_ids), args.t_attn_size, 'page cache dropped before each pass' \
+        if drop else 'separate videos per pass (page cache not dropped)'))
+    for name, num, elapsed, measured_bytes, estimated_bytes in results:
+        if measured_bytes is not None:
+            size = '{:.2f} MB read/sample ({:.2f} MB est.)'.format(measured_bytes/1024.**2/num, \
+                estimated_bytes/1024.**2/num)
+        else:
+            size = '{:.2f} MB read/sample (est.)'.format(estimated_bytes/1024.**2/num)
+        print('{:<8}{}, {:.2f} ms/sample'.format(name+':', size, elapsed*1000/num))
+    print('mmap open: {:.2f} ms/sample (included above)'.format(loader.open_time*1000/len(mmap_ids)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--seg_feature_root', type=str, default='data/anet/rgb_motion_1d')
+    parser.add_argument('--t_attn_size', type=int, default=480)
+    parser.add_argument('--num_videos', type=int, default=200)
+    main(parser.parse_args())
@@ -0,0 +1,119 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+
+# Check the accuracy cost of reduced-precision region features: runs
+# main.py --inference_only once per feature format (packed shards from
+# prepro/pack_region_feats.py, or feature_root if no shard directory is given) and
+# compares the captioning/grounding metrics and the generated sentences.
+# Usage: python tools/compare_feat_formats.py --formats '' data/anet/fc6_feat_100rois_int8 \
+#     -- --batch_size 100 --cuda --inference_only --start_from save/$ID --id $ID --val_split validation \
+#        --densecap_references ... --grd_reference ... --eval_obj_grounding --language_eval
+# (everything after -- is passed on to main.py, without --region_feat_shards)
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+
+_SCRIPTPATH_ = os.path.dirname(os.path.abspath(__file__))
+_ROOT_ = os.path.join(_SCRIPTPATH_, '..')
+
+# "Bleu_4: 2.345" (lang eval) and the accuracies printed by main.py/the grounding evaluator
+METRIC_RE = re.compile(r'^\s*([A-Za-z][\w ()./-]*?)\s*:\s*(-?\d+(?:\.\d+)?)\s*$')
+GT_ACCU_RE = re.compile(r'attention / grounding box accuracy across all classes is: ([\d.]+) / ([\d.]+)')
+CLS_ACCU_RE = re.compile(r'classification accuracy across all classes is: ([\d.]+)')
+
+
+def get_arg(main_args, name, default):
+    return main_args[main_args.index(name)+1] if name in main_args else default
+
+
+def run(args, main_args, shard_dir, run_name):
+    cmd = [sys.executable, 'main.py'] + main_args
+    if shard_dir:
+        cmd += ['--region_feat_shards', shard_dir]
+    print(' '.join(cmd))
+    log_file = os.path.join(args.log_dir, run_name+'.log')
+    with open(log_file, 'w') as f:
+        subprocess.check_call(cmd, cwd=_ROOT_, stdout=f, stderr=subprocess.STDOUT)
+    # the runs share the checkpoint id and thus the result files, keep a copy of the captions
+    submission = os.path.join(_ROOT_, 'results', 'densecap-{}-{}.json'.format(
+        get_arg(main_args, '--val_split', 'validation'), get_arg(main_args, '--id', '')))
+    if os.path.isfile(submission):
+        shutil.copy(submission, os.path.join(args.log_dir, run_name+'-densecap.json'))
+    with open(log_file) as f:
+        return parse_metrics(f.read().splitlines())
+
+
+def parse_metrics(lines):
+    metrics = {}
+    in_summary = False
+    for line in lines:
+        if line.startswith('Results Summary'):
+            in_summary = True
+            continue
+        match = GT_ACCU_RE.search(line)
+        if match:
+            metrics['GT sent box accuracy (attention)'] = float(match.group(1))
+            metrics['GT sent box accuracy (grounding)'] = float(match.group(2))
+            continue
+        match = CLS_ACCU_RE.search(line)
+        if match:
+            metrics['GT sent classification accuracy'] = float(match.group(1))
+            continue
+        match = METRIC_RE.match(line)
+        if in_summary and match:
+            metrics[match.group(1)] = float(match.group(2))
+    return metrics
+
+
+def load_sentences(args, run_name):
+    with open(os.path.join(args.log_dir, run_name+'-densecap.json')) as f:
+        results = json.load(f)['results']
+    return {(vid, tuple(p['timestamp'])):p['sentence'] for vid, preds in results.items() for p in preds}
+
+
+def main(args, main_args):
+    if not os.path.isdir(args.log_dir):
+        os.makedirs(args.log_dir)
+    names = [f if f else 'feature_root' for f in args.formats]
+    run_names = ['fmt{}'.format(i) for i in range(len(args.formats))]
+    metrics = [run(args, main_args, f, run_name) for f, run_name in zip(args.formats, run_names)]
+
+    keys = [k for k in metrics[0] if all(k in m for m in metrics[1:])]
+    print('{:40s}'.format('metric') + ''.join('{:>16s}'.format(os.path.basename(n.rstrip('/'))[-16:]) for n in names))
+    for k in keys:
+        row = '{:40s}{:16.4f}'.format(k[:40], metrics[0][k])
+        row += ''.join('{:+16.4f}'.format(m[k]-metrics[0][k]) for m in metrics[1:])
+        print(row)
+    print('(later columns are differences to the first format)')
+
+    if '--language_eval' in main_args:
+        ref = load_sentences(args, run_names[0])
+        for name, run_name in zip(names[1:], run_names[1:]):
+            sents = load_sentences(args, run_name)
+            same = sum(1 for k, s in ref.items() if sents.get(k) == s)
+            print('{}: {}/{} identical sentences ({:.1f}%)'.format(name, same, len(ref), same*100./max(len(ref), 1)))
+
+
+if __name__ == '__main__':
+    argv = sys.argv[1:]
+    main_args = argv[argv.index('--')+1:] if '--' in argv else []
+    argv = argv[:argv.index('--')] if '--' in argv else argv
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--formats', type=str, nargs='+', required=True,
+                        help="region feature shard directories to compare, '' for feature_root; the first one is the reference")
+    parser.add_argument('--log_dir', type=str, default='results/feat_formats', help='directory of the main.py logs')
+    main(parser.parse_args(argv), main_args)